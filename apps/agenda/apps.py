@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AgendaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.agenda'
+
+    def ready(self):
+        # Registrar receptores de señales (invalidación de caché de slots)
+        from . import signals  # noqa: F401
@@ -0,0 +1,553 @@
+# apps/agenda/availability.py
+"""
+Motor de disponibilidad del turnero.
+
+En lugar de consultar disponibilidades, bloqueos y turnos día por día, carga
+todo el rango pedido en tres consultas y luego recorre listas ordenadas de
+intervalos en una sola pasada (merge) para descartar los slots ocupados.
+
+Los slots se generan en la hora de pared de cada ubicación (Ubicacion.timezone)
+y solo dentro de la ventana de reserva del profesional (anticipación mínima y
+máxima): los días que no se pueden reservar no cuestan consultas.
+"""
+import datetime
+import heapq
+from functools import cached_property, lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import (
+    DisponibilidadHoraria,
+    BloqueoDisponibilidad,
+    Turno,
+    TipoConsultaConfig,
+    ProfessionalSettings,
+    TurnoState,
+)
+
+
+# Estados que ocupan el slot (los TENTATIVO solo mientras su soft-hold siga vigente)
+ESTADOS_OCUPAN_SLOT = [TurnoState.RESERVADO, TurnoState.CONFIRMADO, TurnoState.ATENDIDO]
+
+DURACION_POR_DEFECTO_MIN = 60
+
+# Anticipación mínima y máxima cuando el profesional no tiene ProfessionalSettings
+ANTICIPACION_MINIMA_POR_DEFECTO = datetime.timedelta(hours=2)
+HORIZONTE_POR_DEFECTO = datetime.timedelta(days=60)
+
+# El iterador carga los ocupados por bloques de días que crecen 1, 2, 4, ... hasta este tope
+DIAS_POR_BLOQUE_MAX = 14
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Zonas horarias por ubicación
+# ────────────────────────────────────────────────────────────────────────────────
+
+@lru_cache(maxsize=64)
+def _zoneinfo(nombre):
+    try:
+        return ZoneInfo(nombre)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def zona_horaria(nombre):
+    """ZoneInfo de una ubicación (cacheado por nombre); la zona actual si falta o no es válida."""
+    return (_zoneinfo(nombre) if nombre else None) or timezone.get_current_timezone()
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Configuración (duración + buffers)
+# ────────────────────────────────────────────────────────────────────────────────
+
+class ConfiguracionSlots:
+    """
+    Duración y buffers a usar para generar los slots de un pedido.
+    """
+    def __init__(self, duracion_min, buffer_before_min=0, buffer_after_min=0, settings=None):
+        self.settings = settings
+        self.duracion = datetime.timedelta(minutes=duracion_min)
+        self.buffer_before = datetime.timedelta(minutes=buffer_before_min)
+        self.buffer_after = datetime.timedelta(minutes=buffer_after_min)
+
+    @property
+    def total(self):
+        """Duración total del slot incluyendo buffers."""
+        return self.buffer_before + self.duracion + self.buffer_after
+
+
+class ResolutorBuffers:
+    """
+    Capa de resolución de buffers para un profesional.
+
+    Carga ProfessionalSettings y, recién cuando hace falta, todos sus
+    TipoConsultaConfig (una consulta cada uno). A partir de ahí resuelve en memoria
+    la ventana de reserva y la configuración de los slots pedidos. Lo que ocupa
+    cada turno existente no se resuelve acá: es su busy_range guardado.
+    """
+    def __init__(self, nutricionista):
+        self.nutricionista = nutricionista
+        self.settings = ProfessionalSettings.objects.filter(nutricionista=nutricionista).first()
+
+    @cached_property
+    def tipos(self):
+        return {
+            tipo.id: tipo
+            for tipo in TipoConsultaConfig.objects.filter(nutricionista=self.nutricionista).order_by('id')
+        }
+
+    @classmethod
+    def precargado(cls, settings, tipos):
+        """Resolutor armado con datos ya cargados (p. ej. en bloque para varios profesionales)."""
+        resolutor = cls.__new__(cls)
+        resolutor.settings = settings
+        resolutor.tipos = {tipo.id: tipo for tipo in sorted(tipos, key=lambda t: t.id)}
+        return resolutor
+
+    def ventana_de_reserva(self, now):
+        """Instantes [desde, hasta] en que puede empezar un turno reservado ahora."""
+        if self.settings is None:
+            return now + ANTICIPACION_MINIMA_POR_DEFECTO, now + HORIZONTE_POR_DEFECTO
+        return now + self.settings.anticipacion_minima, now + self.settings.anticipacion_maxima
+
+    @property
+    def buffers_por_defecto(self):
+        """Buffers globales (antes, después) del profesional, en minutos."""
+        if self.settings is None:
+            return 0, 0
+        return self.settings.buffer_before_min, self.settings.buffer_after_min
+
+    def configuracion(self, duracion_minutos=None, tipo_consulta_id=None):
+        """
+        Resuelve duración y buffers con las mismas reglas históricas de
+        calculate_available_slots:
+
+        - Buffers globales de ProfessionalSettings.
+        - Si llega tipo_consulta_id, su duración y buffers pisan a los globales.
+        - Sin duración explícita se usa el primer TipoConsultaConfig del profesional
+          (y sus buffers, si no se pidió un tipo), o 60 minutos como último recurso.
+        """
+        if self.settings is None:
+            return ConfiguracionSlots(duracion_minutos or DURACION_POR_DEFECTO_MIN)
+
+        buffer_before_min, buffer_after_min = self.buffers_por_defecto
+
+        if tipo_consulta_id:
+            tipo_consulta_config = self.tipos.get(int(tipo_consulta_id))
+            if tipo_consulta_config is not None:
+                duracion_minutos = tipo_consulta_config.duracion_min
+                buffer_before_min = tipo_consulta_config.buffer_before_min
+                buffer_after_min = tipo_consulta_config.buffer_after_min
+
+        if duracion_minutos is None:
+            default_tipo_consulta = next(iter(self.tipos.values()), None)
+            if default_tipo_consulta:
+                duracion_minutos = default_tipo_consulta.duracion_min
+                if not tipo_consulta_id:  # Solo usar buffers si no se especificó tipo_consulta_id
+                    buffer_before_min = default_tipo_consulta.buffer_before_min
+                    buffer_after_min = default_tipo_consulta.buffer_after_min
+            else:
+                duracion_minutos = DURACION_POR_DEFECTO_MIN
+
+        return ConfiguracionSlots(duracion_minutos, buffer_before_min, buffer_after_min, settings=self.settings)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Carga del rango (3 consultas)
+# ────────────────────────────────────────────────────────────────────────────────
+
+def limites_del_rango(start_date, end_date, tz):
+    """Devuelve [inicio, fin) en datetimes aware que cubren start_date..end_date inclusive."""
+    inicio = timezone.make_aware(datetime.datetime.combine(start_date, datetime.time.min), tz)
+    fin = timezone.make_aware(
+        datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time.min), tz
+    )
+    return inicio, fin
+
+
+def acotar_fechas(start_date, end_date, desde, hasta):
+    """
+    Recorta start_date..end_date a los días que tocan la ventana [desde, hasta].
+    Deja un día de margen a cada lado porque cada ubicación puede tener su propia
+    zona horaria; el filtro exacto se hace slot por slot (ver en_ventana).
+    end_date=None significa "hasta donde permita la ventana".
+    """
+    un_dia = datetime.timedelta(days=1)
+    start_date = max(start_date, timezone.localdate(desde) - un_dia)
+    limite = timezone.localdate(hasta) + un_dia
+    end_date = limite if end_date is None else min(end_date, limite)
+    return start_date, end_date
+
+
+def turnos_activos(now=None):
+    """Q de turnos que ocupan agenda: confirmados/reservados/atendidos o holds vigentes."""
+    now = now or timezone.now()
+    return (
+        Q(state__in=ESTADOS_OCUPAN_SLOT) |
+        (Q(state=TurnoState.TENTATIVO) & Q(soft_hold_expires_at__gt=now))
+    )
+
+
+def cargar_disponibilidades(nutricionista, ubicacion_id=None):
+    """
+    Disponibilidades recurrentes agrupadas por día de la semana (1 consulta).
+    Cada una trae `ubicacion_tz`, la zona horaria de su ubicación.
+    """
+    query = DisponibilidadHoraria.objects.filter(nutricionista=nutricionista).annotate(
+        ubicacion_tz=F('ubicacion__timezone')
+    )
+    if ubicacion_id:
+        query = query.filter(ubicacion_id=ubicacion_id)
+
+    por_dia = {}
+    for disp in query:
+        por_dia.setdefault(disp.dia_semana, []).append(disp)
+    return por_dia
+
+
+def cargar_ocupados(nutricionista, rango_inicio, rango_fin, ubicacion_id=None, now=None):
+    """
+    Intervalos ocupados (bloqueos + turnos con sus buffers) que tocan el rango.
+    Dos consultas: una para bloqueos y otra para turnos. De cada turno se usa su
+    busy_range guardado, el mismo que compara la restricción de solapes: si los
+    buffers del tipo cambiaron después de reservarlo, el turno conserva los suyos.
+    """
+    bloqueos = BloqueoDisponibilidad.objects.filter(
+        nutricionista=nutricionista,
+        start_time__lt=rango_fin,
+        end_time__gt=rango_inicio,
+    )
+    if ubicacion_id:
+        bloqueos = bloqueos.filter(ubicacion_id=ubicacion_id)
+    ocupados = list(bloqueos.values_list('start_time', 'end_time'))
+
+    turnos = Turno.objects.filter(
+        nutricionista=nutricionista,
+        busy_range__overlap=(rango_inicio, rango_fin),
+    ).filter(turnos_activos(now))
+    if ubicacion_id:
+        turnos = turnos.filter(ubicacion_id=ubicacion_id)
+
+    for busy_range in turnos.values_list('busy_range', flat=True):
+        ocupados.append((busy_range.lower, busy_range.upper))
+
+    return ocupados
+
+
+def cargar_ocupados_por_ubicacion(nutricionista, rango_inicio, rango_fin, now=None):
+    """
+    Como cargar_ocupados pero para todas las ubicaciones a la vez (las mismas dos
+    consultas), agrupando los intervalos por ubicacion_id.
+    """
+    por_ubicacion = {}
+    bloqueos = BloqueoDisponibilidad.objects.filter(
+        nutricionista=nutricionista,
+        start_time__lt=rango_fin,
+        end_time__gt=rango_inicio,
+    ).values_list('ubicacion_id', 'start_time', 'end_time')
+    for ubicacion_id, start_time, end_time in bloqueos:
+        por_ubicacion.setdefault(ubicacion_id, []).append((start_time, end_time))
+
+    turnos = Turno.objects.filter(
+        nutricionista=nutricionista,
+        busy_range__overlap=(rango_inicio, rango_fin),
+    ).filter(turnos_activos(now)).values_list('ubicacion_id', 'busy_range')
+    for ubicacion_id, busy_range in turnos:
+        por_ubicacion.setdefault(ubicacion_id, []).append((busy_range.lower, busy_range.upper))
+    return por_ubicacion
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Generación de candidatos + barrido
+# ────────────────────────────────────────────────────────────────────────────────
+
+def cortar_ventana(start_dt, end_dt, config):
+    """
+    Slots potenciales de una ventana de atención como tuplas
+    (total_inicio, total_fin, inicio, fin), donde total_* incluye los buffers
+    e inicio/fin es lo que ve el paciente.
+    """
+    candidatos = []
+    total_inicio = start_dt
+    while total_inicio + config.total <= end_dt:
+        inicio = total_inicio + config.buffer_before
+        candidatos.append((total_inicio, total_inicio + config.total, inicio, inicio + config.duracion))
+        total_inicio += config.total
+    return candidatos
+
+
+def iterar_candidatos(disponibilidades_por_dia, start_date, end_date, config):
+    """
+    Igual que generar_candidatos pero perezoso: produce los candidatos día por día,
+    ya ordenados, para poder cortar la búsqueda apenas se encuentra lo necesario.
+
+    Cada disponibilidad se interpreta en la hora de pared de su ubicación
+    (atributo `ubicacion_tz`, ver cargar_disponibilidades).
+    """
+    current_date = start_date
+    un_dia = datetime.timedelta(days=1)
+
+    while current_date <= end_date:
+        del_dia = []
+        for disp in disponibilidades_por_dia.get(current_date.weekday(), ()):
+            tz = zona_horaria(getattr(disp, 'ubicacion_tz', None))
+            start_dt = timezone.make_aware(datetime.datetime.combine(current_date, disp.hora_inicio), tz)
+            end_dt = timezone.make_aware(datetime.datetime.combine(current_date, disp.hora_fin), tz)
+            del_dia.extend(cortar_ventana(start_dt, end_dt, config))
+        del_dia.sort()
+        yield from del_dia
+        current_date += un_dia
+
+
+def generar_candidatos(disponibilidades_por_dia, start_date, end_date, config):
+    """Slots potenciales de todas las disponibilidades del rango (ver cortar_ventana)."""
+    return list(iterar_candidatos(disponibilidades_por_dia, start_date, end_date, config))
+
+
+def en_ventana(candidatos, desde, hasta):
+    """Candidatos cuyo inicio (visible para el paciente) cae dentro de [desde, hasta]."""
+    return [candidato for candidato in candidatos if desde <= candidato[2] <= hasta]
+
+
+def rango_de_candidatos(candidatos):
+    """
+    Rango [inicio, fin) a cargar de ocupados: lo que cubren los candidatos con
+    sus buffers (los de los turnos ya vienen en su busy_range).
+    """
+    return (
+        min(candidato[0] for candidato in candidatos),
+        max(candidato[1] for candidato in candidatos),
+    )
+
+
+def fusionar_intervalos(intervalos):
+    """Ordena y fusiona intervalos [a, b) que se solapan o se tocan."""
+    fusionados = []
+    for inicio, fin in sorted(intervalos):
+        if fusionados and inicio <= fusionados[-1][1]:
+            if fin > fusionados[-1][1]:
+                fusionados[-1][1] = fin
+        else:
+            fusionados.append([inicio, fin])
+    return fusionados
+
+
+def barrer_libres(candidatos, ocupados):
+    """
+    Recorre candidatos y ocupados (ambos ordenados por inicio) en una sola pasada
+    y produce los candidatos cuyo rango total no toca ningún intervalo ocupado.
+
+    `ocupados` debe venir fusionado (disjunto), así el puntero solo avanza.
+    Es un generador: si se deja de consumir, el barrido se detiene ahí.
+    """
+    j = 0
+    n = len(ocupados)
+    for candidato in candidatos:
+        total_inicio, total_fin = candidato[0], candidato[1]
+        # Descartar ocupados que terminan antes de que empiece el candidato
+        while j < n and ocupados[j][1] <= total_inicio:
+            j += 1
+        if j < n and ocupados[j][0] < total_fin:
+            continue
+        yield candidato
+
+
+def filtrar_libres(candidatos, ocupados, now, incluir_pasados=False):
+    """
+    Ordena candidatos, los barre contra los ocupados (fusionados) y devuelve
+    [{'inicio', 'fin'}] sin inicios repetidos.
+    """
+    candidatos.sort()
+    final_slots = []
+    ultimo_inicio = None
+    for _, _, inicio, fin in barrer_libres(candidatos, ocupados):
+        if inicio == ultimo_inicio or (inicio < now and not incluir_pasados):
+            continue
+        final_slots.append({'inicio': inicio, 'fin': fin})
+        ultimo_inicio = inicio
+
+    return final_slots
+
+
+def slots_disponibles(nutricionista, start_date, end_date, duracion_minutos=None,
+                      ubicacion_id=None, tipo_consulta_id=None, now=None, incluir_pasados=False,
+                      materializado=False):
+    """
+    Implementación del motor detrás de utils.calculate_available_slots.
+
+    Retorna [{'inicio': datetime, 'fin': datetime}] ordenado y sin inicios repetidos.
+    Siempre cuesta el mismo número de consultas (settings, tipos, disponibilidades,
+    bloqueos y turnos), sin importar cuántos turnos haya en el rango. Si el rango
+    queda fuera de la ventana de reserva (anticipación mínima/máxima) cuesta solo
+    la consulta de settings.
+
+    Con incluir_pasados=True no aplica la ventana de reserva (ni descarta los slots
+    que ya empezaron); lo usa la caché de snapshots, que la aplica al momento de leer.
+
+    Con materializado=True (y una ubicación concreta) lee el free/busy precalculado
+    de DisponibilidadDia en lugar de derivarlo de disponibilidades, bloqueos y turnos.
+    """
+    now = now or timezone.now()
+
+    resolutor = ResolutorBuffers(nutricionista)
+    ventana = None
+    if not incluir_pasados:
+        ventana = resolutor.ventana_de_reserva(now)
+        start_date, end_date = acotar_fechas(start_date, end_date, *ventana)
+        if start_date > end_date:
+            return []
+    config = resolutor.configuracion(duracion_minutos, tipo_consulta_id)
+
+    if materializado and ubicacion_id:
+        from .materializado import slots_materializados
+        return slots_materializados(
+            nutricionista, start_date, end_date, int(ubicacion_id), config, now, incluir_pasados, ventana
+        )
+
+    disponibilidades_por_dia = cargar_disponibilidades(nutricionista, ubicacion_id)
+    candidatos = generar_candidatos(disponibilidades_por_dia, start_date, end_date, config)
+    if ventana:
+        candidatos = en_ventana(candidatos, *ventana)
+    if not candidatos:
+        return []
+
+    rango_inicio, rango_fin = rango_de_candidatos(candidatos)
+    ocupados = fusionar_intervalos(
+        cargar_ocupados(nutricionista, rango_inicio, rango_fin, ubicacion_id, now)
+    )
+
+    return filtrar_libres(candidatos, ocupados, now, incluir_pasados)
+
+
+def slots_por_combinacion(nutricionista, start_date, end_date, now=None):
+    """
+    Slots de cada combinación ubicación × tipo de consulta del profesional, para
+    la vista de agenda. Equivale a llamar a slots_disponibles con cada par
+    (ubicacion_id, tipo_consulta_id), pero compartiendo una sola carga de
+    settings, tipos, disponibilidades, bloqueos y turnos (cinco consultas en total).
+
+    Retorna {ubicacion_id: {tipo_consulta_id: [{'inicio', 'fin'}]}}; solo aparecen
+    las ubicaciones con horario de atención.
+    """
+    now = now or timezone.now()
+
+    resolutor = ResolutorBuffers(nutricionista)
+    ventana = resolutor.ventana_de_reserva(now)
+    start_date, end_date = acotar_fechas(start_date, end_date, *ventana)
+    if start_date > end_date:
+        return {}
+
+    tipos = list(resolutor.tipos)
+    por_ubicacion = {}
+    for dia_semana, disponibilidades in cargar_disponibilidades(nutricionista).items():
+        for disp in disponibilidades:
+            por_ubicacion.setdefault(disp.ubicacion_id, {}).setdefault(dia_semana, []).append(disp)
+
+    candidatos = {}
+    for ubicacion_id, disponibilidades_por_dia in por_ubicacion.items():
+        for tipo_id in tipos:
+            config = resolutor.configuracion(tipo_consulta_id=tipo_id)
+            candidatos[(ubicacion_id, tipo_id)] = en_ventana(
+                generar_candidatos(disponibilidades_por_dia, start_date, end_date, config), *ventana
+            )
+
+    resultado = {ubicacion_id: {tipo_id: [] for tipo_id in tipos} for ubicacion_id in por_ubicacion}
+    todos = [candidato for lista in candidatos.values() for candidato in lista]
+    if not todos:
+        return resultado
+
+    rango_inicio, rango_fin = rango_de_candidatos(todos)
+    ocupados = {
+        ubicacion_id: fusionar_intervalos(intervalos)
+        for ubicacion_id, intervalos in cargar_ocupados_por_ubicacion(
+            nutricionista, rango_inicio, rango_fin, now
+        ).items()
+    }
+    for (ubicacion_id, tipo_id), lista in candidatos.items():
+        if lista:
+            resultado[ubicacion_id][tipo_id] = filtrar_libres(lista, ocupados.get(ubicacion_id, []), now)
+    return resultado
+
+
+def iterar_slots(nutricionista, start_date, end_date=None, duracion_minutos=None,
+                 ubicacion_id=None, tipo_consulta_id=None, limit=None, now=None):
+    """
+    Versión perezosa de slots_disponibles: produce los slots en orden cronológico,
+    día por día y sin inicios repetidos, y deja de trabajar cuando se deja de
+    consumir o se alcanza `limit`.
+
+    Los ocupados no se cargan todos de entrada sino por bloques de días que crecen
+    (1, 2, 4, ... hasta DIAS_POR_BLOQUE_MAX), así buscar "el próximo turno libre"
+    suele costar una sola ronda de bloqueos + turnos aunque el horizonte sea largo.
+    Los bloques sin disponibilidades no consultan nada. Si las ubicaciones están
+    en zonas horarias distintas, sus días locales no empiezan a la vez: cada zona
+    se recorre por su lado y los slots se intercalan por instante.
+
+    Sin end_date busca hasta la anticipación máxima del profesional.
+    """
+    now = now or timezone.now()
+
+    resolutor = ResolutorBuffers(nutricionista)
+    ventana = resolutor.ventana_de_reserva(now)
+    start_date, end_date = acotar_fechas(start_date, end_date, *ventana)
+    if start_date > end_date or (limit is not None and limit <= 0):
+        return
+
+    config = resolutor.configuracion(duracion_minutos, tipo_consulta_id)
+    disponibilidades_por_dia = cargar_disponibilidades(nutricionista, ubicacion_id)
+    if not disponibilidades_por_dia:
+        return
+
+    flujos = [
+        _iterar_por_bloques(nutricionista, por_dia, start_date, end_date, config, ventana, ubicacion_id, now)
+        for por_dia in _por_zona_horaria(disponibilidades_por_dia)
+    ]
+    slots = flujos[0] if len(flujos) == 1 else heapq.merge(*flujos, key=lambda slot: slot['inicio'])
+
+    entregados = 0
+    ultimo_inicio = None
+    for slot in slots:
+        if slot['inicio'] == ultimo_inicio:
+            continue
+        ultimo_inicio = slot['inicio']
+        yield slot
+        entregados += 1
+        if limit is not None and entregados >= limit:
+            return
+
+
+def _por_zona_horaria(disponibilidades_por_dia):
+    """Separa las disponibilidades por día de la semana según la zona horaria de su ubicación."""
+    por_zona = {}
+    for dia, disponibilidades in disponibilidades_por_dia.items():
+        for disp in disponibilidades:
+            por_zona.setdefault(disp.ubicacion_tz, {}).setdefault(dia, []).append(disp)
+    return list(por_zona.values())
+
+
+def _iterar_por_bloques(nutricionista, disponibilidades_por_dia, start_date, end_date, config, ventana,
+                        ubicacion_id, now):
+    """Slots libres (en orden, dentro de una misma zona horaria) recorriendo bloques de días que crecen."""
+    dias_por_bloque = 1
+    bloque_inicio = start_date
+    while bloque_inicio <= end_date:
+        bloque_fin = min(bloque_inicio + datetime.timedelta(days=dias_por_bloque - 1), end_date)
+        candidatos = en_ventana(
+            generar_candidatos(disponibilidades_por_dia, bloque_inicio, bloque_fin, config), *ventana
+        )
+
+        if candidatos:
+            # Por busy_range: un turno justo fuera del bloque puede invadirlo con sus buffers
+            rango_inicio, rango_fin = rango_de_candidatos(candidatos)
+            ocupados = fusionar_intervalos(cargar_ocupados(
+                nutricionista, rango_inicio, rango_fin, ubicacion_id, now,
+            ))
+            candidatos.sort()
+            for _, _, inicio, fin in barrer_libres(candidatos, ocupados):
+                if inicio >= now:
+                    yield {'inicio': inicio, 'fin': fin}
+
+        bloque_inicio = bloque_fin + datetime.timedelta(days=1)
+        dias_por_bloque = min(dias_por_bloque * 2, DIAS_POR_BLOQUE_MAX)
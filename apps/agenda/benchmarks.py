@@ -0,0 +1,410 @@
+# apps/agenda/benchmarks.py
+"""
+Micro-benchmarks del motor de slots con agendas sintéticas.
+
+Genera un profesional ficticio (sedes, horarios, tipos de consulta, bloqueos y
+turnos) según un perfil configurable, corre los escenarios más usados del
+turnero sobre ventanas de 7/31/60 días y mide tiempo de pared, cantidad de
+consultas y memoria asignada. El resultado es un dict listo para volcar como
+JSON, así las regresiones del motor se ven como números.
+
+También compara los dos caminos de listado de mis-turnos (serializer completo
+y proyección del calendario) sobre historiales de 1k y 10k turnos.
+
+Todo corre dentro de una transacción que se revierte al final: no deja datos.
+Se usa desde los comandos `python manage.py benchmark_slots` y
+`python manage.py benchmark_listados`.
+"""
+import datetime
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.db import connection, transaction
+from django.utils import timezone
+from psycopg.types.range import Range
+
+from apps.user.models import UserAccount, Nutricionista, Paciente, TipoConsulta
+from .models import (
+    Ubicacion,
+    ProfessionalSettings,
+    TipoConsultaConfig,
+    DisponibilidadHoraria,
+    BloqueoDisponibilidad,
+    Turno,
+    TurnoState,
+)
+from .listados import proyectar_calendario, turnos_de_agenda
+from .serializers import TurnoAgendaSerializer
+from .utils import calculate_available_slots, iter_available_slots
+
+
+# Profesional muy ocupado: 8 h por día hábil repartidas en 3 sedes y 40 turnos por semana
+PERFIL_POR_DEFECTO = {
+    'sedes': 3,
+    'dias_habiles': 5,
+    'horas_por_dia': 8,
+    'turnos_por_semana': 40,
+    'bloqueos_por_semana': 2,
+    'holds_por_semana': 3,
+}
+
+VENTANAS_POR_DEFECTO = (7, 31, 60)
+
+# Turnos y bloqueos se ubican sobre una grilla de 15 min, dejando una celda libre
+# después de cada uno (alcanza para los buffers: nunca se pisan entre sí)
+GRILLA = datetime.timedelta(minutes=15)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Agenda sintética
+# ────────────────────────────────────────────────────────────────────────────────
+
+def _ventanas_del_dia(dia_semana, perfil):
+    """
+    Horario de un día hábil: las horas se parten en mañana y tarde (desde las 8 y
+    las 13) y cada bloque va a una sede distinta, rotando según el día.
+    """
+    manana = perfil['horas_por_dia'] // 2
+    tarde = perfil['horas_por_dia'] - manana
+    bloques = [(datetime.time(8, 0), manana), (datetime.time(13, 0), tarde)]
+    ventanas = []
+    for orden, (inicio, horas) in enumerate(bloques):
+        if horas <= 0:
+            continue
+        fin = (datetime.datetime.combine(datetime.date.min, inicio) + datetime.timedelta(hours=horas)).time()
+        ventanas.append(((dia_semana * 2 + orden) % perfil['sedes'], inicio, fin))
+    return ventanas
+
+
+def crear_agenda_sintetica(perfil, desde, dias, seed=0):
+    """
+    Crea el profesional del perfil con turnos, bloqueos y holds repartidos al azar
+    (reproducible con `seed`) entre `desde` y `desde + dias`. Usa bulk_create, así
+    que no dispara señales: la caché y el free/busy materializado no se enteran.
+    """
+    rng = random.Random(seed)
+    tz = timezone.get_current_timezone()
+    sufijo = f"{seed}{time.time_ns()}"[-12:]
+
+    user = UserAccount.objects.create_user(
+        dni=f"9{sufijo[-7:]}", email=f"benchmark{sufijo}@example.com", password=None
+    )
+    nutri = Nutricionista.objects.create(user=user, nombre="Benchmark", apellido=sufijo)
+    ProfessionalSettings.objects.create(
+        nutricionista=nutri,
+        buffer_before_min=5,
+        buffer_after_min=5,
+        anticipacion_minima=datetime.timedelta(0),
+        anticipacion_maxima=datetime.timedelta(days=dias + 30),
+    )
+    tipos = [
+        TipoConsultaConfig.objects.create(
+            nutricionista=nutri, tipo=TipoConsulta.INICIAL, duracion_min=60, buffer_before_min=5, buffer_after_min=5
+        ),
+        TipoConsultaConfig.objects.create(
+            nutricionista=nutri, tipo=TipoConsulta.SEGUIMIENTO, duracion_min=30, buffer_before_min=5, buffer_after_min=5
+        ),
+    ]
+    sedes = Ubicacion.objects.bulk_create([
+        Ubicacion(nutricionista=nutri, nombre=f"Sede {i + 1}") for i in range(perfil['sedes'])
+    ])
+
+    disponibilidades = []
+    for dia_semana in range(perfil['dias_habiles']):
+        for sede, hora_inicio, hora_fin in _ventanas_del_dia(dia_semana, perfil):
+            disponibilidades.append(DisponibilidadHoraria(
+                nutricionista=nutri, ubicacion=sedes[sede], dia_semana=dia_semana,
+                hora_inicio=hora_inicio, hora_fin=hora_fin,
+            ))
+    DisponibilidadHoraria.objects.bulk_create(disponibilidades)
+
+    # Celdas de la grilla de cada ventana del rango: (sede, inicio, fin de la ventana)
+    celdas = []
+    for offset in range(dias):
+        fecha = desde + datetime.timedelta(days=offset)
+        if fecha.weekday() >= perfil['dias_habiles']:
+            continue
+        for sede, hora_inicio, hora_fin in _ventanas_del_dia(fecha.weekday(), perfil):
+            inicio = timezone.make_aware(datetime.datetime.combine(fecha, hora_inicio), tz)
+            fin = timezone.make_aware(datetime.datetime.combine(fecha, hora_fin), tz)
+            while inicio < fin:
+                celdas.append((sedes[sede], inicio, fin))
+                inicio += GRILLA
+    rng.shuffle(celdas)
+    ocupadas = set()
+
+    def ubicar(cantidad, duraciones):
+        """Hasta `cantidad` intervalos (sede, inicio, fin) sin solaparse, en celdas al azar."""
+        ubicados = []
+        for sede, inicio, fin_ventana in celdas:
+            if len(ubicados) >= cantidad:
+                break
+            duracion = duraciones()
+            fin = inicio + duracion
+            necesarias = [(sede.id, inicio + GRILLA * k) for k in range(int(duracion / GRILLA) + 1)]
+            if fin > fin_ventana or any(celda in ocupadas for celda in necesarias):
+                continue
+            ocupadas.update(necesarias)
+            ubicados.append((sede, inicio, fin))
+        return ubicados
+
+    semanas = max(dias / 7, 1)
+    bloqueos = [
+        BloqueoDisponibilidad(nutricionista=nutri, ubicacion=sede, start_time=inicio, end_time=fin, motivo="benchmark")
+        for sede, inicio, fin in ubicar(
+            int(perfil['bloqueos_por_semana'] * semanas), lambda: datetime.timedelta(hours=1)
+        )
+    ]
+    BloqueoDisponibilidad.objects.bulk_create(bloqueos)
+
+    # Una inicial cada tres seguimientos
+    tipo_por_duracion = {datetime.timedelta(minutes=tipo.duracion_min): tipo for tipo in tipos}
+    duracion_al_azar = lambda: rng.choices(list(tipo_por_duracion), weights=[1, 3])[0]
+    n_holds = int(perfil['holds_por_semana'] * semanas)
+    ubicados = ubicar(int((perfil['turnos_por_semana'] + perfil['holds_por_semana']) * semanas), duracion_al_azar)
+
+    now = timezone.now()
+    turnos = []
+    for indice, (sede, inicio, fin) in enumerate(ubicados):
+        es_hold = indice < n_holds
+        turnos.append(Turno(
+            nutricionista=nutri,
+            ubicacion=sede,
+            tipo_consulta=tipo_por_duracion[fin - inicio],
+            start_time=inicio,
+            end_time=fin,
+            slot=Range(inicio, fin, bounds='[)'),
+            busy_range=Turno.calcular_busy_range(inicio, fin, tipo_por_duracion[fin - inicio]),
+            state=TurnoState.TENTATIVO if es_hold else TurnoState.RESERVADO,
+            soft_hold_expires_at=now + datetime.timedelta(minutes=15) if es_hold else None,
+        ))
+    Turno.objects.bulk_create(turnos)
+
+    return {
+        'nutricionista': nutri,
+        'ubicacion': sedes[0],
+        'tipo': tipos[1],  # seguimiento: el turno más pedido
+        'turnos': len(turnos),
+        'bloqueos': len(bloqueos),
+        'disponibilidades': len(disponibilidades),
+    }
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Escenarios y medición
+# ────────────────────────────────────────────────────────────────────────────────
+
+def _todas_las_ubicaciones(agenda, desde, hasta):
+    return calculate_available_slots(agenda['nutricionista'], desde, hasta)
+
+
+def _ubicacion_y_tipo(agenda, desde, hasta):
+    return calculate_available_slots(
+        agenda['nutricionista'], desde, hasta,
+        ubicacion_id=agenda['ubicacion'].id, tipo_consulta_id=agenda['tipo'].id,
+    )
+
+
+def _materializado(agenda, desde, hasta):
+    return calculate_available_slots(
+        agenda['nutricionista'], desde, hasta,
+        ubicacion_id=agenda['ubicacion'].id, tipo_consulta_id=agenda['tipo'].id, materializado=True,
+    )
+
+
+def _proximo_libre(agenda, desde, hasta):
+    return list(iter_available_slots(
+        agenda['nutricionista'], desde, hasta,
+        ubicacion_id=agenda['ubicacion'].id, tipo_consulta_id=agenda['tipo'].id, limit=1,
+    ))
+
+
+ESCENARIOS = {
+    'todas_las_ubicaciones': _todas_las_ubicaciones,
+    'ubicacion_y_tipo': _ubicacion_y_tipo,
+    'materializado': _materializado,
+    'proximo_libre': _proximo_libre,
+}
+
+
+def medir(funcion, repeticiones, unidad='slots'):
+    """
+    Corre `funcion` `repeticiones` veces. Los tiempos se toman sin tracemalloc
+    (que distorsiona); consultas y memoria salen de una corrida extra, la última,
+    así los escenarios con caché o materialización se miden ya en caliente.
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+
+    # Contador propio: connection.queries se corta en 9000 consultas
+    consultas = 0
+
+    def contar(execute, sql, params, many, context):
+        nonlocal consultas
+        consultas += 1
+        return execute(sql, params, many, context)
+
+    tracemalloc.start()
+    try:
+        antes = tracemalloc.take_snapshot()
+        with connection.execute_wrapper(contar):
+            resultado = funcion()
+        despues = tracemalloc.take_snapshot()
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    diferencias = despues.compare_to(antes, 'filename')
+    return {
+        unidad: len(resultado),
+        'consultas': consultas,
+        'tiempo_ms': {
+            'min': round(min(tiempos), 3),
+            'mediana': round(statistics.median(tiempos), 3),
+            'max': round(max(tiempos), 3),
+        },
+        'memoria_pico_kb': round(pico / 1024, 1),
+        'bloques_retenidos': sum(max(d.count_diff, 0) for d in diferencias),
+    }
+
+
+def correr_benchmark(perfil=None, ventanas=VENTANAS_POR_DEFECTO, repeticiones=5, escenarios=None, seed=0):
+    """
+    Arma la agenda sintética, mide cada escenario en cada ventana y revierte todo.
+    Retorna el reporte como dict serializable a JSON.
+    """
+    perfil = {**PERFIL_POR_DEFECTO, **(perfil or {})}
+    escenarios = escenarios or list(ESCENARIOS)
+    desde = timezone.localdate() + datetime.timedelta(days=1)
+
+    reporte = {
+        'generado_en': timezone.now().isoformat(),
+        'perfil': perfil,
+        'seed': seed,
+        'repeticiones': repeticiones,
+        'resultados': [],
+    }
+
+    with transaction.atomic():
+        agenda = crear_agenda_sintetica(perfil, desde, max(ventanas), seed)
+        reporte['agenda'] = {
+            clave: agenda[clave] for clave in ('turnos', 'bloqueos', 'disponibilidades')
+        }
+        for dias in ventanas:
+            hasta = desde + datetime.timedelta(days=dias - 1)
+            for nombre in escenarios:
+                escenario = ESCENARIOS[nombre]
+                resultado = medir(lambda: escenario(agenda, desde, hasta), repeticiones)
+                reporte['resultados'].append({'escenario': nombre, 'dias': dias, **resultado})
+        transaction.set_rollback(True)
+
+    return reporte
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Listados de mis-turnos
+# ────────────────────────────────────────────────────────────────────────────────
+
+CANTIDADES_LISTADO_POR_DEFECTO = (1000, 10000)
+
+# Un turno de 30 min cada 45 (los buffers de 5 no se pisan), de 8 a 18 todos los días
+PASO_LISTADO = datetime.timedelta(minutes=45)
+TURNOS_POR_DIA_LISTADO = 13
+
+
+def crear_historial_sintetico(cantidad, seed=0):
+    """
+    Profesional con `cantidad` turnos consecutivos (hacia atrás desde hoy), la
+    mitad de pacientes registrados y la mitad públicos con intake_answers.
+    """
+    rng = random.Random(seed)
+    tz = timezone.get_current_timezone()
+    sufijo = f"{seed}{time.time_ns()}"[-12:]
+
+    user = UserAccount.objects.create_user(
+        dni=f"8{sufijo[-7:]}", email=f"listado{sufijo}@example.com", password=None
+    )
+    nutri = Nutricionista.objects.create(user=user, nombre="Listado", apellido=sufijo)
+    tipos = [
+        TipoConsultaConfig.objects.create(
+            nutricionista=nutri, tipo=tipo, duracion_min=30, buffer_before_min=5, buffer_after_min=5
+        )
+        for tipo in (TipoConsulta.INICIAL, TipoConsulta.SEGUIMIENTO)
+    ]
+    sede = Ubicacion.objects.create(nutricionista=nutri, nombre="Sede Listado")
+    pacientes = [
+        Paciente.objects.create(
+            user=UserAccount.objects.create_user(
+                dni=f"7{sufijo[-5:]}{i:02d}", email=f"paciente{i}.{sufijo}@example.com", password=None
+            ),
+            nombre=f"Paciente{i}", apellido="Sintético", genero="O",
+        )
+        for i in range(20)
+    ]
+
+    primer_dia = timezone.localdate() - datetime.timedelta(days=cantidad // TURNOS_POR_DIA_LISTADO + 1)
+    turnos = []
+    for indice in range(cantidad):
+        dia, orden = divmod(indice, TURNOS_POR_DIA_LISTADO)
+        inicio = timezone.make_aware(
+            datetime.datetime.combine(primer_dia + datetime.timedelta(days=dia), datetime.time(8, 0)), tz
+        ) + PASO_LISTADO * orden
+        fin = inicio + datetime.timedelta(minutes=30)
+        tipo = rng.choice(tipos)
+        publico = indice % 2 == 1
+        turnos.append(Turno(
+            nutricionista=nutri,
+            paciente=None if publico else rng.choice(pacientes),
+            ubicacion=sede,
+            tipo_consulta=tipo,
+            start_time=inicio,
+            end_time=fin,
+            slot=Range(inicio, fin, bounds='[)'),
+            busy_range=Turno.calcular_busy_range(inicio, fin, tipo),
+            state=TurnoState.ATENDIDO,
+            intake_answers={
+                'nombre_completo': f"Público {indice}", 'email': f"publico{indice}@example.com",
+            } if publico else None,
+        ))
+    Turno.objects.bulk_create(turnos, batch_size=2000)
+    return nutri
+
+
+def _listado_serializer(nutri):
+    return TurnoAgendaSerializer(turnos_de_agenda(nutri).order_by('start_time', 'id'), many=True).data
+
+
+def _listado_proyeccion(nutri):
+    return list(proyectar_calendario(Turno.objects.filter(nutricionista=nutri)).order_by('start_time', 'id'))
+
+
+ESCENARIOS_LISTADO = {
+    'serializer': _listado_serializer,
+    'proyeccion': _listado_proyeccion,
+}
+
+
+def correr_benchmark_listados(cantidades=CANTIDADES_LISTADO_POR_DEFECTO, repeticiones=3, seed=0):
+    """
+    Mide los dos caminos de listado con historiales de cada tamaño de
+    `cantidades` (el rango completo en una sola respuesta) y revierte todo.
+    """
+    reporte = {
+        'generado_en': timezone.now().isoformat(),
+        'seed': seed,
+        'repeticiones': repeticiones,
+        'resultados': [],
+    }
+    with transaction.atomic():
+        for cantidad in cantidades:
+            nutri = crear_historial_sintetico(cantidad, seed)
+            for nombre, escenario in ESCENARIOS_LISTADO.items():
+                resultado = medir(lambda: escenario(nutri), repeticiones, unidad='filas')
+                reporte['resultados'].append({'escenario': nombre, 'turnos': cantidad, **resultado})
+        transaction.set_rollback(True)
+    return reporte
@@ -0,0 +1,587 @@
+# apps/agenda/booking.py
+"""
+Alta y confirmación de turnos contra la restricción de solapes de la base.
+
+El chequeo de solapes no se hace en Python: cada turno guarda su `busy_range`
+(slot más buffers) y la ExclusionConstraint `Turno.RESTRICCION_SOLAPE` rechaza
+cualquier INSERT/UPDATE que pise a otro turno activo de la misma ubicación.
+Así el chequeo y la escritura son una sola operación atómica, sin ventana de
+carrera entre "verificar" y "guardar".
+
+La restricción no puede depender de now(): un hold vencido sigue contando hasta
+que alguien lo cancela. Por eso, antes de escribir, se liberan los holds
+vencidos que se cruzan con el rango pedido.
+
+Las reservas de una misma agenda (nutricionista + ubicación) se serializan con
+un advisory lock de PostgreSQL a nivel transacción (`agenda_bloqueada`): validar
+y escribir corre sin competencia, y quien no consigue el lock a tiempo recibe
+AgendaOcupada en lugar de quedar esperando detrás de una fila de requests.
+
+Qué horarios se pueden reservar lo decide un único VerificadorDisponibilidad,
+compartido por todos los caminos de reserva (privado, público, aprobación y
+series recurrentes).
+"""
+import datetime
+from contextlib import ExitStack, contextmanager
+
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import DateField, DateTimeField, Exists, F, Func, IntegerField, OuterRef, TimeField
+from django.db.models.functions import Cast
+from django.utils import timezone
+from psycopg.types.range import Range
+
+from . import metrics
+from .availability import ResolutorBuffers, turnos_activos, zona_horaria
+from .models import (
+    BloqueoDisponibilidad,
+    DisponibilidadHoraria,
+    ProfessionalSettings,
+    TRANSICIONES_TURNO,
+    Turno,
+    TurnoState,
+    Ubicacion,
+)
+
+
+# Espera máxima por el lock de una agenda antes de rendirse
+ESPERA_LOCK_MS = 2000
+
+# SQLSTATE lock_not_available: venció el lock_timeout
+LOCK_NO_DISPONIBLE = '55P03'
+
+# Filas por UPDATE al cancelar holds vencidos en la tarea periódica
+LOTE_HOLDS_VENCIDOS = 500
+
+# Tope de ocurrencias de una serie de turnos (un año de seguimientos semanales)
+MAX_OCURRENCIAS_SERIE = 52
+
+# Tope de turnos por aprobación/cancelación en lote
+MAX_TURNOS_POR_LOTE = 100
+
+MENSAJES_NO_RESERVABLE = {
+    'ubicacion': "La ubicación no pertenece al nutricionista seleccionado.",
+    'fuera_de_horario': "El horario seleccionado no está dentro de la disponibilidad del nutricionista.",
+    'bloqueado': "El horario seleccionado no está disponible (bloqueado).",
+    'ocupado': (
+        "El horario seleccionado no está disponible (incluyendo tiempos de preparación). "
+        "Por favor, seleccione otro horario."
+    ),
+    'serie': "El horario se pisa con otra ocurrencia de la misma serie.",
+    'lote': "El horario se pisa con otro turno del mismo lote.",
+    'estado': "El estado del turno no admite el cambio pedido.",
+    'no_encontrado': "El turno no existe o no pertenece al nutricionista.",
+}
+
+
+class ConflictoDeHorario(Exception):
+    """El turno se pisa (buffers incluidos) con otro turno activo."""
+
+
+class AgendaOcupada(Exception):
+    """Otra reserva sobre la misma agenda tiene el lock y no lo soltó a tiempo."""
+
+
+@contextmanager
+def agenda_bloqueada(nutricionista_id, ubicacion_id, espera_ms=ESPERA_LOCK_MS):
+    """
+    Toma el advisory lock de la agenda (nutricionista, ubicación) hasta el fin de
+    la transacción en curso: dos reservas sobre la misma agenda no validan ni
+    insertan a la vez. Si no lo consigue en `espera_ms` lanza AgendaOcupada.
+
+    El lock_timeout se fija dentro de un savepoint y se restaura apenas se obtiene
+    el lock, así no afecta al resto de la transacción (ATOMIC_REQUESTS).
+    """
+    with transaction.atomic():
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting('lock_timeout')")
+                anterior = cursor.fetchone()[0]
+                cursor.execute("SELECT set_config('lock_timeout', %s, true)", [f'{int(espera_ms)}ms'])
+                cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [nutricionista_id, ubicacion_id])
+                cursor.execute("SELECT set_config('lock_timeout', %s, true)", [anterior])
+        except OperationalError as e:
+            if getattr(e.__cause__, 'sqlstate', None) == LOCK_NO_DISPONIBLE:
+                raise AgendaOcupada(f"agenda {nutricionista_id}/{ubicacion_id}") from e
+            raise
+        yield
+
+
+def liberar_holds_vencidos(nutricionista_id, ubicacion_id, busy_range, now=None):
+    """
+    Cancela los holds TENTATIVO vencidos que se cruzan con `busy_range`, para que
+    no bloqueen la restricción de solapes. Retorna cuántos se cancelaron.
+    """
+    now = now or timezone.now()
+    vencidos = Turno.objects.filter(
+        nutricionista_id=nutricionista_id,
+        ubicacion_id=ubicacion_id,
+        state=TurnoState.TENTATIVO,
+        soft_hold_expires_at__lte=now,
+        busy_range__overlap=busy_range,
+    )
+    cancelados = vencidos.update(state=TurnoState.CANCELADO, updated_at=now)
+    if cancelados:
+        # update() no dispara señales: avisar a caché y materializado a mano
+        from .signals import agenda_modificada, dias_modificados
+        agenda_modificada(nutricionista_id)
+        dias_modificados(nutricionista_id, ubicacion_id, intervalos=[(busy_range.lower, busy_range.upper)])
+        metrics.incrementar('holds_vencidos_cancelados', cancelados, origen='reserva')
+    return cancelados
+
+
+def cancelar_holds_vencidos(now=None, lote=LOTE_HOLDS_VENCIDOS):
+    """
+    Pasa a CANCELADO todos los holds TENTATIVO vencidos, en UPDATEs de a `lote`
+    filas (cada uno en su transacción, recorriendo turno_hold_vencimiento_idx),
+    así no se retienen locks sobre miles de filas. Lo corre la tarea periódica
+    de Celery; retorna (cancelados, lotes).
+    """
+    from .signals import turnos_modificados
+
+    now = now or timezone.now()
+    cancelados = lotes = 0
+    while True:
+        with transaction.atomic():
+            filas = list(
+                Turno.objects.filter(
+                    state=TurnoState.TENTATIVO,
+                    soft_hold_expires_at__isnull=False,
+                    soft_hold_expires_at__lte=now,
+                ).order_by('soft_hold_expires_at').select_for_update(skip_locked=True).values_list(
+                    'id', 'nutricionista_id', 'ubicacion_id', 'busy_range'
+                )[:lote]
+            )
+            if not filas:
+                break
+            Turno.objects.filter(pk__in=[fila[0] for fila in filas]).update(
+                state=TurnoState.CANCELADO, updated_at=now
+            )
+
+            # update() no dispara señales: un aviso por agenda afectada y rango de días
+            turnos_modificados([fila[1:] for fila in filas])
+
+        cancelados += len(filas)
+        lotes += 1
+        if len(filas) < lote:
+            break
+
+    if cancelados:
+        metrics.incrementar('holds_vencidos_cancelados', cancelados, origen='periodico')
+    metrics.observar('holds_vencidos_lotes', lotes)
+    return cancelados, lotes
+
+
+class HorarioNoReservable(Exception):
+    """
+    El horario pedido no se puede reservar. `motivo` es un código estable (ver
+    MENSAJES_NO_RESERVABLE, más fuera_de_ventana) y el mensaje está listo para
+    mostrar al usuario.
+    """
+    def __init__(self, motivo, mensaje=None):
+        super().__init__(mensaje or MENSAJES_NO_RESERVABLE[motivo])
+        self.motivo = motivo
+
+
+class _HoraLocal(Func):
+    """`instante AT TIME ZONE zona`: hora de pared (sin zona) en la zona dada."""
+    template = '(%(expressions)s)'
+    arg_joiner = ' AT TIME ZONE '
+    output_field = DateTimeField()
+
+
+class _DiaSemanaLocal(Func):
+    """Día de la semana de una hora de pared, con la convención de Python (lunes = 0)."""
+    template = '(EXTRACT(ISODOW FROM %(expressions)s)::integer - 1)'
+    output_field = IntegerField()
+
+
+class VerificadorDisponibilidad:
+    """
+    Responde si [inicio, fin) se puede reservar para un profesional, ubicación y
+    tipo de consulta, con las mismas reglas con que el motor ofrece slots:
+
+    - El inicio cae dentro de la ventana de reserva (anticipación mínima/máxima).
+    - El rango con buffers entra en una DisponibilidadHoraria de la ubicación,
+      leída en la hora de pared de esa ubicación.
+    - El rango con buffers no toca bloqueos ni el busy_range de turnos activos.
+
+    La configuración del profesional (settings y zonas horarias de sus
+    ubicaciones) se carga una vez por verificador; cada verificación es después
+    una sola consulta con tres EXISTS. Las vistas usan un verificador por request
+    (ver del_request), así todas las reservas cuestan lo mismo.
+    """
+    ATRIBUTO_REQUEST = '_verificador_disponibilidad'
+
+    def __init__(self):
+        self._agendas = {}
+
+    @classmethod
+    def del_request(cls, request):
+        """Verificador memoizado en el request: la configuración se carga una sola vez."""
+        verificador = getattr(request, cls.ATRIBUTO_REQUEST, None)
+        if verificador is None:
+            verificador = cls()
+            setattr(request, cls.ATRIBUTO_REQUEST, verificador)
+        return verificador
+
+    def agenda(self, nutricionista_id):
+        """(ResolutorBuffers, {ubicacion_id: zona horaria}) del profesional (2 consultas, una vez)."""
+        if nutricionista_id not in self._agendas:
+            settings = ProfessionalSettings.objects.filter(nutricionista_id=nutricionista_id).first()
+            zonas = {
+                ubicacion_id: zona_horaria(nombre)
+                for ubicacion_id, nombre in Ubicacion.objects.filter(
+                    nutricionista_id=nutricionista_id
+                ).values_list('id', 'timezone')
+            }
+            self._agendas[nutricionista_id] = (ResolutorBuffers.precargado(settings, []), zonas)
+        return self._agendas[nutricionista_id]
+
+    def verificar(self, nutricionista_id, ubicacion_id, tipo_consulta, inicio, fin,
+                  now=None, excluir_id=None, anticipacion=True):
+        """
+        Lanza HorarioNoReservable si el horario no se puede reservar. Con
+        anticipacion=False no se aplica la ventana de reserva (p. ej. cuando el
+        profesional aprueba una solicitud ya hecha). `excluir_id` deja afuera al
+        propio turno al revalidarlo.
+        """
+        now = now or timezone.now()
+        resolutor, zonas = self.agenda(nutricionista_id)
+        if ubicacion_id not in zonas:
+            raise HorarioNoReservable('ubicacion')
+        if anticipacion:
+            self._verificar_anticipacion(resolutor, inicio, now)
+
+        busy_range = Turno.calcular_busy_range(inicio, fin, tipo_consulta)
+        desde = timezone.localtime(busy_range.lower, zonas[ubicacion_id])
+        hasta = timezone.localtime(busy_range.upper, zonas[ubicacion_id])
+
+        turnos = Turno.objects.filter(
+            turnos_activos(now),
+            nutricionista_id=nutricionista_id,
+            ubicacion_id=ubicacion_id,
+            busy_range__overlap=busy_range,
+        )
+        if excluir_id:
+            turnos = turnos.exclude(pk=excluir_id)
+        estado = Ubicacion.objects.filter(pk=ubicacion_id).values(
+            en_horario=Exists(DisponibilidadHoraria.objects.filter(
+                nutricionista_id=nutricionista_id,
+                ubicacion_id=ubicacion_id,
+                dia_semana=desde.weekday(),
+                hora_inicio__lte=desde.time(),
+                hora_fin__gte=hasta.time(),
+            )),
+            bloqueado=Exists(BloqueoDisponibilidad.objects.filter(
+                nutricionista_id=nutricionista_id,
+                ubicacion_id=ubicacion_id,
+                start_time__lt=busy_range.upper,
+                end_time__gt=busy_range.lower,
+            )),
+            ocupado=Exists(turnos),
+        ).get()
+
+        # Las ventanas de atención no cruzan la medianoche
+        if not estado['en_horario'] or desde.date() != hasta.date():
+            raise HorarioNoReservable('fuera_de_horario')
+        if estado['bloqueado']:
+            raise HorarioNoReservable('bloqueado')
+        if estado['ocupado']:
+            raise HorarioNoReservable('ocupado')
+
+    def verificar_serie(self, nutricionista_id, ubicacion_id, tipo_consulta, rangos,
+                        now=None, anticipacion=True):
+        """
+        Versión por lotes de verificar() para las ocurrencias de una serie: retorna,
+        alineada con `rangos` [(inicio, fin), ...], la lista de HorarioNoReservable
+        (o None si la ocurrencia se puede reservar). Horarios, bloqueos y turnos del
+        período completo se leen en tres consultas y cada ocurrencia se resuelve en
+        memoria, con las mismas reglas. Las ocurrencias no pueden pisarse entre sí.
+        Con anticipacion=False solo se rechazan las ocurrencias en el pasado.
+        """
+        now = now or timezone.now()
+        resolutor, zonas = self.agenda(nutricionista_id)
+        if ubicacion_id not in zonas:
+            raise HorarioNoReservable('ubicacion')
+        tz = zonas[ubicacion_id]
+
+        ocupados = [Turno.calcular_busy_range(inicio, fin, tipo_consulta) for inicio, fin in rangos]
+        periodo = Range(
+            min(r.lower for r in ocupados), max(r.upper for r in ocupados), bounds='[)'
+        )
+
+        horarios = {}
+        for dia, hora_inicio, hora_fin in DisponibilidadHoraria.objects.filter(
+            nutricionista_id=nutricionista_id, ubicacion_id=ubicacion_id,
+        ).values_list('dia_semana', 'hora_inicio', 'hora_fin'):
+            horarios.setdefault(dia, []).append((hora_inicio, hora_fin))
+        bloqueos = list(BloqueoDisponibilidad.objects.filter(
+            nutricionista_id=nutricionista_id,
+            ubicacion_id=ubicacion_id,
+            start_time__lt=periodo.upper,
+            end_time__gt=periodo.lower,
+        ).values_list('start_time', 'end_time'))
+        turnos = [
+            (r.lower, r.upper) for r in Turno.objects.filter(
+                turnos_activos(now),
+                nutricionista_id=nutricionista_id,
+                ubicacion_id=ubicacion_id,
+                busy_range__overlap=periodo,
+            ).values_list('busy_range', flat=True)
+        ]
+
+        def se_cruza(busy_range, rangos_ocupados):
+            return any(lower < busy_range.upper and busy_range.lower < upper for lower, upper in rangos_ocupados)
+
+        resultado = []
+        aceptados = []
+        for (inicio, _fin), busy_range in zip(rangos, ocupados):
+            desde = timezone.localtime(busy_range.lower, tz)
+            hasta = timezone.localtime(busy_range.upper, tz)
+            try:
+                if anticipacion:
+                    self._verificar_anticipacion(resolutor, inicio, now)
+                elif inicio < now:
+                    raise HorarioNoReservable('fuera_de_ventana', "No se pueden reservar turnos en el pasado.")
+                en_horario = desde.date() == hasta.date() and any(
+                    hora_inicio <= desde.time() and hora_fin >= hasta.time()
+                    for hora_inicio, hora_fin in horarios.get(desde.weekday(), ())
+                )
+                if not en_horario:
+                    raise HorarioNoReservable('fuera_de_horario')
+                if se_cruza(busy_range, bloqueos):
+                    raise HorarioNoReservable('bloqueado')
+                if se_cruza(busy_range, turnos):
+                    raise HorarioNoReservable('ocupado')
+                if se_cruza(busy_range, aceptados):
+                    raise HorarioNoReservable('serie')
+            except HorarioNoReservable as e:
+                resultado.append(e)
+            else:
+                aceptados.append((busy_range.lower, busy_range.upper))
+                resultado.append(None)
+        return resultado
+
+    def revisar_turnos(self, nutricionista_id, ids, now=None):
+        """
+        Revalida turnos ya guardados (p. ej. solicitudes a aprobar en lote) en una
+        sola consulta: cada fila trae, calculados en la base y en la hora de pared
+        de su ubicación, los mismos tres EXISTS de verificar(). Retorna {id:
+        HorarioNoReservable o None}; entre los turnos del lote tampoco puede haber
+        solapes. No aplica la ventana de reserva (como al aprobar uno solo).
+        """
+        now = now or timezone.now()
+        desde = _HoraLocal(F('busy_range__startswith'), F('ubicacion__timezone'))
+        hasta = _HoraLocal(F('busy_range__endswith'), F('ubicacion__timezone'))
+        filas = Turno.objects.filter(nutricionista_id=nutricionista_id, pk__in=ids).annotate(
+            dia_local=_DiaSemanaLocal(desde),
+            hora_desde=Cast(desde, TimeField()),
+            hora_hasta=Cast(hasta, TimeField()),
+            fecha_desde=Cast(desde, DateField()),
+            fecha_hasta=Cast(hasta, DateField()),
+        ).annotate(
+            en_horario=Exists(DisponibilidadHoraria.objects.filter(
+                nutricionista_id=OuterRef('nutricionista_id'),
+                ubicacion_id=OuterRef('ubicacion_id'),
+                dia_semana=OuterRef('dia_local'),
+                hora_inicio__lte=OuterRef('hora_desde'),
+                hora_fin__gte=OuterRef('hora_hasta'),
+            )),
+            bloqueado=Exists(BloqueoDisponibilidad.objects.filter(
+                nutricionista_id=OuterRef('nutricionista_id'),
+                ubicacion_id=OuterRef('ubicacion_id'),
+                start_time__lt=OuterRef('busy_range__endswith'),
+                end_time__gt=OuterRef('busy_range__startswith'),
+            )),
+            ocupado=Exists(Turno.objects.filter(
+                turnos_activos(now),
+                nutricionista_id=OuterRef('nutricionista_id'),
+                ubicacion_id=OuterRef('ubicacion_id'),
+                busy_range__overlap=OuterRef('busy_range'),
+            ).exclude(pk=OuterRef('pk'))),
+        ).order_by('start_time').values(
+            'id', 'ubicacion_id', 'busy_range', 'fecha_desde', 'fecha_hasta', 'en_horario', 'bloqueado', 'ocupado',
+        )
+
+        resultado = {}
+        aceptados = []
+        for fila in filas:
+            busy_range = fila['busy_range']
+            if not fila['en_horario'] or fila['fecha_desde'] != fila['fecha_hasta']:
+                resultado[fila['id']] = HorarioNoReservable('fuera_de_horario')
+            elif fila['bloqueado']:
+                resultado[fila['id']] = HorarioNoReservable('bloqueado')
+            elif fila['ocupado']:
+                resultado[fila['id']] = HorarioNoReservable('ocupado')
+            elif any(
+                ubicacion_id == fila['ubicacion_id'] and otro.lower < busy_range.upper and busy_range.lower < otro.upper
+                for ubicacion_id, otro in aceptados
+            ):
+                resultado[fila['id']] = HorarioNoReservable('lote')
+            else:
+                aceptados.append((fila['ubicacion_id'], busy_range))
+                resultado[fila['id']] = None
+        return resultado
+
+    @staticmethod
+    def _verificar_anticipacion(resolutor, inicio, now):
+        desde, hasta = resolutor.ventana_de_reserva(now)
+        if inicio < desde:
+            horas_minimas = (desde - now).total_seconds() / 3600
+            if horas_minimas <= 0:
+                raise HorarioNoReservable('fuera_de_ventana', "No se pueden solicitar turnos en el pasado.")
+            raise HorarioNoReservable(
+                'fuera_de_ventana',
+                f"Se requiere reservar con al menos {horas_minimas:.0f} horas de anticipación. "
+                f"El turno seleccionado es en {(inicio - now).total_seconds() / 3600:.1f} horas.",
+            )
+        if inicio > hasta:
+            raise HorarioNoReservable(
+                'fuera_de_ventana',
+                f"No se puede reservar con más de {(hasta - now).days} días de anticipación.",
+            )
+
+
+@contextmanager
+def sin_solapes():
+    """
+    Corre la escritura en un savepoint y traduce la violación de la restricción de
+    solapes en ConflictoDeHorario. El savepoint deja usable la transacción del
+    request (ATOMIC_REQUESTS) después del rechazo.
+    """
+    try:
+        with transaction.atomic():
+            yield
+    except IntegrityError as e:
+        if Turno.RESTRICCION_SOLAPE in str(e):
+            raise ConflictoDeHorario(str(e)) from e
+        raise
+
+
+def ocurrencias_semanales(inicio, fin, repeticiones, intervalo_semanas=1, tz=None):
+    """
+    [(inicio, fin), ...] de una serie semanal que empieza en [inicio, fin). Cada
+    ocurrencia mantiene la hora de pared de `tz` (la zona de la ubicación), así
+    un cambio de horario de verano no corre los turnos de la serie.
+    """
+    tz = tz or timezone.get_current_timezone()
+    local_inicio = timezone.localtime(inicio, tz).replace(tzinfo=None)
+    duracion = fin - inicio
+    ocurrencias = []
+    for i in range(repeticiones):
+        desde = timezone.make_aware(local_inicio + datetime.timedelta(weeks=i * intervalo_semanas), tz)
+        ocurrencias.append((desde, desde + duracion))
+    return ocurrencias
+
+
+def reservar_serie(nutricionista, paciente, ubicacion, tipo_consulta, rangos,
+                   omitir_conflictos=False, verificador=None, now=None):
+    """
+    Reserva como CONFIRMADO las ocurrencias `rangos` de una serie bajo el lock de
+    la agenda: una verificación por lotes (verificar_serie), un único bulk_create
+    y una sola invalidación de caché/materializado. Retorna (turnos, conflictos),
+    con conflictos = [((inicio, fin), HorarioNoReservable), ...].
+
+    La serie la arma el profesional, así que no se le aplica la ventana de
+    reserva de los pacientes (como al aprobar un turno). Si hay conflictos y no
+    se pide `omitir_conflictos`, no crea nada. Puede lanzar AgendaOcupada o
+    ConflictoDeHorario (la restricción de la base respalda el alta).
+    """
+    from .signals import agenda_modificada, dias_modificados
+
+    now = now or timezone.now()
+    verificador = verificador or VerificadorDisponibilidad()
+    with agenda_bloqueada(nutricionista.id, ubicacion.id):
+        revision = verificador.verificar_serie(
+            nutricionista.id, ubicacion.id, tipo_consulta, rangos, now=now, anticipacion=False
+        )
+        conflictos = [(rango, error) for rango, error in zip(rangos, revision) if error is not None]
+        if conflictos and not omitir_conflictos:
+            return [], conflictos
+
+        libres = [rango for rango, error in zip(rangos, revision) if error is None]
+        if not libres:
+            return [], conflictos
+        turnos = [
+            Turno(
+                nutricionista=nutricionista,
+                paciente=paciente,
+                ubicacion=ubicacion,
+                tipo_consulta=tipo_consulta,
+                start_time=inicio,
+                end_time=fin,
+                # bulk_create no pasa por save(): slot y busy_range se arman acá
+                slot=Range(inicio, fin, bounds='[)'),
+                busy_range=Turno.calcular_busy_range(inicio, fin, tipo_consulta),
+                state=TurnoState.CONFIRMADO,
+                source='interno',
+                canal=tipo_consulta.canal_por_defecto,
+                precio_cobrado=tipo_consulta.precio,
+            )
+            for inicio, fin in libres
+        ]
+        periodo = Range(turnos[0].busy_range.lower, turnos[-1].busy_range.upper, bounds='[)')
+        liberar_holds_vencidos(nutricionista.id, ubicacion.id, periodo, now=now)
+        with sin_solapes():
+            Turno.objects.bulk_create(turnos)
+
+    # bulk_create no dispara señales: avisar a caché y materializado una sola vez
+    agenda_modificada(nutricionista.id)
+    # Solo los días de las ocurrencias, no todo el período de la serie
+    dias_modificados(nutricionista.id, ubicacion.id, intervalos=[
+        (turno.busy_range.lower, turno.busy_range.upper) for turno in turnos
+    ])
+    metrics.incrementar('turnos_de_serie_creados', len(turnos))
+    return turnos, conflictos
+
+
+def transicionar_lote(nutricionista_id, ids, destino, verificador=None, now=None):
+    """
+    Pasa a `destino` (CONFIRMADO o CANCELADO) los turnos `ids` del profesional en
+    una transacción. Para confirmar se toman los locks de las agendas afectadas y
+    se revalida todo el lote en una consulta (revisar_turnos); los que pasan se
+    actualizan con un solo UPDATE condicional (TurnoQuerySet.transicionar).
+    Retorna (aplicados, rechazos) con rechazos = {id: HorarioNoReservable}.
+    Puede lanzar AgendaOcupada o ConflictoDeHorario.
+    """
+    now = now or timezone.now()
+    verificador = verificador or VerificadorDisponibilidad()
+    filas = {
+        turno_id: (ubicacion_id, state, busy_range)
+        for turno_id, ubicacion_id, state, busy_range in Turno.objects.filter(
+            nutricionista_id=nutricionista_id, pk__in=ids,
+        ).values_list('id', 'ubicacion_id', 'state', 'busy_range')
+    }
+    rechazos = {turno_id: HorarioNoReservable('no_encontrado') for turno_id in ids if turno_id not in filas}
+    candidatos = []
+    for turno_id, (_, state, _) in filas.items():
+        if state in TRANSICIONES_TURNO[destino]:
+            candidatos.append(turno_id)
+        else:
+            rechazos[turno_id] = HorarioNoReservable('estado')
+
+    with transaction.atomic(), ExitStack() as locks:
+        if destino == TurnoState.CONFIRMADO and candidatos:
+            # Locks en orden fijo: dos lotes sobre las mismas agendas no se bloquean entre sí
+            for ubicacion_id in sorted({filas[turno_id][0] for turno_id in candidatos}):
+                locks.enter_context(agenda_bloqueada(nutricionista_id, ubicacion_id))
+            for turno_id, error in verificador.revisar_turnos(nutricionista_id, candidatos, now=now).items():
+                if error is not None:
+                    rechazos[turno_id] = error
+            candidatos = [turno_id for turno_id in candidatos if turno_id not in rechazos]
+            for ubicacion_id in {filas[turno_id][0] for turno_id in candidatos}:
+                rangos = [filas[turno_id][2] for turno_id in candidatos if filas[turno_id][0] == ubicacion_id]
+                periodo = Range(min(r.lower for r in rangos), max(r.upper for r in rangos), bounds='[)')
+                liberar_holds_vencidos(nutricionista_id, ubicacion_id, periodo, now=now)
+
+        aplicados = []
+        if candidatos:
+            with sin_solapes():
+                aplicados = Turno.objects.filter(pk__in=candidatos).transicionar(destino, now=now)
+        # Los que otro request cambió entre la lectura y el UPDATE
+        for turno_id in set(candidatos) - set(aplicados):
+            rechazos[turno_id] = HorarioNoReservable('estado')
+
+    if aplicados:
+        metrics.incrementar('turnos_transicionados_en_lote', len(aplicados), estado=destino)
+    return aplicados, rechazos
@@ -0,0 +1,189 @@
+# apps/agenda/busqueda.py
+"""
+Búsqueda de disponibilidad entre varios profesionales.
+
+Devuelve los primeros N slots libres entre todos los nutricionistas públicos
+que cumplen los filtros. Todo se carga en bloque (un juego de consultas por
+rango para todos los candidatos, no uno por profesional) y después cada par
+(profesional, ubicación) produce su flujo ordenado de slots; los flujos se
+combinan con un merge de k vías que se detiene apenas junta N resultados.
+"""
+import datetime
+import heapq
+from itertools import islice
+
+from django.db.models import F
+from django.utils import timezone
+
+from .availability import (
+    ResolutorBuffers,
+    acotar_fechas,
+    barrer_libres,
+    fusionar_intervalos,
+    iterar_candidatos,
+    limites_del_rango,
+    turnos_activos,
+)
+from .models import (
+    BloqueoDisponibilidad,
+    BookingMode,
+    DisponibilidadHoraria,
+    ProfessionalSettings,
+    TipoConsultaConfig,
+    Turno,
+)
+from apps.user.models import TipoConsulta
+
+
+LIMITE_POR_DEFECTO = 10
+LIMITE_MAXIMO = 50
+
+
+def _flujo_de_slots(nutricionista, ubicacion, tipo, config, disponibilidades_por_dia,
+                    ocupados, start_date, end_date, ventana):
+    """
+    Slots libres (ordenados) de un profesional en una ubicación, generados a demanda
+    y solo dentro de su ventana de reserva.
+    """
+    desde, hasta = ventana
+    ultimo_inicio = None
+    candidatos = iterar_candidatos(disponibilidades_por_dia, start_date, end_date, config)
+    for _, _, inicio, fin in barrer_libres(candidatos, ocupados):
+        if inicio > hasta:
+            return
+        if inicio == ultimo_inicio or inicio < desde:
+            continue
+        ultimo_inicio = inicio
+        yield {
+            'inicio': inicio,
+            'fin': fin,
+            'nutricionista_id': nutricionista.id,
+            'nutricionista_nombre': nutricionista.full_name,
+            'ubicacion_id': ubicacion.id,
+            'ubicacion_nombre': ubicacion.nombre,
+            'is_virtual': ubicacion.is_virtual,
+            'tipo_consulta_id': tipo.id,
+        }
+
+
+def buscar_primeros_slots(start_date, end_date, limite=LIMITE_POR_DEFECTO, especialidad_id=None,
+                          ubicacion_id=None, is_virtual=None, tipo=TipoConsulta.INICIAL, now=None):
+    """
+    Primeros `limite` slots libres entre todos los nutricionistas públicos.
+
+    Filtros opcionales: especialidad, ubicación concreta, modalidad (is_virtual)
+    y tipo de consulta (enum TipoConsulta; solo se consideran los profesionales
+    que lo tienen configurado). Como en el turnero público, los turnos y bloqueos
+    se cruzan por ubicación, y cada profesional solo ofrece slots dentro de su
+    ventana de reserva, en la zona horaria de cada ubicación.
+
+    Cuesta siempre cinco consultas (settings, tipos, disponibilidades, bloqueos y
+    turnos) sin importar cuántos profesionales haya.
+    """
+    now = now or timezone.now()
+    if start_date > end_date or limite <= 0:
+        return []
+
+    # 1) Profesionales candidatos (con sus settings)
+    settings_qs = ProfessionalSettings.objects.filter(
+        booking_mode=BookingMode.PUBLICO,
+        nutricionista__user__is_active=True,
+    ).select_related('nutricionista')
+    if especialidad_id:
+        settings_qs = settings_qs.filter(nutricionista__especialidades__id=especialidad_id)
+    settings_por_nutri = {s.nutricionista_id: s for s in settings_qs}
+    if not settings_por_nutri:
+        return []
+    ids = list(settings_por_nutri)
+
+    # 2) Tipos de consulta: resuelven duración y buffers del slot pedido
+    tipos_por_nutri = {}
+    for tipo_config in TipoConsultaConfig.objects.filter(nutricionista_id__in=ids):
+        tipos_por_nutri.setdefault(tipo_config.nutricionista_id, []).append(tipo_config)
+
+    pedidos = {}
+    ventanas = {}
+    for nutri_id, tipos in tipos_por_nutri.items():
+        pedido = next((t for t in tipos if t.tipo == tipo), None)
+        if pedido is None:
+            continue
+        resolutor = ResolutorBuffers.precargado(settings_por_nutri[nutri_id], tipos)
+        pedidos[nutri_id] = (pedido, resolutor.configuracion(tipo_consulta_id=pedido.id))
+        ventanas[nutri_id] = resolutor.ventana_de_reserva(now)
+    if not pedidos:
+        return []
+
+    # Nada que buscar fuera de la unión de las ventanas de reserva
+    start_date, end_date = acotar_fechas(
+        start_date, end_date,
+        min(desde for desde, _ in ventanas.values()),
+        max(hasta for _, hasta in ventanas.values()),
+    )
+    if start_date > end_date:
+        return []
+
+    # 3) Disponibilidades de todos, agrupadas por (profesional, ubicación)
+    disponibilidades = DisponibilidadHoraria.objects.filter(
+        nutricionista_id__in=list(pedidos),
+    ).select_related('ubicacion').annotate(ubicacion_tz=F('ubicacion__timezone'))
+    if ubicacion_id:
+        disponibilidades = disponibilidades.filter(ubicacion_id=ubicacion_id)
+    if is_virtual is not None:
+        disponibilidades = disponibilidades.filter(ubicacion__is_virtual=is_virtual)
+
+    agendas = {}
+    ubicaciones = {}
+    for disp in disponibilidades:
+        clave = (disp.nutricionista_id, disp.ubicacion_id)
+        ubicaciones[clave] = disp.ubicacion
+        agendas.setdefault(clave, {}).setdefault(disp.dia_semana, []).append(disp)
+    if not agendas:
+        return []
+
+    # 4) Ocupados del rango para todos los profesionales (bloqueos + turnos). Un día
+    # de margen a cada lado cubre las zonas horarias de cada ubicación
+    un_dia = datetime.timedelta(days=1)
+    rango_inicio, rango_fin = limites_del_rango(
+        start_date - un_dia, end_date + un_dia, timezone.get_current_timezone()
+    )
+    nutri_ids = list({nutri_id for nutri_id, _ in agendas})
+    ubicacion_ids = list({ubic_id for _, ubic_id in agendas})
+
+    ocupados = {clave: [] for clave in agendas}
+    bloqueos = BloqueoDisponibilidad.objects.filter(
+        nutricionista_id__in=nutri_ids,
+        ubicacion_id__in=ubicacion_ids,
+        start_time__lt=rango_fin,
+        end_time__gt=rango_inicio,
+    ).values_list('nutricionista_id', 'ubicacion_id', 'start_time', 'end_time')
+    for nutri_id, ubic_id, start_time, end_time in bloqueos:
+        if (nutri_id, ubic_id) in ocupados:
+            ocupados[(nutri_id, ubic_id)].append((start_time, end_time))
+
+    turnos = Turno.objects.filter(
+        nutricionista_id__in=nutri_ids,
+        ubicacion_id__in=ubicacion_ids,
+        busy_range__overlap=(rango_inicio, rango_fin),
+    ).filter(turnos_activos(now)).values_list('nutricionista_id', 'ubicacion_id', 'busy_range')
+    for nutri_id, ubic_id, busy_range in turnos:
+        if (nutri_id, ubic_id) in ocupados:
+            ocupados[(nutri_id, ubic_id)].append((busy_range.lower, busy_range.upper))
+
+    # 5) Merge de k vías de los flujos por (profesional, ubicación), con corte temprano
+    flujos = []
+    for (nutri_id, ubic_id), disponibilidades_por_dia in agendas.items():
+        pedido, config = pedidos[nutri_id]
+        flujos.append(_flujo_de_slots(
+            settings_por_nutri[nutri_id].nutricionista,
+            ubicaciones[(nutri_id, ubic_id)],
+            pedido,
+            config,
+            disponibilidades_por_dia,
+            fusionar_intervalos(ocupados[(nutri_id, ubic_id)]),
+            start_date,
+            end_date,
+            ventanas[nutri_id],
+        ))
+
+    combinados = heapq.merge(*flujos, key=lambda slot: (slot['inicio'], slot['nutricionista_id'], slot['ubicacion_id']))
+    return list(islice(combinados, limite))
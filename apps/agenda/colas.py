@@ -0,0 +1,52 @@
+# apps/agenda/colas.py
+"""
+Colas de Celery para las notificaciones por email.
+
+Cada plantilla declara su prioridad (ver plantillas.PLANTILLAS) y el despachador
+publica cada lote en la cola de esa prioridad:
+
+- CRITICA (notificaciones_criticas): mails transaccionales que el paciente está
+  esperando, como el magic link de verificación, que vence en 10 minutos.
+- MASIVA (notificaciones_masivas): avisos de acciones en lote, recordatorios.
+
+Cada cola se atiende con un worker propio, así una tanda grande de avisos
+masivos no demora a los críticos:
+
+    celery -A core worker -Q notificaciones_criticas -n criticas@%h
+    celery -A core worker -Q notificaciones_masivas -n masivas@%h
+    celery -A core worker -Q celery -n general@%h
+
+Un worker que atiende una sola de estas colas y no recibió -c toma la
+concurrencia declarada en AGENDA_COLAS_NOTIFICACIONES (ver aplicar_concurrencia).
+"""
+from django.conf import settings
+
+
+CRITICA = 'critica'
+MASIVA = 'masiva'
+
+COLAS = getattr(settings, 'AGENDA_COLAS_NOTIFICACIONES', {
+    CRITICA: {'cola': 'notificaciones_criticas', 'concurrencia': 4},
+    MASIVA: {'cola': 'notificaciones_masivas', 'concurrencia': 2},
+})
+
+
+def cola_de(prioridad):
+    """Nombre de la cola de Celery de una prioridad."""
+    return COLAS[prioridad]['cola']
+
+
+def aplicar_concurrencia(conf, options):
+    """
+    Receptor de celeryd_init: si el worker atiende solo una cola de
+    notificaciones y no se le pasó -c, usa la concurrencia declarada para ella.
+    """
+    if options.get('concurrency'):
+        return
+    colas = options.get('queues') or []
+    if isinstance(colas, str):
+        colas = colas.split(',')
+    declaradas = {config['cola']: config['concurrencia'] for config in COLAS.values()}
+    if len(colas) == 1 and colas[0] in declaradas:
+        # setup_defaults del worker toma worker_concurrency si no vino por CLI
+        conf.worker_concurrency = declaradas[colas[0]]
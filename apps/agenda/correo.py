@@ -0,0 +1,268 @@
+# apps/agenda/correo.py
+"""
+Conexiones SMTP salientes reutilizables por proceso worker.
+
+Cada email de notificación sale desde el SMTP propio del nutricionista (si lo
+configuró) o desde el del sistema. Abrir una conexión cuesta TCP + TLS + AUTH,
+así que en lugar de abrir una por email el PoolSMTP de cada proceso guarda las
+conexiones libres agrupadas por remitente (host, puerto, usuario, TLS/SSL) y las
+reutiliza entre tareas:
+
+- antes de reutilizar una conexión que estuvo libre más de VERIFICAR_DESPUES
+  segundos se le manda un NOOP; si el servidor la cortó se descarta y se abre
+  otra;
+- las conexiones libres hace más de INACTIVIDAD_MAXIMA segundos se cierran (los
+  servidores SMTP cortan las sesiones ociosas de todas formas);
+- se guardan a lo sumo CONEXIONES_POR_REMITENTE libres por remitente.
+
+La configuración resuelta de cada nutricionista (remitente_para) también se
+recuerda en el proceso, validada contra un contador de versión en la caché de
+Django que se incrementa al guardar el Nutricionista (ver signals.py): todos
+los workers la recargan en el siguiente envío tras un cambio.
+"""
+import logging
+import os
+import smtplib
+import threading
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CONEXIONES_POR_REMITENTE = getattr(settings, 'AGENDA_SMTP_CONEXIONES_POR_REMITENTE', 2)
+INACTIVIDAD_MAXIMA = getattr(settings, 'AGENDA_SMTP_INACTIVIDAD_SEGUNDOS', 120)
+VERIFICAR_DESPUES = 15
+
+REMITENTE_TTL = getattr(settings, 'AGENDA_REMITENTE_CACHE_TTL', 60 * 10)
+REMITENTE_VERSION_KEY = 'agenda:remitente:version:{nutricionista_id}'
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Remitentes
+# ──────────────────────────────────────────────────────────────────────────────
+
+class Remitente(namedtuple('Remitente', 'from_email host port username password use_tls use_ssl')):
+    """
+    Desde dónde sale un email. Sin host se usa el backend por defecto de
+    settings (EMAIL_BACKEND), como en desarrollo.
+    """
+    __slots__ = ()
+
+    @property
+    def clave(self):
+        """Clave del pool: remitentes con la misma clave comparten conexiones."""
+        return (self.host, self.port, self.username, self.password, self.use_tls, self.use_ssl)
+
+    def __repr__(self):
+        # Sin la contraseña, por si termina en un log
+        return f"Remitente({self.from_email!r}, {self.host}:{self.port})"
+
+
+def remitente_del_sistema():
+    """Email del sistema; en DEBUG, el backend por defecto (sin SMTP propio)."""
+    if settings.DEBUG:
+        return Remitente(settings.DEFAULT_FROM_EMAIL, None, None, None, None, False, False)
+    return Remitente(
+        settings.SYSTEM_DEFAULT_FROM_EMAIL,
+        settings.SYSTEM_EMAIL_HOST,
+        settings.SYSTEM_EMAIL_PORT,
+        settings.SYSTEM_EMAIL_HOST_USER,
+        settings.SYSTEM_EMAIL_HOST_PASSWORD,
+        settings.SYSTEM_EMAIL_USE_TLS,
+        settings.SYSTEM_EMAIL_USE_SSL,
+    )
+
+
+def _cargar_remitente(nutricionista_id):
+    from apps.user.models import Nutricionista
+
+    try:
+        nutricionista = Nutricionista.objects.get(id=nutricionista_id)
+    except Exception as exc:
+        logger.warning(f"Error al obtener nutricionista {nutricionista_id}: {exc}. Usando email del sistema.")
+        return remitente_del_sistema()
+
+    config = nutricionista.get_email_config()
+    if config is None:
+        logger.info(f"Nutricionista {nutricionista_id} sin email configurado, usando email del sistema")
+        return remitente_del_sistema()
+    return Remitente(
+        config['DEFAULT_FROM_EMAIL'],
+        config['EMAIL_HOST'],
+        config['EMAIL_PORT'],
+        config['EMAIL_HOST_USER'],
+        config['EMAIL_HOST_PASSWORD'],
+        config['EMAIL_USE_TLS'],
+        config['EMAIL_USE_SSL'],
+    )
+
+
+# nutricionista_id -> (versión, vence, Remitente), por proceso
+_remitentes = {}
+
+
+def invalidar_remitente(nutricionista_id):
+    """Incrementa la versión de la config de email: cada proceso la recarga."""
+    key = REMITENTE_VERSION_KEY.format(nutricionista_id=nutricionista_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def remitente_para(nutricionista_id):
+    """
+    Remitente de las notificaciones de un nutricionista: su SMTP propio si lo
+    configuró, si no (o sin nutricionista) el del sistema.
+    """
+    if not nutricionista_id:
+        return remitente_del_sistema()
+
+    # La versión se lee antes que la base: si cambia en el medio, el próximo
+    # envío ve una versión distinta y recarga.
+    version = cache.get(REMITENTE_VERSION_KEY.format(nutricionista_id=nutricionista_id))
+    ahora = time.monotonic()
+    guardado = _remitentes.get(nutricionista_id)
+    if guardado is not None and guardado[0] == version and guardado[1] > ahora:
+        return guardado[2]
+
+    remitente = _cargar_remitente(nutricionista_id)
+    _remitentes[nutricionista_id] = (version, ahora + REMITENTE_TTL, remitente)
+    return remitente
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Pool de conexiones
+# ──────────────────────────────────────────────────────────────────────────────
+
+def _conexion_viva(conexion):
+    try:
+        return conexion.connection.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+class PoolSMTP:
+    """Conexiones SMTP libres de un proceso, agrupadas por Remitente.clave."""
+
+    def __init__(self, por_remitente=CONEXIONES_POR_REMITENTE, inactividad=INACTIVIDAD_MAXIMA,
+                 verificar_despues=VERIFICAR_DESPUES):
+        self.por_remitente = por_remitente
+        self.inactividad = inactividad
+        self.verificar_despues = verificar_despues
+        self._libres = defaultdict(list)  # clave -> [(conexion, ultimo_uso)]
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _tras_fork(self):
+        # Un proceso hijo no debe usar los sockets heredados del padre
+        if self._pid != os.getpid():
+            self._libres = defaultdict(list)
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def cerrar_inactivas(self, ahora=None):
+        """Cierra las conexiones libres hace más de `inactividad` segundos."""
+        self._tras_fork()
+        ahora = time.monotonic() if ahora is None else ahora
+        vencidas = []
+        with self._lock:
+            for clave, libres in list(self._libres.items()):
+                vigentes = [(c, uso) for c, uso in libres if ahora - uso <= self.inactividad]
+                vencidas += [c for c, uso in libres if ahora - uso > self.inactividad]
+                if vigentes:
+                    self._libres[clave] = vigentes
+                else:
+                    del self._libres[clave]
+        for conexion in vencidas:
+            self._cerrar(conexion)
+        return len(vencidas)
+
+    def cerrar_todas(self):
+        """Cierra todas las conexiones libres (p. ej. al apagar el worker)."""
+        self._tras_fork()
+        with self._lock:
+            libres, self._libres = self._libres, defaultdict(list)
+        for conexiones in libres.values():
+            for conexion, _ in conexiones:
+                self._cerrar(conexion)
+
+    def _tomar(self, clave):
+        ahora = time.monotonic()
+        self.cerrar_inactivas(ahora)
+        while True:
+            with self._lock:
+                libres = self._libres.get(clave)
+                if not libres:
+                    return None
+                # La más reciente: es la que menos probablemente cortó el servidor
+                conexion, uso = libres.pop()
+            if ahora - uso < self.verificar_despues or _conexion_viva(conexion):
+                metrics.incrementar('smtp_conexiones_reutilizadas')
+                return conexion
+            self._cerrar(conexion)
+
+    def _devolver(self, clave, conexion):
+        if conexion.connection is None:
+            return
+        with self._lock:
+            libres = self._libres[clave]
+            if len(libres) < self.por_remitente:
+                libres.append((conexion, time.monotonic()))
+                return
+        self._cerrar(conexion)
+
+    @staticmethod
+    def _cerrar(conexion):
+        try:
+            conexion.close()
+        except Exception as exc:
+            logger.debug(f"Error al cerrar conexión SMTP: {exc}")
+
+    @contextmanager
+    def conexion(self, remitente):
+        """
+        Conexión abierta para enviar como `remitente`; al salir vuelve al pool.
+        Si el envío falla, la conexión se descarta.
+        """
+        self._tras_fork()
+        if remitente.host is None:
+            yield get_connection(fail_silently=False)
+            return
+
+        conexion = self._tomar(remitente.clave)
+        if conexion is None:
+            conexion = get_connection(
+                host=remitente.host,
+                port=remitente.port,
+                username=remitente.username,
+                password=remitente.password,
+                use_tls=remitente.use_tls,
+                use_ssl=remitente.use_ssl,
+                fail_silently=False,
+            )
+            if not isinstance(conexion, SMTPBackend):
+                # Backends sin conexión (archivo, memoria, consola): nada que reutilizar
+                yield conexion
+                return
+            conexion.open()
+            metrics.incrementar('smtp_conexiones_abiertas')
+
+        try:
+            yield conexion
+        except BaseException:
+            self._cerrar(conexion)
+            raise
+        self._devolver(remitente.clave, conexion)
+
+
+pool = PoolSMTP()
@@ -0,0 +1,32 @@
+# apps/agenda/cursores.py
+"""
+Cursores opacos para paginar respuestas de la agenda.
+
+Un cursor es un diccionario JSON en base64 url-safe: el cliente no necesita
+interpretarlo, solo devolverlo tal cual para pedir la página siguiente.
+"""
+import base64
+import binascii
+import json
+
+
+class CursorInvalido(ValueError):
+    """El cursor recibido no se puede decodificar."""
+
+
+def codificar_cursor(datos):
+    """Serializa `datos` (dict con valores JSON) como cursor opaco."""
+    crudo = json.dumps(datos, separators=(',', ':'), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(crudo).decode().rstrip('=')
+
+
+def decodificar_cursor(cursor):
+    """Inversa de codificar_cursor; lanza CursorInvalido si no es un cursor válido."""
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError) as exc:
+        raise CursorInvalido("Cursor inválido.") from exc
+    if not isinstance(datos, dict):
+        raise CursorInvalido("Cursor inválido.")
+    return datos
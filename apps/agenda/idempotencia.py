@@ -0,0 +1,90 @@
+# apps/agenda/idempotencia.py
+"""
+Soporte del header Idempotency-Key para los POST públicos del turnero.
+
+El primer pedido con una clave inserta su fila en ClaveIdempotencia (en curso)
+y la procesa en una misma transacción que, al terminar, guarda la respuesta; si
+el procesamiento falla, la fila se revierte con él. Los reintentos con la misma
+clave reciben la respuesta tal cual con una búsqueda por índice. Si dos pedidos
+con la misma clave llegan a la vez, el índice único hace esperar al segundo
+hasta que el primero confirma, y entonces lee su respuesta.
+
+Solo se guardan respuestas que confirman la transacción: los errores de la API
+(que DRF revierte) se pueden reintentar con la misma clave.
+"""
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import ClaveIdempotencia
+
+
+HEADER = 'Idempotency-Key'
+HEADER_REPETIDA = 'Idempotent-Replayed'
+LARGO_MAXIMO = 255
+
+TTL = datetime.timedelta(hours=getattr(settings, 'AGENDA_IDEMPOTENCIA_TTL_HORAS', 24))
+
+
+def _respuesta_guardada(registro):
+    response = Response(registro.respuesta, status=registro.status_code)
+    response[HEADER_REPETIDA] = 'true'
+    return response
+
+
+def _respuesta_existente(registro, huella):
+    if registro.huella != huella:
+        return Response(
+            {"error": f"La {HEADER} ya se usó con otro pedido."},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    return _respuesta_guardada(registro)
+
+
+def responder_idempotente(request, endpoint, procesar, now=None):
+    """
+    Ejecuta `procesar()` (que retorna la Response) a lo sumo una vez por
+    Idempotency-Key y endpoint. Sin header se comporta como `procesar()`.
+    """
+    clave = request.headers.get(HEADER)
+    if not clave:
+        return procesar()
+    if len(clave) > LARGO_MAXIMO:
+        return Response(
+            {"error": f"{HEADER} no puede superar {LARGO_MAXIMO} caracteres."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    now = now or timezone.now()
+    huella = hashlib.sha256(request.body).hexdigest()
+    registros = ClaveIdempotencia.objects.filter(endpoint=endpoint, clave=clave)
+
+    registro = registros.first()
+    if registro is not None and registro.expires_at <= now:
+        registros.filter(pk=registro.pk).delete()
+        registro = None
+    if registro is not None and registro.status_code is not None:
+        return _respuesta_existente(registro, huella)
+
+    # El reclamo, `procesar()` y la respuesta guardada se confirman juntos: si
+    # `procesar()` lanza, la fila se revierte y un reintento vuelve a empezar.
+    # Un pedido concurrente con la misma clave queda bloqueado en el insert
+    # (índice único) hasta que este confirma o revierte.
+    with transaction.atomic():
+        ClaveIdempotencia.objects.bulk_create(
+            [ClaveIdempotencia(endpoint=endpoint, clave=clave, huella=huella, expires_at=now + TTL)],
+            ignore_conflicts=True,
+        )
+        registro = registros.select_for_update().get()
+        if registro.huella != huella or registro.status_code is not None:
+            return _respuesta_existente(registro, huella)
+
+        response = procesar()
+        if response.status_code < 500:
+            registros.filter(pk=registro.pk).update(status_code=response.status_code, respuesta=response.data)
+    return response
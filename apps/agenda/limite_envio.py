@@ -0,0 +1,114 @@
+# apps/agenda/limite_envio.py
+"""
+Límite de envío por remitente (token bucket) y backoff de las tareas de email.
+
+Las cuentas SMTP propias de los nutricionistas suelen tener un tope de envíos
+del proveedor. Cada remitente tiene un balde de `capacidad` tokens que se
+rellena a `por_minuto` tokens por minuto, compartido por todos los workers a
+través de la caché de Django. El balde se guarda como dos claves: los tokens
+consumidos (un contador que solo se mueve con incr/decr, atómicos también en
+Redis) y el instante desde el que se cuenta el relleno. Los tokens disponibles
+son capacidad + relleno - consumidos, con tope en la capacidad.
+
+Una tarea que se queda sin tokens no quema un reintento: se reprograma con
+backoff exponencial con jitter (backoff), a partir de la espera que indica el
+balde.
+"""
+import hashlib
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .correo import remitente_del_sistema
+
+
+LIMITE_POR_MINUTO = getattr(settings, 'AGENDA_EMAIL_LIMITE_POR_MINUTO', 20)
+RAFAGA = getattr(settings, 'AGENDA_EMAIL_RAFAGA', 10)
+# Email del sistema: 0 = sin límite (suele ser un proveedor transaccional)
+LIMITE_SISTEMA_POR_MINUTO = getattr(settings, 'AGENDA_EMAIL_SISTEMA_LIMITE_POR_MINUTO', 0)
+
+BACKOFF_BASE_SEGUNDOS = 5
+# Por debajo de notificaciones.REPUBLICAR_DESPUES: una tarea demorada no se republica
+BACKOFF_TOPE_SEGUNDOS = 60 * 5
+
+CONSUMIDOS_KEY = 'agenda:limite_envio:{clave}:consumidos'
+INICIO_KEY = 'agenda:limite_envio:{clave}:inicio'
+
+
+def backoff(intento, minimo=0.0, base=BACKOFF_BASE_SEGUNDOS, tope=BACKOFF_TOPE_SEGUNDOS):
+    """
+    Segundos a esperar antes del intento número `intento` (desde 0): `minimo`
+    más un valor al azar entre 0 y min(tope, base * 2**intento) ("full jitter"),
+    para que las tareas demoradas juntas no vuelvan todas a la vez.
+    """
+    return minimo + random.uniform(0, min(tope, base * 2 ** intento))
+
+
+class LimiteDeEnvio:
+    """Token bucket compartido entre procesos vía la caché de Django."""
+
+    def __init__(self, capacidad, por_minuto):
+        self.capacidad = capacidad
+        self.tasa = por_minuto / 60
+
+    def tomar(self, clave, cantidad=1, ahora=None):
+        """
+        Toma hasta `cantidad` tokens del balde `clave`. Retorna (concedidos,
+        espera): `espera` son los segundos hasta el próximo token si no alcanzó
+        para todos, o 0.
+        """
+        ahora = time.time() if ahora is None else ahora
+        consumidos_key = CONSUMIDOS_KEY.format(clave=clave)
+        inicio_key = INICIO_KEY.format(clave=clave)
+
+        cache.add(consumidos_key, 0, timeout=None)
+        try:
+            consumidos = cache.incr(consumidos_key, cantidad)
+        except ValueError:
+            # La clave fue desalojada entre add e incr
+            cache.set(consumidos_key, cantidad, timeout=None)
+            consumidos = cantidad
+        previos = consumidos - cantidad
+
+        inicio = cache.get(inicio_key)
+        permitidos = None if inicio is None else self.capacidad + self.tasa * (ahora - inicio)
+        if permitidos is None or permitidos - previos > self.capacidad:
+            # Balde lleno (o nuevo): se mueve el origen del relleno para no
+            # acumular más de `capacidad` tokens durante los ratos sin envíos
+            cache.set(inicio_key, ahora - previos / self.tasa, timeout=None)
+            permitidos = previos + self.capacidad
+
+        concedidos = max(0, min(cantidad, math.floor(permitidos) - previos))
+        if concedidos == cantidad:
+            return concedidos, 0
+        try:
+            cache.decr(consumidos_key, cantidad - concedidos)
+        except ValueError:
+            pass
+        return concedidos, (previos + concedidos + 1 - permitidos) / self.tasa
+
+
+def _clave(remitente):
+    return hashlib.sha1(f"{remitente.host}:{remitente.port}:{remitente.username}".encode()).hexdigest()[:16]
+
+
+def limite_para(remitente):
+    """(LimiteDeEnvio, clave del balde) del remitente, o (None, None) si no tiene límite."""
+    if remitente.host is None:
+        return None, None
+    if remitente.clave == remitente_del_sistema().clave:
+        if not LIMITE_SISTEMA_POR_MINUTO:
+            return None, None
+        return LimiteDeEnvio(RAFAGA, LIMITE_SISTEMA_POR_MINUTO), _clave(remitente)
+    return LimiteDeEnvio(RAFAGA, LIMITE_POR_MINUTO), _clave(remitente)
+
+
+def tomar_tokens(remitente, cantidad=1):
+    """(concedidos, espera) para enviar `cantidad` emails como `remitente`."""
+    limite, clave = limite_para(remitente)
+    if limite is None:
+        return cantidad, 0
+    return limite.tomar(clave, cantidad)
@@ -0,0 +1,161 @@
+# apps/agenda/listados.py
+"""
+Listado de turnos del profesional (mis-turnos) paginado por keyset.
+
+Las páginas se recorren en orden (start_time, id) y el cursor opaco guarda la
+última fila entregada: cada página es un rango sobre el índice
+(nutricionista, start_time), sin OFFSET, así que la página 500 cuesta lo mismo
+que la primera. Para exportaciones, exportar_json recorre el rango completo de
+a LOTE_EXPORTACION filas y lo emite como un único array JSON, sin cargarlo
+entero en memoria.
+
+El calendario usa proyectar_calendario: filas armadas en la base con
+values()/annotate(), sin instanciar modelos ni pasar por DRF (ver el
+benchmark de listados en benchmarks.py).
+"""
+import datetime
+
+from django.db.models import Case, CharField, Q, Value, When
+from django.db.models.fields.json import KT
+from django.db.models.functions import Coalesce, Concat, NullIf, Trim
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.renderers import JSONRenderer
+
+from apps.user.models import TipoConsulta
+from .cursores import CursorInvalido, codificar_cursor, decodificar_cursor
+from .models import Turno
+
+
+LIMITE_POR_DEFECTO = 200
+LIMITE_MAXIMO = 1000
+
+# Filas por consulta al exportar
+LOTE_EXPORTACION = 500
+
+# Ventana por defecto cuando no se piden fechas: el último mes y los próximos dos
+VENTANA_PASADO = datetime.timedelta(days=30)
+VENTANA_FUTURO = datetime.timedelta(days=60)
+
+
+def ventana_por_defecto(desde=None, hasta=None, now=None):
+    """Completa los extremos que no se pidieron con la ventana por defecto."""
+    now = now or timezone.now()
+    if desde is None:
+        desde = now - VENTANA_PASADO
+    if hasta is None:
+        hasta = max(now, desde) + VENTANA_FUTURO
+    return desde, hasta
+
+
+def turnos_de_agenda(nutricionista):
+    """
+    Turnos del profesional listos para TurnoAgendaSerializer: trae en la misma
+    consulta todas las relaciones que serializa (sin consultas por fila).
+    """
+    return Turno.objects.filter(nutricionista=nutricionista).select_related(
+        'nutricionista__user', 'paciente__user', 'tipo_consulta', 'ubicacion'
+    )
+
+
+# Columnas de una fila del calendario
+CAMPOS_CALENDARIO = (
+    'id', 'start_time', 'end_time', 'state',
+    'paciente_nombre', 'paciente_email', 'ubicacion_nombre', 'tipo_consulta_display',
+)
+
+
+def proyectar_calendario(queryset):
+    """
+    Filas livianas del calendario como dicts: nombre del paciente registrado o,
+    si es un turno público, el nombre (o email) de intake_answers; nombre de la
+    ubicación y tipo de consulta legible, todo resuelto en la misma consulta.
+    """
+    nombre_registrado = NullIf(
+        Trim(Concat('paciente__nombre', Value(' '), 'paciente__apellido', output_field=CharField())),
+        Value(''),
+    )
+    return queryset.annotate(
+        paciente_nombre=Coalesce(
+            nombre_registrado,
+            NullIf(KT('intake_answers__nombre_completo'), Value('')),
+            KT('intake_answers__email'),
+            Value(''),
+            output_field=CharField(),
+        ),
+        paciente_email=Coalesce('paciente__user__email', KT('intake_answers__email'), output_field=CharField()),
+        ubicacion_nombre=Coalesce('ubicacion__nombre', Value(''), output_field=CharField()),
+        tipo_consulta_display=Case(
+            *[When(tipo_consulta__tipo=valor, then=Value(etiqueta)) for valor, etiqueta in TipoConsulta.choices],
+            default='tipo_consulta__tipo',
+            output_field=CharField(),
+        ),
+    ).values(*CAMPOS_CALENDARIO)
+
+
+def _cursor_de(fila):
+    # Instancias de Turno o filas de proyectar_calendario
+    if isinstance(fila, dict):
+        start_time, turno_id = fila['start_time'], fila['id']
+    else:
+        start_time, turno_id = fila.start_time, fila.id
+    return codificar_cursor({'t': start_time.isoformat(), 'id': turno_id})
+
+
+def _desde_cursor(queryset, cursor):
+    """Filas estrictamente posteriores a la posición (start_time, id) del cursor."""
+    datos = decodificar_cursor(cursor)
+    try:
+        start_time = parse_datetime(datos['t'])
+        turno_id = int(datos['id'])
+    except (KeyError, TypeError, ValueError) as exc:
+        raise CursorInvalido("Cursor inválido.") from exc
+    if start_time is None or timezone.is_naive(start_time):
+        raise CursorInvalido("Cursor inválido.")
+    return queryset.filter(Q(start_time__gt=start_time) | Q(start_time=start_time, id__gt=turno_id))
+
+
+def pagina(queryset, cursor=None, limite=LIMITE_POR_DEFECTO):
+    """
+    (filas, cursor_siguiente) de una página de `queryset` en orden (start_time,
+    id). cursor_siguiente es None en la última página. Lanza CursorInvalido.
+    """
+    queryset = queryset.order_by('start_time', 'id')
+    if cursor:
+        queryset = _desde_cursor(queryset, cursor)
+    # Una fila de más indica si hay página siguiente sin contar el total
+    filas = list(queryset[:limite + 1])
+    if len(filas) <= limite:
+        return filas, None
+    filas = filas[:limite]
+    return filas, _cursor_de(filas[-1])
+
+
+def iterar_paginas(queryset, lote=None):
+    """Recorre `queryset` completo por keyset, de a `lote` filas por consulta."""
+    lote = lote or LOTE_EXPORTACION
+    cursor = None
+    while True:
+        filas, cursor = pagina(queryset, cursor, lote)
+        if filas:
+            yield filas
+        if cursor is None:
+            return
+
+
+def exportar_json(lotes, serializar):
+    """
+    Emite como un array JSON (en bytes, para StreamingHttpResponse) las filas de
+    `lotes`; `serializar(filas)` retorna la lista de dicts de cada lote.
+    """
+    renderer = JSONRenderer()
+    yield b'['
+    primero = True
+    for filas in lotes:
+        # Sin los corchetes del array de cada lote
+        cuerpo = renderer.render(serializar(filas))[1:-1]
+        if not primero:
+            yield b','
+        yield cuerpo
+        primero = False
+    yield b']'
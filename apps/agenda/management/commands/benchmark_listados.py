@@ -0,0 +1,38 @@
+# apps/agenda/management/commands/benchmark_listados.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.agenda.benchmarks import CANTIDADES_LISTADO_POR_DEFECTO, correr_benchmark_listados
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara los listados de mis-turnos (serializer completo vs. proyección del calendario) "
+        "sobre historiales sintéticos y emite un reporte JSON. No deja datos."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--turnos', type=int, nargs='+', default=list(CANTIDADES_LISTADO_POR_DEFECTO),
+                            help="Tamaños de historial a medir (default: 1000 10000).")
+        parser.add_argument('--repeticiones', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Archivo donde escribir el JSON (default: stdout).")
+
+    def handle(self, *args, **options):
+        if options['repeticiones'] < 1 or any(cantidad < 1 for cantidad in options['turnos']):
+            raise CommandError("--repeticiones y --turnos deben ser positivos.")
+
+        reporte = correr_benchmark_listados(
+            cantidades=options['turnos'],
+            repeticiones=options['repeticiones'],
+            seed=options['seed'],
+        )
+
+        salida = json.dumps(reporte, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as archivo:
+                archivo.write(salida)
+            self.stdout.write(self.style.SUCCESS(f"Reporte guardado en {options['output']}"))
+        else:
+            self.stdout.write(salida)
@@ -0,0 +1,50 @@
+# apps/agenda/management/commands/benchmark_slots.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.agenda.benchmarks import (
+    ESCENARIOS,
+    PERFIL_POR_DEFECTO,
+    VENTANAS_POR_DEFECTO,
+    correr_benchmark,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide el motor de slots (tiempo, consultas y memoria) sobre una agenda sintética "
+        "y emite un reporte JSON. No deja datos: todo se revierte al terminar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, nargs='+', default=list(VENTANAS_POR_DEFECTO),
+                            help="Ventanas a medir, en días (default: 7 31 60).")
+        parser.add_argument('--repeticiones', type=int, default=5)
+        parser.add_argument('--escenario', dest='escenarios', action='append', choices=sorted(ESCENARIOS),
+                            help="Escenario a correr (repetible). Default: todos.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Archivo donde escribir el JSON (default: stdout).")
+        for clave, valor in PERFIL_POR_DEFECTO.items():
+            parser.add_argument(f"--{clave.replace('_', '-')}", dest=clave, type=int, default=valor)
+
+    def handle(self, *args, **options):
+        if options['repeticiones'] < 1 or any(dias < 1 for dias in options['dias']):
+            raise CommandError("--repeticiones y --dias deben ser positivos.")
+
+        perfil = {clave: options[clave] for clave in PERFIL_POR_DEFECTO}
+        reporte = correr_benchmark(
+            perfil=perfil,
+            ventanas=options['dias'],
+            repeticiones=options['repeticiones'],
+            escenarios=options['escenarios'],
+            seed=options['seed'],
+        )
+
+        salida = json.dumps(reporte, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as archivo:
+                archivo.write(salida)
+            self.stdout.write(self.style.SUCCESS(f"Reporte guardado en {options['output']}"))
+        else:
+            self.stdout.write(salida)
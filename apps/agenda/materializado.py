@@ -0,0 +1,260 @@
+# apps/agenda/materializado.py
+"""
+Free/busy materializado por día (modelo DisponibilidadDia).
+
+En lugar de derivar la disponibilidad en cada request, se persisten por
+(nutricionista, ubicación, día) las ventanas de atención con sus intervalos
+libres. Leer un rango es entonces un solo scan por índice más el corte en slots
+de los intervalos libres.
+
+Las filas se calculan la primera vez que se leen y después se mantienen
+incrementalmente desde signals.py, recalculando solo los días afectados. Una
+lectura nunca pisa una fila existente: si materializó un día con datos previos
+a un cambio que se confirmó en el medio, la fila que vale es la del refresco.
+"""
+import bisect
+import datetime
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from .availability import (
+    ESTADOS_OCUPAN_SLOT,
+    cargar_disponibilidades,
+    cortar_ventana,
+    en_ventana,
+    filtrar_libres,
+    fusionar_intervalos,
+    limites_del_rango,
+    zona_horaria,
+)
+from .models import BloqueoDisponibilidad, DisponibilidadDia, Turno, TurnoState, Ubicacion
+
+
+logger = logging.getLogger(__name__)
+
+
+def _restar(inicio, fin, ocupados, fines):
+    """Intervalos libres de [inicio, fin) descontando `ocupados` (fusionados y ordenados)."""
+    libres = []
+    cursor = inicio
+    # Primer ocupado que termina después del inicio de la ventana
+    for i in range(bisect.bisect_right(fines, inicio), len(ocupados)):
+        ocupado_inicio, ocupado_fin = ocupados[i]
+        if ocupado_inicio >= fin:
+            break
+        if ocupado_inicio > cursor:
+            libres.append([cursor, ocupado_inicio])
+        cursor = max(cursor, ocupado_fin)
+    if cursor < fin:
+        libres.append([cursor, fin])
+    return libres
+
+
+def materializar_dias(nutricionista, ubicacion_id, fechas, now=None, sobrescribir=True):
+    """
+    Recalcula y guarda las filas DisponibilidadDia de los días indicados.
+    Con sobrescribir=False solo inserta los días que siguen sin fila.
+
+    Cuesta siempre las mismas consultas (disponibilidades, bloqueos, turnos y
+    el upsert), sin importar cuántos días se pidan. Los turnos ocupan su
+    busy_range guardado, así las filas no dependen de los buffers actuales.
+    Retorna {fecha: DisponibilidadDia}.
+    """
+    fechas = sorted(set(fechas))
+    if not fechas:
+        return {}
+
+    now = now or timezone.now()
+    nutricionista_id = getattr(nutricionista, 'id', nutricionista)
+
+    disponibilidades_por_dia = cargar_disponibilidades(nutricionista_id, ubicacion_id)
+    # Todas las filas son de una misma ubicación: los días se cortan en su zona horaria
+    una_disponibilidad = next((d[0] for d in disponibilidades_por_dia.values() if d), None)
+    tz = zona_horaria(getattr(una_disponibilidad, 'ubicacion_tz', None))
+    rango_inicio, rango_fin = limites_del_rango(fechas[0], fechas[-1], tz)
+
+    firmes = list(BloqueoDisponibilidad.objects.filter(
+        nutricionista_id=nutricionista_id,
+        ubicacion_id=ubicacion_id,
+        start_time__lt=rango_fin,
+        end_time__gt=rango_inicio,
+    ).values_list('start_time', 'end_time'))
+
+    holds = []
+    turnos = Turno.objects.filter(
+        nutricionista_id=nutricionista_id,
+        ubicacion_id=ubicacion_id,
+        busy_range__overlap=(rango_inicio, rango_fin),
+        state__in=ESTADOS_OCUPAN_SLOT + [TurnoState.TENTATIVO],
+    ).values_list('busy_range', 'state', 'soft_hold_expires_at')
+    for busy_range, state, expira in turnos:
+        rango = (busy_range.lower, busy_range.upper)
+        if state != TurnoState.TENTATIVO:
+            firmes.append(rango)
+        elif expira and expira > now:
+            holds.append((rango[0], rango[1], expira))
+
+    firmes = fusionar_intervalos(firmes)
+    fines = [fin for _, fin in firmes]
+
+    filas = []
+    for fecha in fechas:
+        dia_inicio, dia_fin = limites_del_rango(fecha, fecha, tz)
+        ventanas = []
+        disponibilidades = sorted(
+            disponibilidades_por_dia.get(fecha.weekday(), ()), key=lambda d: d.hora_inicio
+        )
+        for disp in disponibilidades:
+            inicio = timezone.make_aware(datetime.datetime.combine(fecha, disp.hora_inicio), tz)
+            fin = timezone.make_aware(datetime.datetime.combine(fecha, disp.hora_fin), tz)
+            ventanas.append({
+                'inicio': inicio.isoformat(),
+                'fin': fin.isoformat(),
+                'libres': [[a.isoformat(), b.isoformat()] for a, b in _restar(inicio, fin, firmes, fines)],
+            })
+
+        filas.append(DisponibilidadDia(
+            nutricionista_id=nutricionista_id,
+            ubicacion_id=ubicacion_id,
+            fecha=fecha,
+            ventanas=ventanas,
+            holds=[
+                [a.isoformat(), b.isoformat(), expira.isoformat()]
+                for a, b, expira in holds
+                if a < dia_fin and b > dia_inicio
+            ],
+        ))
+
+    if sobrescribir:
+        DisponibilidadDia.objects.bulk_create(
+            filas,
+            update_conflicts=True,
+            unique_fields=['nutricionista', 'ubicacion', 'fecha'],
+            update_fields=['ventanas', 'holds', 'actualizado_en'],
+        )
+    else:
+        # Si otra lectura o un refresco guardó el día en el medio, queda su fila
+        DisponibilidadDia.objects.bulk_create(filas, ignore_conflicts=True)
+    return {fila.fecha: fila for fila in filas}
+
+
+def slots_materializados(nutricionista, start_date, end_date, ubicacion_id, config, now,
+                         incluir_pasados=False, reserva=None):
+    """
+    Slots del rango leídos de DisponibilidadDia (un scan por índice).
+    Los días que todavía no tienen fila se materializan en el momento.
+    Con `reserva` (ventana desde, hasta) solo se devuelven slots que empiezan dentro de ella.
+    """
+    filas = {
+        fila.fecha: fila
+        for fila in DisponibilidadDia.objects.filter(
+            nutricionista=nutricionista,
+            ubicacion_id=ubicacion_id,
+            fecha__range=(start_date, end_date),
+        )
+    }
+    fechas = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    faltantes = [fecha for fecha in fechas if fecha not in filas]
+    if faltantes:
+        filas.update(materializar_dias(nutricionista, ubicacion_id, faltantes, now, sobrescribir=False))
+
+    parse = datetime.datetime.fromisoformat
+    candidatos = []
+    ocupados = []
+    for fila in filas.values():
+        for ventana in fila.ventanas:
+            inicio, fin = parse(ventana['inicio']), parse(ventana['fin'])
+            candidatos.extend(cortar_ventana(inicio, fin, config))
+            # Lo que no está libre dentro de la ventana está ocupado
+            cursor = inicio
+            for libre_inicio, libre_fin in ventana['libres']:
+                libre_inicio = parse(libre_inicio)
+                if libre_inicio > cursor:
+                    ocupados.append((cursor, libre_inicio))
+                cursor = parse(libre_fin)
+            if cursor < fin:
+                ocupados.append((cursor, fin))
+        for hold_inicio, hold_fin, expira in fila.holds:
+            if parse(expira) > now:
+                ocupados.append((parse(hold_inicio), parse(hold_fin)))
+
+    if reserva:
+        candidatos = en_ventana(candidatos, *reserva)
+    if not candidatos:
+        return []
+    return filtrar_libres(candidatos, fusionar_intervalos(ocupados), now, incluir_pasados)
+
+
+def _dias_de_intervalos(ubicacion_id, intervalos):
+    """Días, en la zona de la ubicación, que tocan los intervalos [inicio, fin) de `intervalos`."""
+    nombre_tz = Ubicacion.objects.filter(pk=ubicacion_id).values_list('timezone', flat=True).first()
+    if nombre_tz is None:
+        return set()  # la ubicación se borró con sus turnos
+    tz = zona_horaria(nombre_tz)
+    dias = set()
+    for inicio, fin in intervalos:
+        dia, ultimo = timezone.localtime(inicio, tz).date(), timezone.localtime(fin, tz).date()
+        while dia <= ultimo:
+            dias.add(dia)
+            dia += datetime.timedelta(days=1)
+    return dias
+
+
+def refrescar_dias(nutricionista_id, ubicacion_id=None, desde=None, hasta=None, dia_semana=None, intervalos=None):
+    """
+    Recalcula las filas afectadas por un cambio (al confirmar su transacción).
+
+    Filtra por ubicación (o todas), rango de fechas (nunca hacia atrás de hoy) o
+    instantes (`intervalos`: pares [inicio, fin), p. ej. el rango de un turno,
+    que se pasan a días en la zona de la ubicación) y, opcionalmente, día de la
+    semana. Con días acotados (un turno, un bloqueo) guarda todos esos días,
+    tengan fila o no: una lectura concurrente que los calculó antes del cambio
+    ya no puede dejar su fila vieja (ver materializar_dias). Sin rango (horario
+    semanal, zona horaria) recalcula solo las filas existentes; los días sin
+    fila se calcularán al leerlos.
+    """
+    fechas = None
+    if intervalos is not None:
+        fechas = _dias_de_intervalos(ubicacion_id, intervalos)
+    # Hoy en la zona más atrasada: ninguna va más de un día detrás del servidor
+    hoy = timezone.localdate() - datetime.timedelta(days=1)
+    desde = max(desde or hoy, hoy)
+    if hasta and fechas is None:
+        fechas = [desde + datetime.timedelta(days=i) for i in range((hasta - desde).days + 1)]
+
+    por_ubicacion = {}
+    if fechas is not None:
+        fechas = sorted(fecha for fecha in set(fechas) if fecha >= desde)
+        if dia_semana is not None:
+            fechas = [fecha for fecha in fechas if fecha.weekday() == dia_semana]
+        if not fechas:
+            return
+        ubicaciones = [ubicacion_id] if ubicacion_id else Ubicacion.objects.filter(
+            nutricionista_id=nutricionista_id
+        ).values_list('id', flat=True)
+        for ubicacion in ubicaciones:
+            por_ubicacion[ubicacion] = fechas
+    else:
+        existentes = DisponibilidadDia.objects.filter(nutricionista_id=nutricionista_id, fecha__gte=desde)
+        if ubicacion_id:
+            existentes = existentes.filter(ubicacion_id=ubicacion_id)
+        if dia_semana is not None:
+            existentes = existentes.filter(fecha__iso_week_day=dia_semana + 1)
+        for ubicacion, fecha in existentes.values_list('ubicacion_id', 'fecha'):
+            por_ubicacion.setdefault(ubicacion, []).append(fecha)
+
+    for ubicacion, fechas in por_ubicacion.items():
+        try:
+            with transaction.atomic():
+                materializar_dias(nutricionista_id, ubicacion, fechas)
+        except Exception:
+            # Mejor recalcular al leer que servir un free/busy desactualizado
+            logger.exception(
+                "No se pudo refrescar DisponibilidadDia (nutricionista %s, ubicación %s); se descartan las filas.",
+                nutricionista_id, ubicacion,
+            )
+            DisponibilidadDia.objects.filter(
+                nutricionista_id=nutricionista_id, ubicacion_id=ubicacion, fecha__in=fechas
+            ).delete()
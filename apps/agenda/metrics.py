@@ -0,0 +1,52 @@
+# apps/agenda/metrics.py
+"""
+Métricas operativas de la agenda.
+
+Sin dependencias extra: cada métrica se escribe como línea de log estructurada
+(logger `apps.agenda.metrics`, fácil de levantar desde el agregador de logs) y,
+en el caso de los contadores, se acumula en la caché de Django para poder
+consultarla desde cualquier proceso (con Redis como CACHE_URL los comparten
+web y workers de Celery).
+"""
+import logging
+
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+METRICA_KEY = 'agenda:metricas:{nombre}'
+
+
+def _clave(nombre, etiquetas):
+    if etiquetas:
+        nombre += ':' + ','.join(f'{k}={v}' for k, v in sorted(etiquetas.items()))
+    return METRICA_KEY.format(nombre=nombre)
+
+
+def _log(tipo, nombre, valor, etiquetas):
+    extras = ' '.join(f'{k}={v}' for k, v in sorted(etiquetas.items()))
+    logger.info(f"metric={nombre} type={tipo} value={valor} {extras}".rstrip())
+
+
+def incrementar(nombre, valor=1, **etiquetas):
+    """Suma `valor` al contador `nombre` (con sus etiquetas) y lo registra en el log."""
+    clave = _clave(nombre, etiquetas)
+    cache.add(clave, 0, timeout=None)
+    try:
+        cache.incr(clave, valor)
+    except ValueError:
+        # La clave fue desalojada entre add e incr
+        cache.set(clave, valor, timeout=None)
+    _log('counter', nombre, valor, etiquetas)
+
+
+def observar(nombre, valor, **etiquetas):
+    """Registra una medición puntual (duración, tamaño de lote, ...); guarda la última."""
+    cache.set(_clave(nombre, etiquetas), valor, timeout=None)
+    _log('gauge', nombre, valor, etiquetas)
+
+
+def valor(nombre, **etiquetas):
+    """Valor acumulado del contador (o última medición) de `nombre`; 0 si no hay."""
+    return cache.get(_clave(nombre, etiquetas), 0)
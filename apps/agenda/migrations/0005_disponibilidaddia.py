@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0004_alter_notificationlog_sent_at'),
+        ('user', '0007_merge_20251031_2052'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DisponibilidadDia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fecha', models.DateField()),
+                ('ventanas', models.JSONField(blank=True, default=list)),
+                ('holds', models.JSONField(blank=True, default=list)),
+                ('actualizado_en', models.DateTimeField(auto_now=True)),
+                ('nutricionista', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disponibilidad_dias', to='user.nutricionista')),
+                ('ubicacion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disponibilidad_dias', to='agenda.ubicacion')),
+            ],
+            options={
+                'unique_together': {('nutricionista', 'ubicacion', 'fecha')},
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:40
+
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+from django.db import migrations, models
+
+
+# Rango ocupado de los turnos existentes: slot más los buffers de su tipo de consulta
+BACKFILL_BUSY_RANGE = """
+UPDATE agenda_turno AS t
+SET busy_range = tstzrange(
+    t.start_time - make_interval(mins => c.buffer_before_min),
+    t.end_time + make_interval(mins => c.buffer_after_min),
+    '[)'
+)
+FROM agenda_tipoconsultaconfig AS c
+WHERE c.id = t.tipo_consulta_id;
+"""
+
+# Los holds vencidos ya no ocupan agenda pero entrarían en la nueva restricción
+CANCELAR_HOLDS_VENCIDOS = """
+UPDATE agenda_turno
+SET state = 'CANCELADO', updated_at = now()
+WHERE state = 'TENTATIVO' AND soft_hold_expires_at <= now();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0005_disponibilidaddia'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='turno',
+            name='busy_range',
+            field=django.contrib.postgres.fields.ranges.DateTimeRangeField(help_text='Slot más los buffers del tipo de consulta: lo que el turno ocupa de la agenda', null=True),
+        ),
+        migrations.RunSQL(BACKFILL_BUSY_RANGE, migrations.RunSQL.noop),
+        migrations.RunSQL(CANCELAR_HOLDS_VENCIDOS, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='turno',
+            name='busy_range',
+            field=django.contrib.postgres.fields.ranges.DateTimeRangeField(help_text='Slot más los buffers del tipo de consulta: lo que el turno ocupa de la agenda'),
+        ),
+        migrations.RemoveConstraint(
+            model_name='turno',
+            name='no_overlap_por_prof_y_ubic',
+        ),
+        # Si quedan turnos activos que se pisan (buffers incluidos) esta operación
+        # falla indicando las filas en conflicto: hay que resolverlas a mano.
+        migrations.AddConstraint(
+            model_name='turno',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('state__in', ['RESERVADO', 'CONFIRMADO', 'ATENDIDO']), models.Q(('soft_hold_expires_at__isnull', False), ('state', 'TENTATIVO')), _connector='OR'), expressions=[(models.F('nutricionista'), '='), (models.F('ubicacion'), '='), (models.F('busy_range'), '&&')], name='turno_busy_range_sin_solape'),
+        ),
+    ]
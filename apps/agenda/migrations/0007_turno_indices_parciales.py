@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0006_turno_busy_range'),
+        ('user', '0007_merge_20251031_2052'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='turno',
+            index=models.Index(condition=models.Q(('state__in', ['RESERVADO', 'CONFIRMADO', 'ATENDIDO']), models.Q(('soft_hold_expires_at__isnull', False), ('state', 'TENTATIVO')), _connector='OR'), fields=['nutricionista', 'start_time'], name='turno_vivo_nutri_inicio_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='turno',
+            index=models.Index(condition=models.Q(('soft_hold_expires_at__isnull', False), ('state', 'TENTATIVO')), fields=['soft_hold_expires_at'], name='turno_hold_vencimiento_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0008_claveidempotencia'),
+        ('user', '0007_merge_20251031_2052'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationlog',
+            name='published_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notificationlog',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='notificationlog',
+            index=models.Index(condition=models.Q(('sent_at__isnull', True)), fields=['published_at'], name='notificacion_pendiente_idx'),
+        ),
+    ]
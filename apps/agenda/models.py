@@ -3,7 +3,8 @@ from uuid import uuid4
 from datetime import timedelta
 
 from django.conf import settings
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
 from django.utils import timezone
 
 # Postgres-specific
@@ -161,6 +162,29 @@ class BloqueoDisponibilidad(models.Model):
         return f"Bloqueo {self.nutricionista.full_name}: {self.start_time} - {self.end_time} ({self.ubicacion.nombre})"
 
 
+class DisponibilidadDia(models.Model):
+    """
+    Free/busy materializado por (nutricionista, ubicación, día).
+
+    Guarda las ventanas de atención del día con sus intervalos libres ya
+    descontados bloqueos y turnos firmes (con buffers). Los soft-holds se guardan
+    aparte con su vencimiento para poder ignorarlos al leer cuando expiran.
+    Se mantiene incrementalmente desde signals.py (ver materializado.py).
+    """
+    nutricionista = models.ForeignKey(Nutricionista, on_delete=models.CASCADE, related_name="disponibilidad_dias")
+    ubicacion = models.ForeignKey(Ubicacion, on_delete=models.CASCADE, related_name="disponibilidad_dias")
+    fecha = models.DateField()
+    ventanas = models.JSONField(default=list, blank=True)  # [{"inicio", "fin", "libres": [[inicio, fin], ...]}]
+    holds = models.JSONField(default=list, blank=True)     # [[inicio, fin, expira], ...]
+    actualizado_en = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("nutricionista", "ubicacion", "fecha")
+
+    def __str__(self):
+        return f"Free/busy {self.nutricionista_id} @ {self.ubicacion_id} {self.fecha}"
+
+
 # ────────────────────────────────────────────────────────────────────────────────
 # 5) Obra social (catálogo por profesional) + snapshot en turno
 # ────────────────────────────────────────────────────────────────────────────────
@@ -197,11 +221,59 @@ class PaymentState(models.TextChoices):
     REFUNDED = "REFUNDED", "Reembolsado"
     FEE_CHARGED = "FEE_CHARGED", "No-show cobrado"
 
+# Turnos que ocupan agenda a nivel base: estados activos y holds con vencimiento
+# (los vencidos los cancela la tarea periódica; ver booking.cancelar_holds_vencidos).
+# Condición de la restricción de solapes y del índice parcial de turnos vivos.
+TURNO_OCUPA_AGENDA = (
+    models.Q(state__in=[TurnoState.RESERVADO, TurnoState.CONFIRMADO, TurnoState.ATENDIDO]) |
+    models.Q(state=TurnoState.TENTATIVO, soft_hold_expires_at__isnull=False)
+)
+
+# Máquina de estados del turno: estado destino -> estados desde los que se llega.
+# Todo cambio de estado pasa por Turno.transicionar / TurnoQuerySet.transicionar,
+# que lo aplican como un UPDATE condicional sobre esta tabla.
+TRANSICIONES_TURNO = {
+    TurnoState.RESERVADO: frozenset({TurnoState.TENTATIVO}),    # verificación del magic link
+    TurnoState.CONFIRMADO: frozenset({TurnoState.TENTATIVO}),   # aprobación del profesional
+    TurnoState.CANCELADO: frozenset({TurnoState.TENTATIVO, TurnoState.RESERVADO, TurnoState.CONFIRMADO}),
+    TurnoState.ATENDIDO: frozenset({TurnoState.RESERVADO, TurnoState.CONFIRMADO}),
+    TurnoState.AUSENTE: frozenset({TurnoState.RESERVADO, TurnoState.CONFIRMADO}),
+}
+
+class TurnoQuerySet(models.QuerySet):
+    def transicionar(self, destino, now=None, **cambios):
+        """
+        Pasa a `destino` los turnos del queryset cuyo estado lo permite (ver
+        TRANSICIONES_TURNO); los demás quedan como están. Bloquea las filas, las
+        actualiza en un solo UPDATE (state, updated_at y `cambios`) y retorna los
+        ids que cambiaron. Pensado para acciones en lote y tareas periódicas.
+        """
+        from .signals import turnos_modificados
+
+        now = now or timezone.now()
+        with transaction.atomic():
+            filas = list(
+                self.filter(state__in=TRANSICIONES_TURNO[destino]).select_for_update().values_list(
+                    'id', 'nutricionista_id', 'ubicacion_id', 'busy_range'
+                )
+            )
+            if not filas:
+                return []
+            self.model.objects.filter(pk__in=[fila[0] for fila in filas]).update(
+                state=destino, updated_at=now, **cambios
+            )
+        # update() no dispara señales
+        turnos_modificados([fila[1:] for fila in filas])
+        return [fila[0] for fila in filas]
+
 class Turno(models.Model):
     """
     Cita agendada. Usa un campo de rango para exclusión de solapes por (nutricionista, ubicación).
     Requiere extensión btree_gist para el ExclusionConstraint.
     """
+    # Nombre de la restricción de solapes (para reconocer su IntegrityError)
+    RESTRICCION_SOLAPE = "turno_busy_range_sin_solape"
+
     nutricionista = models.ForeignKey(Nutricionista, on_delete=models.PROTECT, related_name="turnos")
     paciente = models.ForeignKey(Paciente, on_delete=models.PROTECT, related_name="turnos", null=True, blank=True)
 
@@ -215,6 +287,7 @@ class Turno(models.Model):
     start_time = models.DateTimeField()
     end_time = models.DateTimeField()
     slot = DateTimeRangeField(help_text="Rango horario [start, end) para constraints")
+    busy_range = DateTimeRangeField(help_text="Slot más los buffers del tipo de consulta: lo que el turno ocupa de la agenda")
 
     # Estados
     state = models.CharField(max_length=16, choices=TurnoState.choices, default=TurnoState.RESERVADO)
@@ -236,23 +309,41 @@ class Turno(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TurnoQuerySet.as_manager()
+
     class Meta:
         ordering = ["start_time"]
         indexes = [
             models.Index(fields=["nutricionista", "start_time"]),
             models.Index(fields=["ubicacion", "start_time"]),
             models.Index(fields=["state"]),
+            # Las consultas de slots y solapes solo recorren turnos vivos
+            models.Index(
+                fields=["nutricionista", "start_time"],
+                name="turno_vivo_nutri_inicio_idx",
+                condition=TURNO_OCUPA_AGENDA,
+            ),
+            # Holds pendientes de vencer, en el orden en que los cancela la tarea periódica
+            models.Index(
+                fields=["soft_hold_expires_at"],
+                name="turno_hold_vencimiento_idx",
+                condition=models.Q(state=TurnoState.TENTATIVO, soft_hold_expires_at__isnull=False),
+            ),
         ]
         constraints = [
-            # Evita solapamientos por nutricionista+ubicación (requiere btree_gist)
+            # Evita solapamientos (buffers incluidos) por nutricionista+ubicación entre
+            # turnos activos; requiere btree_gist. Los holds vencidos siguen contando
+            # hasta que se cancelan, y los TENTATIVO sin vencimiento (solicitudes a
+            # aprobar) recién cuentan al confirmarse.
             ExclusionConstraint(
-                name="no_overlap_por_prof_y_ubic",
+                name="turno_busy_range_sin_solape",  # Turno.RESTRICCION_SOLAPE
                 expressions=[
                     (models.F("nutricionista"), RangeOperators.EQUAL),
                     (models.F("ubicacion"), RangeOperators.EQUAL),
-                    (models.F("slot"), RangeOperators.OVERLAPS),
+                    (models.F("busy_range"), RangeOperators.OVERLAPS),
                 ],
                 index_type="GIST",
+                condition=TURNO_OCUPA_AGENDA,
             )
         ]
 
@@ -260,12 +351,51 @@ class Turno(models.Model):
         who = self.paciente.full_name if self.paciente_id else "—"
         return f"{self.nutricionista.full_name} con {who} @ {self.start_time}"
 
+    def transicionar(self, destino, now=None, **cambios):
+        """
+        Aplica la transición a `destino` con un único UPDATE ... WHERE state IN
+        (orígenes), que escribe solo state, updated_at y `cambios`. Retorna False
+        si el estado ya no lo permitía (p. ej. otro request lo cambió antes), sin
+        tocar la instancia.
+        """
+        from .signals import turnos_modificados
+
+        now = now or timezone.now()
+        valores = {'state': destino, 'updated_at': now, **cambios}
+        aplicada = type(self).objects.filter(
+            pk=self.pk, state__in=TRANSICIONES_TURNO[destino]
+        ).update(**valores)
+        if not aplicada:
+            return False
+        for campo, valor in valores.items():
+            setattr(self, campo, valor)
+        # update() no dispara señales
+        turnos_modificados([(self.nutricionista_id, self.ubicacion_id, self.busy_range)])
+        return True
+
+    @staticmethod
+    def calcular_busy_range(start_time, end_time, tipo_consulta):
+        """
+        Rango [start - buffer_before, end + buffer_after) que ocupa un turno.
+
+        Se fija al guardar: si después cambian los buffers del tipo, el turno
+        conserva los suyos. El motor de slots lee este mismo campo, así ofrece
+        lo mismo que acepta la restricción de solapes.
+        """
+        from psycopg.types.range import Range
+        return Range(
+            start_time - timedelta(minutes=tipo_consulta.buffer_before_min),
+            end_time + timedelta(minutes=tipo_consulta.buffer_after_min),
+            bounds='[)',
+        )
+
     def save(self, *args, **kwargs):
-        # Mantener 'slot' consistente con start_time/end_time
+        # Mantener 'slot' y 'busy_range' consistentes con start_time/end_time
         if self.start_time and self.end_time:
             # Rango semiabierto: [start, end) - debe ser un Range object
             from psycopg.types.range import Range
             self.slot = Range(self.start_time, self.end_time, bounds='[)')
+            self.busy_range = self.calcular_busy_range(self.start_time, self.end_time, self.tipo_consulta)
         super().save(*args, **kwargs)
 
 
@@ -370,11 +500,20 @@ class NotificationLog(models.Model):
     template = models.CharField(max_length=64)  # ej: booking_confirmation, reminder_24h, reminder_3h, offer_waitlist
     payload = models.JSONField(default=dict, blank=True)
     sent_at = models.DateTimeField(null=True, blank=True)  # Se establece cuando realmente se envía
+    published_at = models.DateTimeField(null=True, blank=True)  # Publicado en la cola por el outbox (notificaciones.py)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # Tomado por una tarea de envío (ver tasks.RECLAMO_VENCE)
     delivered = models.BooleanField(default=False)
     delivery_meta = models.JSONField(default=dict, blank=True)
 
     class Meta:
-        indexes = [models.Index(fields=["channel", "template", "sent_at"])]
+        indexes = [
+            models.Index(fields=["channel", "template", "sent_at"]),
+            # Outbox: pendientes de envío por fecha de publicación
+            models.Index(
+                fields=["published_at"], condition=models.Q(sent_at__isnull=True),
+                name="notificacion_pendiente_idx",
+            ),
+        ]
 
 
 class MagicAction(models.TextChoices):
@@ -441,3 +580,31 @@ class CalendarEventLink(models.Model):
     external_event_id = models.CharField(max_length=255, db_index=True)
     external_etag = models.CharField(max_length=255, blank=True)  # para detectar cambios
     last_synced_at = models.DateTimeField(auto_now=True)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# 11) Idempotencia de las reservas públicas (header Idempotency-Key)
+# ────────────────────────────────────────────────────────────────────────────────
+
+class ClaveIdempotencia(models.Model):
+    """
+    Respuesta ya dada a un POST con Idempotency-Key. Un reintento con la misma
+    clave (doble click, reintento del celular) recibe la respuesta original con
+    una búsqueda por índice, sin volver a crear turno, token ni email.
+    Las filas vencen a las AGENDA_IDEMPOTENCIA_TTL_HORAS (ver idempotencia.py).
+    """
+    endpoint = models.CharField(max_length=32)
+    clave = models.CharField(max_length=255)
+    huella = models.CharField(max_length=64)  # sha256 del body: misma clave con otro pedido es un error
+    status_code = models.PositiveSmallIntegerField(null=True)  # null mientras el pedido está en curso
+    respuesta = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["endpoint", "clave"], name="clave_idempotencia_unica"),
+        ]
+        indexes = [models.Index(fields=["expires_at"])]
+
+    def __str__(self):
+        return f"{self.endpoint}:{self.clave}"
@@ -0,0 +1,140 @@
+# apps/agenda/notificaciones.py
+"""
+Outbox transaccional de notificaciones por email.
+
+Las vistas no encolan tareas: con notificar() guardan los NotificationLog en la
+misma transacción que el cambio que avisan y, al confirmarse, el despachador
+(publicar) los publica agrupados por remitente y prioridad, de a LOTE_ENVIO por
+mensaje, en la cola de Celery de esa prioridad (ver colas.py). El worker envía
+cada lote por una sola sesión SMTP (tasks.send_notification_emails_batch). Si la transacción se revierte, los logs
+desaparecen con ella y no sale ningún email.
+
+Publicar marca published_at, y lo vuelve a limpiar si el broker rechaza el lote.
+Los logs que nunca se publicaron (el proceso murió antes del on_commit, el broker
+no estaba disponible) o que siguen sin enviarse REPUBLICAR_DESPUES después de
+publicados (el broker perdió el mensaje, el worker murió) los retoma la tarea
+periódica publicar_notificaciones_pendientes. Publicar dos veces no duplica el
+email: la tarea reclama cada log (claimed_at) con FOR UPDATE SKIP LOCKED y solo
+envía los que siguen pendientes y sin reclamar.
+
+Las notificaciones con plantilla desconocida o payload incompleto no se
+publican: notificar() las guarda ya marcadas como fallidas.
+"""
+import datetime
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import NotificationChannel, NotificationLog
+from .colas import CRITICA, cola_de
+from .plantillas import PayloadInvalido, PlantillaDesconocida, prioridad_de, validar_payload
+from .tasks import send_notification_emails_batch
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+LOTE_ENVIO = getattr(settings, 'AGENDA_NOTIFICACIONES_LOTE', 50)
+REPUBLICAR_DESPUES = datetime.timedelta(minutes=10)
+
+# Logs que republica como máximo cada corrida de la tarea periódica
+LIMITE_REPUBLICACION = 1000
+
+
+def notificar(logs):
+    """
+    Guarda los NotificationLog (sin guardar) de `logs` y programa su publicación
+    para cuando se confirme la transacción en curso. Los que no pasan
+    plantillas.validar_payload se guardan ya marcados como fallidos.
+    """
+    if not logs:
+        return []
+    for log in logs:
+        try:
+            validar_payload(log.template, log.payload)
+        except (PlantillaDesconocida, PayloadInvalido) as exc:
+            logger.error(f"Notificación inválida, no se publica: {exc}")
+            log.sent_at = timezone.now()
+            log.delivered = False
+            log.delivery_meta = {**log.delivery_meta, 'error': str(exc)}
+            metrics.incrementar('notificaciones_invalidas', plantilla=log.template)
+    NotificationLog.objects.bulk_create(logs)
+    log_ids = [log.id for log in logs if log.sent_at is None]
+    if log_ids:
+        # robust: un error al publicar no debe convertir en error un cambio ya confirmado
+        transaction.on_commit(lambda: publicar(NotificationLog.objects.filter(pk__in=log_ids)), robust=True)
+    return logs
+
+
+def publicar(logs, now=None):
+    """
+    Toma los logs pendientes de `logs` (queryset), los marca como publicados y
+    encola un mensaje por lote de a lo sumo LOTE_ENVIO logs del mismo remitente
+    y prioridad, en la cola de esa prioridad (los críticos primero). Si el broker
+    rechaza un lote, sus logs vuelven a quedar sin publicar para que los retome
+    publicar_pendientes. Retorna la cantidad de lotes encolados.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        # SKIP LOCKED: si otro despachador ya los está publicando, son suyos
+        filas = list(
+            logs.filter(sent_at__isnull=True)
+            .select_for_update(skip_locked=True)
+            .order_by('id')
+            .values_list('id', 'payload__nutricionista_id', 'template')
+        )
+        if not filas:
+            return 0
+        NotificationLog.objects.filter(pk__in=[log_id for log_id, _, _ in filas]).update(published_at=now)
+
+    grupos = defaultdict(list)
+    for log_id, nutricionista_id, template in filas:
+        grupos[(prioridad_de(template), nutricionista_id)].append(log_id)
+    lotes = 0
+    sin_encolar = []
+    for prioridad, nutricionista_id in sorted(grupos, key=lambda grupo: grupo[0] != CRITICA):
+        log_ids = grupos[(prioridad, nutricionista_id)]
+        for i in range(0, len(log_ids), LOTE_ENVIO):
+            lote = log_ids[i:i + LOTE_ENVIO]
+            try:
+                send_notification_emails_batch.apply_async(args=(lote,), queue=cola_de(prioridad))
+            except Exception:
+                logger.exception(f"No se pudo encolar un lote de {len(lote)} notificaciones")
+                sin_encolar.extend(lote)
+                continue
+            lotes += 1
+    if sin_encolar:
+        NotificationLog.objects.filter(pk__in=sin_encolar, published_at=now).update(published_at=None)
+        metrics.incrementar('notificaciones_publicacion_fallida', len(sin_encolar))
+    metrics.incrementar('notificaciones_publicadas', len(filas) - len(sin_encolar))
+    return lotes
+
+
+def publicar_pendientes(now=None):
+    """Republica los emails sin enviar que no se publicaron o cuya publicación se perdió."""
+    now = now or timezone.now()
+    pendientes = NotificationLog.objects.filter(channel=NotificationChannel.EMAIL).filter(
+        Q(published_at__isnull=True) | Q(published_at__lt=now - REPUBLICAR_DESPUES)
+    )
+    ids = pendientes.filter(sent_at__isnull=True).order_by('id').values_list('id', flat=True)[:LIMITE_REPUBLICACION]
+    return publicar(NotificationLog.objects.filter(pk__in=list(ids)), now)
+
+
+def medir_cola(now=None):
+    """
+    Registra la profundidad del outbox: emails pendientes de envío (publicados o
+    no, incluidos los demorados por límite de envío) y la antigüedad en segundos
+    de la publicación pendiente más vieja.
+    """
+    now = now or timezone.now()
+    cola = NotificationLog.objects.filter(channel=NotificationChannel.EMAIL, sent_at__isnull=True).aggregate(
+        pendientes=Count('id'), mas_vieja=Min('published_at'),
+    )
+    antiguedad = round((now - cola['mas_vieja']).total_seconds()) if cola['mas_vieja'] else 0
+    metrics.observar('notificaciones_pendientes', cola['pendientes'])
+    metrics.observar('notificaciones_pendientes_antiguedad_s', antiguedad)
+    return cola['pendientes'], antiguedad
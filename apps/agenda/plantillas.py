@@ -0,0 +1,115 @@
+# apps/agenda/plantillas.py
+"""
+Registro de plantillas de los emails de notificación.
+
+Cada plantilla vive en templates/agenda/emails/<nombre>/ con tres archivos:
+asunto.txt, cuerpo.txt y cuerpo.html. Se compilan una sola vez por proceso (la
+primera vez que se usan). Su versión es un hash del contenido de los archivos:
+queda registrada en el delivery_meta de cada log enviado y es parte de la clave
+de la caché de renders, así un cambio en los archivos nunca sirve un render
+viejo.
+
+notificar() valida cada payload con validar_payload antes de publicarlo: una
+notificación con plantilla desconocida o a la que le faltan claves se marca
+fallida en el momento, sin llegar a ocupar un worker.
+
+Cada plantilla declara además su prioridad, que decide en qué cola de Celery se
+publican sus lotes (ver colas.py).
+"""
+import hashlib
+import json
+from collections import namedtuple
+from functools import lru_cache
+
+from django.template.loader import get_template
+
+from .colas import CRITICA, MASIVA
+
+
+DIRECTORIO = 'agenda/emails/{nombre}/'
+ARCHIVOS = ('asunto.txt', 'cuerpo.txt', 'cuerpo.html')
+
+class Plantilla(namedtuple('Plantilla', 'claves prioridad')):
+    """Claves del payload que usa la plantilla (además de 'destinatario') y su prioridad (ver colas.py)."""
+    __slots__ = ()
+
+
+PLANTILLAS = {
+    'public_booking_verification': Plantilla(
+        ('nombre_nutri', 'tipo_consulta', 'fecha_hora_inicio', 'verification_url'), CRITICA,
+    ),
+    'public_booking_confirmed_paciente': Plantilla(
+        ('nombre_nutri', 'tipo_consulta', 'fecha_hora_inicio', 'ubicacion_nombre'), CRITICA,
+    ),
+    'public_booking_confirmed_nutri': Plantilla(
+        ('nombre_nutri', 'nombre_paciente', 'tipo_consulta', 'fecha_hora_inicio'), CRITICA,
+    ),
+    # Avisos de las acciones en lote del profesional (hasta MAX_TURNOS_POR_LOTE juntos)
+    'turno_confirmado_paciente': Plantilla(
+        ('nombre_nutri', 'tipo_consulta', 'fecha_hora_inicio', 'ubicacion_nombre'), MASIVA,
+    ),
+    'turno_cancelado_paciente': Plantilla(
+        ('nombre_nutri', 'tipo_consulta', 'fecha_hora_inicio', 'ubicacion_nombre'), MASIVA,
+    ),
+}
+
+
+class PlantillaDesconocida(LookupError):
+    pass
+
+
+class PayloadInvalido(ValueError):
+    pass
+
+
+class EmailRenderizado(namedtuple('EmailRenderizado', 'asunto texto html version')):
+    __slots__ = ()
+
+
+# nombre -> (templates de ARCHIVOS, versión), por proceso
+_compiladas = {}
+
+
+def compilar(nombre):
+    """Templates compilados y versión de la plantilla `nombre` (se cargan una vez)."""
+    if nombre not in PLANTILLAS:
+        raise PlantillaDesconocida(f"Template de email desconocido: {nombre}")
+    compilada = _compiladas.get(nombre)
+    if compilada is None:
+        templates = tuple(get_template(DIRECTORIO.format(nombre=nombre) + archivo) for archivo in ARCHIVOS)
+        fuentes = '\0'.join(template.template.source for template in templates)
+        compilada = _compiladas[nombre] = (templates, hashlib.sha1(fuentes.encode()).hexdigest()[:12])
+    return compilada
+
+
+def validar_payload(nombre, payload):
+    """Lanza PlantillaDesconocida o PayloadInvalido si la notificación no se puede enviar."""
+    if nombre not in PLANTILLAS:
+        raise PlantillaDesconocida(f"Template de email desconocido: {nombre}")
+    # El destinatario tiene que tener valor; el resto alcanza con que esté (puede ir vacío)
+    faltantes = [clave for clave in PLANTILLAS[nombre].claves if clave not in payload]
+    if not payload.get('destinatario'):
+        faltantes.insert(0, 'destinatario')
+    if faltantes:
+        raise PayloadInvalido(f"Faltan claves en el payload de {nombre}: {', '.join(faltantes)}")
+
+
+@lru_cache(maxsize=256)
+def _renderizar(nombre, version, payload_json):
+    templates, _ = compilar(nombre)
+    contexto = json.loads(payload_json)
+    asunto, texto, html = (template.render(contexto) for template in templates)
+    # El asunto va en un header: una sola línea
+    return EmailRenderizado(' '.join(asunto.split()), texto.strip(), html.strip(), version)
+
+
+def renderizar(nombre, payload):
+    """EmailRenderizado de la plantilla `nombre` con `payload`. Lanza PlantillaDesconocida."""
+    _, version = compilar(nombre)
+    return _renderizar(nombre, version, json.dumps(payload, sort_keys=True, default=str))
+
+
+def prioridad_de(nombre):
+    """Prioridad declarada de la plantilla; MASIVA si no está registrada."""
+    plantilla = PLANTILLAS.get(nombre)
+    return plantilla.prioridad if plantilla else MASIVA
@@ -9,6 +9,13 @@ urlpatterns = [
         name='public-slots'
     ),
     
+    # GET /api/public/agenda/busqueda/?especialidad=...&modalidad=...&limit=...
+    path(
+        'busqueda/',
+        views.PublicSlotSearchView.as_view(),
+        name='public-slot-search'
+    ),
+    
     # POST /api/public/agenda/turnos/
     path(
         'turnos/',
@@ -105,6 +105,8 @@ class TimeSlotSerializer(serializers.Serializer):
 # ... (importaciones y serializers existentes)
 from .models import Turno, Ubicacion, TipoConsultaConfig # Asegúrate de importar los modelos necesarios
 from apps.user.serializers import SimpleUserAccountSerializer # Usaremos un serializer simple para paciente/nutri
+from apps.user.models import AsignacionNutricionistaPaciente, Paciente
+from .booking import MAX_OCURRENCIAS_SERIE, MAX_TURNOS_POR_LOTE
 
 
 # ... (TimeSlotSerializer)
@@ -201,37 +203,93 @@ class TurnoSerializer(serializers.ModelSerializer):
         if slot and slot.lower <= timezone.now() and not self.instance: # Solo al crear
              raise serializers.ValidationError("No se pueden solicitar turnos en el pasado.")
 
-        # Validar que no haya turnos ACTIVOS que se solapen (al crear)
-        if slot and not self.instance:
-            from django.db.models import Q
-            
-            # Obtener el nutricionista desde el contexto (será asignado en la vista)
-            nutricionista = self.context.get('nutricionista')
-            ubicacion = data.get('ubicacion')
-            
-            if nutricionista and ubicacion:
-                # Buscar turnos activos (no cancelados) que se solapen
-                overlapping_turnos = Turno.objects.filter(
-                    nutricionista=nutricionista,
-                    ubicacion=ubicacion,
-                    slot__overlap=slot
-                ).exclude(
-                    state=TurnoState.CANCELADO
-                ).filter(
-                    Q(state__in=[TurnoState.RESERVADO, TurnoState.CONFIRMADO, TurnoState.ATENDIDO]) |
-                    (Q(state=TurnoState.TENTATIVO) & Q(soft_hold_expires_at__gt=timezone.now()))
-                )
-                
-                if overlapping_turnos.exists():
-                    raise serializers.ValidationError(
-                        "Este horario ya no está disponible. Por favor seleccione otro horario."
-                    )
+        # Los solapes (buffers incluidos) se validan en la vista contra busy_range
 
         return data
 
     # NOTA: La asignación de 'paciente' y 'nutricionista' se hará en la vista (perform_create).
     #       El estado inicial también se pondrá en la vista.
 
+
+class TurnoAgendaSerializer(TurnoSerializer):
+    """
+    Fila de la agenda del nutricionista (mis-turnos): el turno completo más los
+    datos de visualización del paciente, la ubicación y el tipo de consulta.
+    Espera el queryset de listados.turnos_de_agenda (relaciones ya cargadas).
+    """
+
+    def to_representation(self, turno):
+        data = super().to_representation(turno)
+
+        if turno.paciente:
+            # Paciente registrado en el sistema
+            data['paciente_nombre'] = turno.paciente.nombre
+            data['paciente_apellido'] = turno.paciente.apellido
+        elif turno.intake_answers:
+            # Paciente público (desde turnero público): separar nombre y apellido
+            partes = turno.intake_answers.get('nombre_completo', '').split(' ', 1)
+            data['paciente_nombre'] = partes[0] if len(partes) > 0 else ''
+            data['paciente_apellido'] = partes[1] if len(partes) > 1 else ''
+            data['paciente_email'] = turno.intake_answers.get('email', '')
+            data['paciente_telefono'] = turno.intake_answers.get('telefono', '')
+
+        if turno.ubicacion:
+            data['ubicacion_nombre'] = turno.ubicacion.nombre
+        if turno.tipo_consulta:
+            data['tipo_consulta_display'] = turno.tipo_consulta.get_tipo_display()
+        return data
+
+
+class TurnoLoteSerializer(serializers.Serializer):
+    """Aprobación o cancelación en lote: ids de turnos del nutricionista y estado destino."""
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1, max_value=2**31 - 1),
+        min_length=1,
+        max_length=MAX_TURNOS_POR_LOTE,
+    )
+    estado = serializers.ChoiceField(choices=[TurnoState.CONFIRMADO, TurnoState.CANCELADO])
+
+
+class TurnoSerieSerializer(serializers.Serializer):
+    """
+    Pedido de una serie semanal de turnos (p. ej. seguimientos) que el
+    nutricionista del contexto reserva para un paciente asignado. `slot_inicio`
+    y `slot_fin` son la primera ocurrencia; las demás repiten la misma hora
+    local cada `intervalo_semanas` semanas.
+    """
+    paciente_id = serializers.PrimaryKeyRelatedField(queryset=Paciente.objects.all(), source='paciente')
+    ubicacion_id = serializers.PrimaryKeyRelatedField(queryset=Ubicacion.objects.all(), source='ubicacion')
+    tipo_consulta_id = serializers.PrimaryKeyRelatedField(
+        queryset=TipoConsultaConfig.objects.all(), source='tipo_consulta'
+    )
+    slot_inicio = serializers.DateTimeField()
+    slot_fin = serializers.DateTimeField()
+    repeticiones = serializers.IntegerField(min_value=1, max_value=MAX_OCURRENCIAS_SERIE)
+    intervalo_semanas = serializers.IntegerField(min_value=1, max_value=4, default=1)
+    # Con True se reservan las ocurrencias libres y se informan las demás;
+    # con False (por defecto) una sola ocurrencia en conflicto cancela la serie
+    omitir_conflictos = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        nutricionista = self.context['nutricionista']
+        if data['ubicacion'].nutricionista_id != nutricionista.id:
+            raise serializers.ValidationError("La ubicación no pertenece al nutricionista.")
+        if data['tipo_consulta'].nutricionista_id != nutricionista.id:
+            raise serializers.ValidationError("El tipo de consulta no pertenece al nutricionista.")
+
+        duracion_slot_min = (data['slot_fin'] - data['slot_inicio']).total_seconds() / 60
+        if abs(duracion_slot_min - data['tipo_consulta'].duracion_min) > 1: # Tolerancia de 1 min
+            raise serializers.ValidationError(
+                f"La duración del slot ({duracion_slot_min} min) no coincide con la duración "
+                f"del tipo de consulta ({data['tipo_consulta'].duracion_min} min)."
+            )
+
+        if not AsignacionNutricionistaPaciente.objects.filter(
+            nutricionista=nutricionista, paciente=data['paciente'], activo=True
+        ).exists():
+            raise serializers.ValidationError("El paciente no está asignado al nutricionista.")
+        return data
+
 # ... (TurnoSerializer que crearemos después)
 
 
@@ -328,37 +386,16 @@ class PublicTurnoCreateSerializer(serializers.ModelSerializer):
     def validate(self, attrs):
         # 1. Validar que los objetos pertenecen al nutricionista
         nutri = attrs['nutricionista']
-        if attrs['ubicacion'].nutricionista != nutri:
+        if attrs['ubicacion'].nutricionista_id != nutri.id:
             raise serializers.ValidationError("La ubicación no pertenece al nutricionista.")
-        if attrs['tipo_consulta'].nutricionista != nutri:
+        if attrs['tipo_consulta'].nutricionista_id != nutri.id:
             raise serializers.ValidationError("El tipo de consulta no pertenece al nutricionista.")
 
         # 2. Validar que el slot está en el futuro
         if attrs['start_time'] < timezone.now():
             raise serializers.ValidationError("No se puede reservar un turno en el pasado.")
             
-        # 3. Verificar que no haya turnos ACTIVOS que se solapen
-        from psycopg.types.range import Range
-        from django.db.models import Q
-        
-        slot_range = Range(attrs['start_time'], attrs['end_time'], bounds='[)')
-        
-        # Buscar turnos activos (no cancelados) que se solapen
-        overlapping_turnos = Turno.objects.filter(
-            nutricionista=nutri,
-            ubicacion=attrs['ubicacion'],
-            slot__overlap=slot_range
-        ).exclude(
-            state=TurnoState.CANCELADO
-        ).filter(
-            Q(state__in=[TurnoState.RESERVADO, TurnoState.CONFIRMADO, TurnoState.ATENDIDO]) |
-            (Q(state=TurnoState.TENTATIVO) & Q(soft_hold_expires_at__gt=timezone.now()))
-        )
-        
-        if overlapping_turnos.exists():
-            raise serializers.ValidationError(
-                "Este horario ya no está disponible. Por favor seleccione otro horario."
-            )
+        # 3. Los solapes los rechaza la restricción de la base al guardar (ver booking.py)
 
         return attrs
 
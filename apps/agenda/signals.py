@@ -0,0 +1,147 @@
+# apps/agenda/signals.py
+"""
+Receptores que mantienen al día los derivados de la agenda (caché de slots y
+free/busy materializado) cuando cambia cualquier modelo que afecta la
+disponibilidad de un nutricionista, y la config de email recordada por los
+workers cuando cambia la del nutricionista.
+"""
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from apps.user.models import Nutricionista
+from .models import (
+    Ubicacion,
+    Turno,
+    BloqueoDisponibilidad,
+    DisponibilidadHoraria,
+    TipoConsultaConfig,
+    ProfessionalSettings,
+)
+from .slot_cache import invalidar_agenda
+from .materializado import refrescar_dias
+from .correo import invalidar_remitente
+
+
+def agenda_modificada(nutricionista_id):
+    """
+    Marca la agenda del nutricionista como modificada.
+
+    Se ejecuta al confirmar la transacción: si se invalidara antes, una lectura
+    concurrente podría cachear datos viejos bajo la versión nueva. Los caminos que
+    escriben con update()/bulk_create() (que no disparan señales) deben llamarla.
+    """
+    transaction.on_commit(lambda: invalidar_agenda(nutricionista_id))
+
+
+def dias_modificados(nutricionista_id, ubicacion_id=None, desde=None, hasta=None, dia_semana=None,
+                     intervalos=None):
+    """
+    Programa el refresco del free/busy materializado para los días afectados
+    (ver materializado.refrescar_dias) al confirmar la transacción. `intervalos`
+    (pares de instantes, que se pasan a días en la zona de la ubicación)
+    reemplaza a desde/hasta.
+    """
+    transaction.on_commit(
+        lambda: refrescar_dias(nutricionista_id, ubicacion_id, desde, hasta, dia_semana, intervalos)
+    )
+
+
+def turnos_modificados(filas):
+    """
+    Avisos para turnos escritos con update(): `filas` son tuplas (nutricionista_id,
+    ubicacion_id, busy_range). Se agrupan en un aviso por agenda con los días
+    que ocupan.
+    """
+    afectadas = {}
+    for nutricionista_id, ubicacion_id, busy_range in filas:
+        afectadas.setdefault((nutricionista_id, ubicacion_id), []).append((busy_range.lower, busy_range.upper))
+    for nutricionista_id in {nutricionista_id for nutricionista_id, _ in afectadas}:
+        agenda_modificada(nutricionista_id)
+    for (nutricionista_id, ubicacion_id), intervalos in afectadas.items():
+        dias_modificados(nutricionista_id, ubicacion_id, intervalos=intervalos)
+
+
+def _intervalo(instance):
+    # Un turno ocupa su busy_range (con buffers); un bloqueo, su propio rango
+    busy_range = getattr(instance, 'busy_range', None)
+    if busy_range is not None:
+        return busy_range.lower, busy_range.upper
+    return instance.start_time, instance.end_time
+
+
+@receiver(post_save, sender=Turno)
+@receiver(post_delete, sender=Turno)
+@receiver(post_save, sender=BloqueoDisponibilidad)
+@receiver(post_delete, sender=BloqueoDisponibilidad)
+@receiver(post_save, sender=DisponibilidadHoraria)
+@receiver(post_delete, sender=DisponibilidadHoraria)
+@receiver(post_save, sender=TipoConsultaConfig)
+@receiver(post_delete, sender=TipoConsultaConfig)
+@receiver(post_save, sender=ProfessionalSettings)
+@receiver(post_delete, sender=ProfessionalSettings)
+def invalidar_slots_de_agenda(sender, instance, **kwargs):
+    agenda_modificada(instance.nutricionista_id)
+
+
+# ──────────────────────────────────────────────────────────────────────
+# Free/busy materializado: solo se recalculan los días afectados
+# ──────────────────────────────────────────────────────────────────────
+
+@receiver(post_init, sender=Turno)
+@receiver(post_init, sender=BloqueoDisponibilidad)
+@receiver(post_init, sender=DisponibilidadHoraria)
+def recordar_valores_originales(sender, instance, **kwargs):
+    # Si un turno/bloqueo se mueve (o un horario cambia de día/ubicación) hay que
+    # refrescar también los días donde estaba antes
+    if sender is DisponibilidadHoraria:
+        instance._agenda_original = (instance.ubicacion_id, instance.dia_semana)
+    else:
+        instance._agenda_original = (instance.ubicacion_id, *_intervalo(instance))
+
+
+@receiver(post_save, sender=Turno)
+@receiver(post_delete, sender=Turno)
+@receiver(post_save, sender=BloqueoDisponibilidad)
+@receiver(post_delete, sender=BloqueoDisponibilidad)
+def refrescar_dias_de_rango(sender, instance, **kwargs):
+    actual = (instance.ubicacion_id, *_intervalo(instance))
+    for ubicacion_id, inicio, fin in {actual, getattr(instance, '_agenda_original', actual)}:
+        if ubicacion_id and inicio and fin:
+            dias_modificados(instance.nutricionista_id, ubicacion_id, intervalos=[(inicio, fin)])
+    instance._agenda_original = actual
+
+
+@receiver(post_save, sender=DisponibilidadHoraria)
+@receiver(post_delete, sender=DisponibilidadHoraria)
+def refrescar_dias_de_disponibilidad(sender, instance, **kwargs):
+    actual = (instance.ubicacion_id, instance.dia_semana)
+    for ubicacion_id, dia_semana in {actual, getattr(instance, '_agenda_original', actual)}:
+        if ubicacion_id and dia_semana is not None:
+            dias_modificados(instance.nutricionista_id, ubicacion_id, dia_semana=dia_semana)
+    instance._agenda_original = actual
+
+
+@receiver(post_init, sender=Ubicacion)
+def recordar_zona_horaria(sender, instance, **kwargs):
+    instance._timezone_original = instance.timezone
+
+
+@receiver(post_save, sender=Ubicacion)
+def refrescar_por_zona_horaria(sender, instance, created, **kwargs):
+    # Los días y las horas de pared de los slots se cortan en la zona de la ubicación
+    if not created and instance.timezone != instance._timezone_original:
+        agenda_modificada(instance.nutricionista_id)
+        dias_modificados(instance.nutricionista_id, instance.id)
+    instance._timezone_original = instance.timezone
+
+
+# ──────────────────────────────────────────────────────────────────────
+# Config de email del nutricionista (ver correo.remitente_para)
+# ──────────────────────────────────────────────────────────────────────
+
+@receiver(post_save, sender=Nutricionista)
+@receiver(post_delete, sender=Nutricionista)
+def invalidar_remitente_de_nutricionista(sender, instance, **kwargs):
+    nutricionista_id = instance.id
+    transaction.on_commit(lambda: invalidar_remitente(nutricionista_id))
@@ -0,0 +1,183 @@
+# apps/agenda/slot_cache.py
+"""
+Caché versionada de disponibilidad para el turnero público.
+
+Cada día calculado se guarda como un snapshot con clave
+(nutricionista, ubicación, tipo de consulta, fecha, versión). La versión es un
+contador por nutricionista que se incrementa (ver signals.py) cada vez que cambia
+algo que afecta su agenda, de modo que los snapshots viejos quedan huérfanos y
+expiran solos. La ventana de reserva (anticipación mínima y máxima) se aplica
+al leer, así un día cacheado sigue siendo correcto a medida que avanza la hora.
+
+Los días de los snapshots son los de la zona horaria de la ubicación, la misma
+en que el motor genera los slots. Sin ubicación, si el profesional tiene sedes
+en zonas distintas un día no tiene límites únicos y se calcula sin caché.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min
+from django.utils import timezone
+
+from .availability import ResolutorBuffers, acotar_fechas, slots_disponibles, limites_del_rango, zona_horaria
+from .models import Turno, TurnoState, Ubicacion
+
+
+SNAPSHOT_TTL = getattr(settings, 'AGENDA_SLOTS_CACHE_TTL', 60 * 60 * 6)
+
+VERSION_KEY = 'agenda:slots:version:{nutricionista_id}'
+SNAPSHOT_KEY = 'agenda:slots:{nutricionista_id}:{ubicacion_id}:{tipo_consulta_id}:{fecha}:v{version}'
+ANTICIPACION_KEY = 'agenda:slots:{nutricionista_id}:anticipacion:v{version}'
+ZONA_KEY = 'agenda:slots:{nutricionista_id}:{ubicacion_id}:zona:v{version}'
+
+# Sin ubicación, sedes en más de una zona horaria
+ZONAS_MIXTAS = '*'
+
+
+def version_agenda(nutricionista_id):
+    """Versión actual de la agenda del nutricionista (la crea si no existe)."""
+    key = VERSION_KEY.format(nutricionista_id=nutricionista_id)
+    version = cache.get(key)
+    if version is None:
+        # Arrancar desde un valor basado en el reloj: si la clave fue desalojada,
+        # no reutilizamos números de versión que puedan tener snapshots viejos.
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidar_agenda(nutricionista_id):
+    """Incrementa la versión de la agenda: todos sus snapshots dejan de usarse."""
+    key = VERSION_KEY.format(nutricionista_id=nutricionista_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def _snapshot_key(nutricionista_id, ubicacion_id, tipo_consulta_id, fecha, version):
+    return SNAPSHOT_KEY.format(
+        nutricionista_id=nutricionista_id,
+        ubicacion_id=ubicacion_id or '-',
+        tipo_consulta_id=tipo_consulta_id or '-',
+        fecha=fecha.isoformat(),
+        version=version,
+    )
+
+
+def _ventana_de_reserva(nutricionista, version, now):
+    """
+    Ventana de reserva del profesional. Las anticipaciones se guardan junto a los
+    snapshots (misma versión, así un cambio de ProfessionalSettings las renueva).
+    """
+    key = ANTICIPACION_KEY.format(nutricionista_id=nutricionista.id, version=version)
+    anticipacion = cache.get(key)
+    if anticipacion is None:
+        desde, hasta = ResolutorBuffers(nutricionista).ventana_de_reserva(now)
+        anticipacion = (desde - now, hasta - now)
+        cache.set(key, anticipacion, timeout=SNAPSHOT_TTL)
+    minima, maxima = anticipacion
+    return now + minima, now + maxima
+
+
+def _zona_de_los_dias(nutricionista, ubicacion_id, version):
+    """
+    Nombre de la zona horaria en que se cortan los días de los snapshots: la de
+    la ubicación o, sin ubicación, la común a todas las del profesional
+    (ZONAS_MIXTAS si difieren). Se guarda con la versión de la agenda.
+    """
+    key = ZONA_KEY.format(nutricionista_id=nutricionista.id, ubicacion_id=ubicacion_id or '-', version=version)
+    zona = cache.get(key)
+    if zona is None:
+        ubicaciones = Ubicacion.objects.filter(nutricionista=nutricionista)
+        if ubicacion_id:
+            ubicaciones = ubicaciones.filter(id=ubicacion_id)
+        zonas = set(ubicaciones.values_list('timezone', flat=True))
+        if len(zonas) > 1:
+            zona = ZONAS_MIXTAS
+        else:
+            zona = zonas.pop() if zonas else timezone.get_current_timezone_name()
+        cache.set(key, zona, timeout=SNAPSHOT_TTL)
+    return zona
+
+
+def _ttl_por_holds(nutricionista, desde, hasta, now):
+    """
+    Los soft-holds vencen por tiempo, sin tocar la base, así que no incrementan la
+    versión: un snapshot que los incluya no puede vivir más allá del primer vencimiento.
+    """
+    rango_inicio, rango_fin = limites_del_rango(desde, hasta, timezone.get_current_timezone())
+    proximo_vencimiento = Turno.objects.filter(
+        nutricionista=nutricionista,
+        state=TurnoState.TENTATIVO,
+        soft_hold_expires_at__gt=now,
+        start_time__lt=rango_fin,
+        end_time__gt=rango_inicio,
+    ).aggregate(proximo=Min('soft_hold_expires_at'))['proximo']
+
+    if proximo_vencimiento is None:
+        return SNAPSHOT_TTL
+    return max(1, min(SNAPSHOT_TTL, int((proximo_vencimiento - now).total_seconds()) + 1))
+
+
+def slots_cacheados(nutricionista, start_date, end_date, ubicacion_id=None, tipo_consulta_id=None):
+    """
+    Igual que calculate_available_slots pero sirviendo cada día desde la caché.
+
+    Los días faltantes se calculan juntos, en una sola llamada al motor que cubre
+    desde el primer hasta el último día sin snapshot. Los días fuera de la
+    ventana de reserva ni se buscan en la caché.
+    """
+    now = timezone.now()
+    ubicacion_id = int(ubicacion_id) if ubicacion_id else None
+    tipo_consulta_id = int(tipo_consulta_id) if tipo_consulta_id else None
+    version = version_agenda(nutricionista.id)
+
+    zona = _zona_de_los_dias(nutricionista, ubicacion_id, version)
+    if zona == ZONAS_MIXTAS:
+        return slots_disponibles(
+            nutricionista, start_date, end_date,
+            ubicacion_id=ubicacion_id, tipo_consulta_id=tipo_consulta_id, now=now,
+        )
+    tz = zona_horaria(zona)
+
+    desde_reserva, hasta_reserva = _ventana_de_reserva(nutricionista, version, now)
+    start_date, end_date = acotar_fechas(start_date, end_date, desde_reserva, hasta_reserva)
+
+    fechas = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    claves = {
+        fecha: _snapshot_key(nutricionista.id, ubicacion_id, tipo_consulta_id, fecha, version)
+        for fecha in fechas
+    }
+    snapshots = cache.get_many(list(claves.values()))
+
+    faltantes = [fecha for fecha in fechas if claves[fecha] not in snapshots]
+    if faltantes:
+        desde, hasta = faltantes[0], faltantes[-1]
+        calculados = slots_disponibles(
+            nutricionista, desde, hasta,
+            ubicacion_id=ubicacion_id,
+            tipo_consulta_id=tipo_consulta_id,
+            now=now,
+            incluir_pasados=True,
+        )
+
+        # Cada slot va al día de la ubicación para el que lo generó el motor
+        por_dia = {fecha: [] for fecha in faltantes}
+        for slot in calculados:
+            fecha = slot['inicio'].astimezone(tz).date()
+            if fecha in por_dia:
+                por_dia[fecha].append(slot)
+
+        nuevos = {claves[fecha]: slots for fecha, slots in por_dia.items()}
+        cache.set_many(nuevos, timeout=_ttl_por_holds(nutricionista, desde, hasta, now))
+        snapshots.update(nuevos)
+
+    return [
+        slot
+        for fecha in fechas
+        for slot in snapshots[claves[fecha]]
+        if desde_reserva <= slot['inicio'] <= hasta_reserva
+    ]
@@ -1,13 +1,69 @@
+import datetime
 import logging
+import smtplib
+import time
+from collections import defaultdict
 from celery import shared_task
+from celery.exceptions import Retry
+from celery.signals import celeryd_init, worker_process_shutdown
 from django.utils import timezone
-from django.core.mail import send_mail, get_connection
-from django.conf import settings
-from .models import NotificationLog
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import Q
+from .models import NotificationLog, ClaveIdempotencia
+from .booking import cancelar_holds_vencidos
+from .correo import pool as smtp_pool, remitente_para
+from .plantillas import PlantillaDesconocida, prioridad_de, renderizar
+from .colas import CRITICA, MASIVA, aplicar_concurrencia, cola_de
+from .limite_envio import backoff, tomar_tokens
+from . import metrics
 
 # Configurar un logger para esta app
 logger = logging.getLogger(__name__)
 
+# Un lote reclamado por un worker que murió a mitad del envío vuelve a poder
+# tomarse pasado este tiempo (antes de que el outbox lo republique, ver
+# notificaciones.REPUBLICAR_DESPUES)
+RECLAMO_VENCE = datetime.timedelta(minutes=5)
+
+
+def _marcar_fallido(log, error):
+    log.sent_at = timezone.now()
+    log.delivered = False
+    log.delivery_meta = {**log.delivery_meta, 'error': error}
+
+
+def _demorar(tarea, args, demoras, espera, nutricionista_id, prioridad, cantidad=1):
+    """
+    Reprograma `tarea` por límite de envío, con backoff exponencial con jitter,
+    en la cola de su prioridad.
+    """
+    countdown = backoff(demoras, minimo=espera)
+    tarea.apply_async(args=args, kwargs={'demoras': demoras + 1}, countdown=countdown, queue=cola_de(prioridad))
+    remitente = nutricionista_id or 'sistema'
+    metrics.incrementar('emails_limitados', cantidad, remitente=remitente)
+    metrics.observar('emails_limitados_demora_s', round(countdown, 1), remitente=remitente)
+    logger.info(f"Límite de envío alcanzado ({remitente}): {cantidad} email(s) demorados {countdown:.0f} s")
+
+
+def _mensaje(email, remitente, destinatario):
+    mensaje = EmailMultiAlternatives(email.asunto, email.texto, remitente.from_email, [destinatario])
+    mensaje.attach_alternative(email.html, 'text/html')
+    return mensaje
+
+
+@worker_process_shutdown.connect
+def cerrar_conexiones_smtp(**kwargs):
+    """Al terminar un proceso del worker, cierra (QUIT) sus conexiones SMTP libres."""
+    smtp_pool.cerrar_todas()
+
+
+@celeryd_init.connect
+def concurrencia_por_cola(conf=None, options=None, **kwargs):
+    """Concurrencia declarada de la cola de notificaciones que atiende el worker (ver colas.py)."""
+    aplicar_concurrencia(conf, options or {})
+
+
 @shared_task(
     bind=True, 
     max_retries=3, 
@@ -15,7 +71,7 @@ logger = logging.getLogger(__name__)
     task_track_started=True,  # Rastrea cuando la tarea inicia
     acks_late=True  # Confirma el mensaje solo después de completar la tarea exitosamente
 )
-def send_notification_email(self, log_id):
+def send_notification_email(self, log_id, demoras=0):
     """
     Tarea de Celery para procesar un NotificationLog y enviar el email.
     
@@ -38,169 +94,206 @@ def send_notification_email(self, log_id):
             log.save()
             return
 
-        # 3. Construir el email basado en el template
-        subject = ""
-        message = ""
-
-        if template == "public_booking_verification":
-            subject = "Confirma tu turno"
-            message = f"""
-            Hola {payload.get('nombre_paciente', 'paciente')},
-
-            Estás a un paso de confirmar tu turno con {payload.get('nombre_nutri')}.
-            
-            Turno: {payload.get('tipo_consulta')}
-            Cuándo: {payload.get('fecha_hora_inicio')}
-
-            Por favor, haz clic en el siguiente enlace para confirmar tu reserva (expira en 10 minutos):
-            {payload.get('verification_url')}
-            """
-        
-        elif template == "public_booking_confirmed_paciente":
-            subject = "¡Tu turno está reservado!"
-            message = f"""
-            Hola {payload.get('nombre_paciente', 'paciente')},
-
-            Tu turno con {payload.get('nombre_nutri')} ha sido reservado con éxito.
-
-            Detalles:
-            Tipo de consulta: {payload.get('tipo_consulta')}
-            Cuándo: {payload.get('fecha_hora_inicio')}
-            Dónde: {payload.get('ubicacion_nombre')}
-
-            ¡Te esperamos!
-            """
-
-        elif template == "public_booking_confirmed_nutri":
-            subject = f"¡Nuevo turno reservado! (Paciente Público)"
-            message = f"""
-            Hola {payload.get('nombre_nutri')},
-
-            Has recibido una nueva reserva de un paciente público.
-
-            Detalles:
-            Paciente: {payload.get('nombre_paciente')}
-            Email: {payload.get('email_paciente')}
-            Teléfono: {payload.get('telefono_paciente')}
-
-            Turno:
-            Tipo de consulta: {payload.get('tipo_consulta')}
-            Cuándo: {payload.get('fecha_hora_inicio')}
-            """
-        
-        else:
-            logger.error(f"Template de email desconocido: {template} para Log {log_id}")
+        # 3. Construir el email con la plantilla registrada (ver plantillas.py)
+        try:
+            email = renderizar(template, payload)
+        except PlantillaDesconocida as exc:
+            # Se marca procesado: reintentarlo no lo va a arreglar
+            logger.error(f"{exc} para Log {log_id}. Marcando como fallido.")
+            _marcar_fallido(log, str(exc))
+            log.save(update_fields=['sent_at', 'delivered', 'delivery_meta'])
             return
 
-        # 4. Determinar desde qué email enviar
-        # Si existe un nutricionista_id en el payload, intentar usar su email
-        from_email = settings.DEFAULT_FROM_EMAIL
-        email_connection = None
-        
-        nutricionista_id = payload.get('nutricionista_id')
-        if nutricionista_id:
-            try:
-                from apps.user.models import Nutricionista
-                nutricionista = Nutricionista.objects.get(id=nutricionista_id)
-                
-                if nutricionista.has_custom_email():
-                    # Usar el email personalizado del nutricionista
-                    email_config = nutricionista.get_email_config()
-                    from_email = email_config['DEFAULT_FROM_EMAIL']
-                    
-                    # Crear una conexión SMTP específica para este nutricionista
-                    email_connection = get_connection(
-                        host=email_config['EMAIL_HOST'],
-                        port=email_config['EMAIL_PORT'],
-                        username=email_config['EMAIL_HOST_USER'],
-                        password=email_config['EMAIL_HOST_PASSWORD'],
-                        use_tls=email_config['EMAIL_USE_TLS'],
-                        use_ssl=email_config['EMAIL_USE_SSL'],
-                        fail_silently=False,
-                    )
-                    logger.info(f"Usando email personalizado del nutricionista {nutricionista_id}: {from_email}")
-                else:
-                    # El nutricionista no tiene email configurado, usar el del sistema
-                    logger.info(f"Nutricionista {nutricionista_id} sin email configurado, usando email del sistema")
-                    if not settings.DEBUG:
-                        # En producción, usar la configuración del sistema
-                        email_connection = get_connection(
-                            host=settings.SYSTEM_EMAIL_HOST,
-                            port=settings.SYSTEM_EMAIL_PORT,
-                            username=settings.SYSTEM_EMAIL_HOST_USER,
-                            password=settings.SYSTEM_EMAIL_HOST_PASSWORD,
-                            use_tls=settings.SYSTEM_EMAIL_USE_TLS,
-                            use_ssl=settings.SYSTEM_EMAIL_USE_SSL,
-                            fail_silently=False,
-                        )
-                        from_email = settings.SYSTEM_DEFAULT_FROM_EMAIL
-            except Exception as nutri_error:
-                logger.warning(f"Error al obtener nutricionista {nutricionista_id}: {nutri_error}. Usando email del sistema.")
-                if not settings.DEBUG:
-                    email_connection = get_connection(
-                        host=settings.SYSTEM_EMAIL_HOST,
-                        port=settings.SYSTEM_EMAIL_PORT,
-                        username=settings.SYSTEM_EMAIL_HOST_USER,
-                        password=settings.SYSTEM_EMAIL_HOST_PASSWORD,
-                        use_tls=settings.SYSTEM_EMAIL_USE_TLS,
-                        use_ssl=settings.SYSTEM_EMAIL_USE_SSL,
-                        fail_silently=False,
-                    )
-                    from_email = settings.SYSTEM_DEFAULT_FROM_EMAIL
-        else:
-            # No hay nutricionista_id, usar el email del sistema
-            logger.info("No se especificó nutricionista_id, usando email del sistema")
-            if not settings.DEBUG:
-                email_connection = get_connection(
-                    host=settings.SYSTEM_EMAIL_HOST,
-                    port=settings.SYSTEM_EMAIL_PORT,
-                    username=settings.SYSTEM_EMAIL_HOST_USER,
-                    password=settings.SYSTEM_EMAIL_HOST_PASSWORD,
-                    use_tls=settings.SYSTEM_EMAIL_USE_TLS,
-                    use_ssl=settings.SYSTEM_EMAIL_USE_SSL,
-                    fail_silently=False,
-                )
-                from_email = settings.SYSTEM_DEFAULT_FROM_EMAIL
+        # 4. Determinar desde qué email enviar: el SMTP del nutricionista si lo
+        # configuró, si no el del sistema (config recordada por proceso, ver correo.py)
+        remitente = remitente_para(payload.get('nutricionista_id'))
+        _, espera = tomar_tokens(remitente)
+        if espera:
+            # Sin tokens: se reprograma sin gastar un reintento
+            _demorar(
+                send_notification_email, (log_id,), demoras, espera, payload.get('nutricionista_id'),
+                prioridad_de(template),
+            )
+            return
         
         # 5. Enviar el Email
         try:
-            send_mail(
-                subject=subject,
-                message=message,
-                from_email=from_email,
-                recipient_list=[destinatario],
-                fail_silently=False,
-                connection=email_connection,
-            )
+            # Conexión reutilizada del pool del worker (sin handshake por email)
+            with smtp_pool.conexion(remitente) as email_connection:
+                email_connection.send_messages([_mensaje(email, remitente, destinatario)])
             
             # 6. Marcar como enviado exitosamente
             log.sent_at = timezone.now()
             log.delivered = True
-            log.save(update_fields=['sent_at', 'delivered'])
+            log.delivery_meta = {**log.delivery_meta, 'plantilla_version': email.version}
+            log.save(update_fields=['sent_at', 'delivered', 'delivery_meta'])
             
             logger.info(f"Email enviado exitosamente para Log {log_id} (Template: {template})")
             
         except Exception as email_error:
-            # Error al enviar el email, marcar como fallido
-            log.sent_at = timezone.now()
-            log.delivered = False
-            log.save(update_fields=['sent_at', 'delivered'])
-            
             logger.error(f"Error al enviar email para Log {log_id}: {email_error}")
             logger.error(f"Traceback completo:", exc_info=True)
             
-            # No reintentar si es un error de configuración
-            if 'DEFAULT_FROM_EMAIL' in str(email_error) or 'EMAIL_BACKEND' in str(email_error):
-                logger.error(f"Error de configuración de email. No se reintentará.")
+            # No reintentar si es un error de configuración ni si se agotaron los
+            # reintentos: recién ahí se marca como fallido
+            config_invalida = 'DEFAULT_FROM_EMAIL' in str(email_error) or 'EMAIL_BACKEND' in str(email_error)
+            if config_invalida or self.request.called_directly or self.request.retries >= self.max_retries:
+                if config_invalida:
+                    logger.error(f"Error de configuración de email. No se reintentará.")
+                _marcar_fallido(log, str(email_error))
+                log.save(update_fields=['sent_at', 'delivered', 'delivery_meta'])
                 return
             
-            # Reintentar si es un error de red/SMTP
-            raise self.retry(exc=email_error)
+            # Reintentar si es un error de red/SMTP: el log sigue pendiente (sent_at nulo)
+            raise self.retry(exc=email_error, countdown=backoff(self.request.retries))
 
+    except Retry:
+        raise
     except NotificationLog.DoesNotExist:
         # Esto es normal si la tarea se duplicó en la cola o el log ya fue procesado
         logger.info(f"Log {log_id} ya fue procesado o no existe. Esta es una ejecución duplicada, ignorando de forma segura.")
     except Exception as exc:
         logger.error(f"Error al enviar email para Log {log_id}: {exc}")
         # Reintentar la tarea si es un error de red/SMTP
-        raise self.retry(exc=exc)
\ No newline at end of file
+        raise self.retry(exc=exc, countdown=backoff(self.request.retries))
+
+@shared_task(
+    bind=True,
+    max_retries=3,
+    acks_late=True,
+    ignore_result=True,
+)
+def send_notification_emails_batch(self, log_ids, demoras=0):
+    """
+    Envía un lote del outbox (ver notificaciones.py): los NotificationLog de
+    `log_ids` que sigan pendientes, agrupados por remitente, cada grupo por una
+    sola sesión SMTP.
+
+    Los logs se reclaman (claimed_at) en una transacción corta con FOR UPDATE
+    SKIP LOCKED: si el mismo log se publicó dos veces, solo una tarea lo envía.
+    El envío SMTP corre fuera de la transacción, sin retener locks ni una
+    conexión a la base, y los resultados se guardan al final en un solo
+    bulk_update. Un reclamo vence a los RECLAMO_VENCE, por si el worker muere
+    en el medio.
+
+    Un destinatario rechazado marca su log como fallido; un error de conexión
+    deja pendientes los logs que faltaban y reintenta solo esos. Lo que excede
+    el límite de envío del remitente (ver limite_envio.py) se reprograma en otra
+    tarea, sin gastar reintentos; `demoras` cuenta esas reprogramaciones.
+    """
+    enviados, pendientes, error, demorados = 0, [], None, []
+    now = timezone.now()
+    with transaction.atomic():
+        logs = list(
+            NotificationLog.objects.select_for_update(skip_locked=True)
+            .filter(pk__in=log_ids, sent_at__isnull=True)
+            .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - RECLAMO_VENCE))
+            .order_by('id')
+        )
+        NotificationLog.objects.filter(pk__in=[log.id for log in logs]).update(claimed_at=now)
+
+    por_remitente = defaultdict(list)
+    for log in logs:
+        por_remitente[log.payload.get('nutricionista_id')].append(log)
+
+    procesados = []
+    for nutricionista_id, del_remitente in por_remitente.items():
+        remitente = remitente_para(nutricionista_id)
+        mensajes = []
+        for log in del_remitente:
+            destinatario = log.payload.get('destinatario')
+            try:
+                email = renderizar(log.template, log.payload)
+            except PlantillaDesconocida as exc:
+                logger.error(f"{exc} para Log {log.id}. Marcando como fallido.")
+                _marcar_fallido(log, str(exc))
+                procesados.append(log)
+                continue
+            if not destinatario:
+                logger.warning(f"NotificationLog {log.id} no tiene 'destinatario' en el payload. Marcando como fallido.")
+                _marcar_fallido(log, "Sin destinatario")
+                procesados.append(log)
+                continue
+            log.delivery_meta = {**log.delivery_meta, 'plantilla_version': email.version}
+            mensajes.append((log, _mensaje(email, remitente, destinatario)))
+        concedidos, espera = tomar_tokens(remitente, len(mensajes))
+        if concedidos < len(mensajes):
+            restantes = [log for log, _ in mensajes[concedidos:]]
+            prioridad = CRITICA if any(prioridad_de(log.template) == CRITICA for log in restantes) else MASIVA
+            demorados.append((nutricionista_id, [log.id for log in restantes], espera, prioridad))
+            mensajes = mensajes[:concedidos]
+        if not mensajes:
+            continue
+        try:
+            with smtp_pool.conexion(remitente) as conexion:
+                for log, mensaje in mensajes:
+                    try:
+                        conexion.send_messages([mensaje])
+                        log.delivered = True
+                        enviados += 1
+                    except smtplib.SMTPRecipientsRefused as exc:
+                        logger.error(f"Destinatario rechazado para Log {log.id}: {exc}")
+                        log.delivered = False
+                    log.sent_at = timezone.now()
+                    procesados.append(log)
+        except Exception as exc:
+            # La sesión se cortó: lo que no llegó a salir queda pendiente
+            logger.error(f"Error al enviar lote de emails (nutricionista {nutricionista_id}): {exc}")
+            pendientes += [log.id for log, _ in mensajes if log.sent_at is None]
+            error = exc
+    NotificationLog.objects.bulk_update(procesados, ['sent_at', 'delivered', 'delivery_meta'])
+
+    metrics.observar('notificaciones_lote_tamano', len(log_ids))
+    for nutricionista_id, ids, espera, prioridad in demorados:
+        _demorar(send_notification_emails_batch, (ids,), demoras, espera, nutricionista_id, prioridad, len(ids))
+        # Recién publicados: la republicación periódica no los duplica mientras esperan
+        NotificationLog.objects.filter(pk__in=ids).update(published_at=timezone.now(), claimed_at=None)
+    if pendientes:
+        if self.request.called_directly or self.request.retries >= self.max_retries:
+            NotificationLog.objects.filter(pk__in=pendientes, sent_at__isnull=True).update(
+                sent_at=timezone.now(), delivered=False
+            )
+        else:
+            # Se liberan para que el reintento los pueda reclamar
+            NotificationLog.objects.filter(pk__in=pendientes).update(claimed_at=None)
+            raise self.retry(args=(pendientes,), exc=error, countdown=backoff(self.request.retries))
+    return enviados
+
+
+@shared_task(ignore_result=True)
+def publicar_notificaciones_pendientes():
+    """
+    Tarea periódica: publica los NotificationLog del outbox que nunca se
+    publicaron o que siguen sin enviarse mucho después (ver notificaciones.py),
+    y registra la profundidad de la cola.
+    """
+    from .notificaciones import medir_cola, publicar_pendientes
+
+    medir_cola()
+    lotes = publicar_pendientes()
+    if lotes:
+        logger.info(f"Outbox: {lotes} lote(s) de notificaciones republicados")
+    return lotes
+
+
+@shared_task(ignore_result=True)
+def cancelar_holds_vencidos_periodico():
+    """
+    Tarea periódica (Celery beat, ver CELERY_BEAT_SCHEDULE): cancela los holds
+    TENTATIVO vencidos en lotes y registra cuántos cosechó.
+    """
+    inicio = time.perf_counter()
+    cancelados, lotes = cancelar_holds_vencidos()
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    metrics.observar('holds_vencidos_duracion_ms', duracion_ms)
+    if cancelados:
+        logger.info(f"Holds vencidos cancelados: {cancelados} en {lotes} lote(s), {duracion_ms} ms")
+    return cancelados
+
+
+@shared_task(ignore_result=True)
+def purgar_claves_idempotencia():
+    """Tarea periódica: borra las claves de idempotencia vencidas (ver idempotencia.py)."""
+    borradas, _ = ClaveIdempotencia.objects.filter(expires_at__lte=timezone.now()).delete()
+    metrics.observar('claves_idempotencia_purgadas', borradas)
+    return borradas
@@ -1,3 +1,1668 @@
-from django.test import TestCase
+import datetime
+import functools
+import json
+import statistics
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Empty
+from types import SimpleNamespace
+from unittest import mock
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+from django.conf import settings as django_settings
+from django.core import mail
+from django.core.mail import send_mail
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+
+from core.celery import app as celery_app
+from apps.user.models import UserAccount, Nutricionista, Especialidad, Paciente, AsignacionNutricionistaPaciente
+from .models import (
+    Ubicacion,
+    ProfessionalSettings,
+    TipoConsultaConfig,
+    DisponibilidadHoraria,
+    BloqueoDisponibilidad,
+    ClaveIdempotencia,
+    MagicAction,
+    MagicLinkToken,
+    NotificationLog,
+    Turno,
+    TurnoState,
+    DisponibilidadDia,
+)
+from .utils import calculate_available_slots, iter_available_slots, calculate_available_slots_batch
+from .slot_cache import VERSION_KEY, _snapshot_key, slots_cacheados, version_agenda
+from .materializado import materializar_dias
+from .busqueda import buscar_primeros_slots
+from .idempotencia import responder_idempotente
+from .benchmarks import correr_benchmark, correr_benchmark_listados
+from .tasks import (
+    cancelar_holds_vencidos_periodico,
+    purgar_claves_idempotencia,
+    send_notification_email,
+    send_notification_emails_batch,
+)
+from . import colas, correo, metrics, plantillas
+from .notificaciones import medir_cola, notificar, publicar_pendientes
+from .limite_envio import LimiteDeEnvio, backoff
+from .booking import (
+    AgendaOcupada,
+    ConflictoDeHorario,
+    HorarioNoReservable,
+    VerificadorDisponibilidad,
+    agenda_bloqueada,
+    cancelar_holds_vencidos,
+    liberar_holds_vencidos,
+    ocurrencias_semanales,
+    sin_solapes,
+)
+
+
+def crear_agenda(dni="30111222", email="nutri@test.com"):
+    """Nutricionista con settings, un tipo de consulta y horario de 8 a 18 todos los días."""
+    user = UserAccount.objects.create_user(dni=dni, email=email, password="secreta123")
+    nutri = Nutricionista.objects.create(user=user, nombre="Ana", apellido="Pérez")
+    ProfessionalSettings.objects.create(nutricionista=nutri, buffer_before_min=5, buffer_after_min=5)
+    tipo = TipoConsultaConfig.objects.create(
+        nutricionista=nutri, tipo="INICIAL", duracion_min=30, buffer_before_min=10, buffer_after_min=10
+    )
+    ubicacion = Ubicacion.objects.create(nutricionista=nutri, nombre="Sede Centro")
+    for dia in range(7):
+        DisponibilidadHoraria.objects.create(
+            nutricionista=nutri,
+            ubicacion=ubicacion,
+            dia_semana=dia,
+            hora_inicio=datetime.time(8, 0),
+            hora_fin=datetime.time(18, 0),
+        )
+    return nutri, ubicacion, tipo
+
+
+def crear_turnos(nutri, ubicacion, tipo, dias, desde):
+    """Un turno reservado por día a las 10:00, empezando en `desde`."""
+    tz = timezone.get_current_timezone()
+    for i in range(dias):
+        inicio = timezone.make_aware(
+            datetime.datetime.combine(desde + datetime.timedelta(days=i), datetime.time(10, 0)), tz
+        )
+        Turno.objects.create(
+            nutricionista=nutri,
+            ubicacion=ubicacion,
+            tipo_consulta=tipo,
+            start_time=inicio,
+            end_time=inicio + datetime.timedelta(minutes=tipo.duracion_min),
+            state=TurnoState.RESERVADO,
+        )
+
+
+class CalculateAvailableSlotsQueriesTest(TestCase):
+    """
+    El cálculo de slots debe costar un número fijo de consultas,
+    sin importar cuántos turnos haya en la ventana pedida.
+    """
+    CONSULTAS_ESPERADAS = 5  # settings, tipos, disponibilidades, bloqueos, turnos
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=13)
+
+    def calcular(self):
+        return calculate_available_slots(
+            self.nutri, self.desde, self.hasta,
+            ubicacion_id=self.ubicacion.id,
+            tipo_consulta_id=self.tipo.id,
+        )
+
+    def test_consultas_constantes_con_pocos_turnos(self):
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=1, desde=self.desde)
+        with self.assertNumQueries(self.CONSULTAS_ESPERADAS):
+            self.calcular()
+
+    def test_consultas_constantes_con_muchos_turnos(self):
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=14, desde=self.desde)
+        with self.assertNumQueries(self.CONSULTAS_ESPERADAS):
+            self.calcular()
+
+    def test_turno_bloquea_slot_con_buffers(self):
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=1, desde=self.desde)
+        inicios = {slot['inicio'].astimezone(timezone.get_current_timezone()).time() for slot in self.calcular()
+                   if slot['inicio'].date() == self.desde}
+        # Slots de 50 min (10 + 30 + 10) desde las 8:10; el de 9:50 choca con el turno de 10:00 + buffers
+        self.assertIn(datetime.time(9, 0), inicios)
+        self.assertNotIn(datetime.time(9, 50), inicios)
+        self.assertNotIn(datetime.time(10, 40), inicios)
+        self.assertIn(datetime.time(11, 30), inicios)
+
+
+class PublicSlotsCacheTest(TestCase):
+    """La caché de snapshots se invalida al cambiar la agenda del nutricionista."""
+
+    def setUp(self):
+        cache.clear()
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=6)
+
+    def cacheados(self):
+        return slots_cacheados(self.nutri, self.desde, self.hasta, self.ubicacion.id, self.tipo.id)
+
+    def test_segunda_lectura_no_recalcula(self):
+        primera = self.cacheados()
+        with self.assertNumQueries(0):
+            segunda = self.cacheados()
+        self.assertEqual(primera, segunda)
+
+    def test_nuevo_turno_invalida_snapshots(self):
+        antes = self.cacheados()
+        with self.captureOnCommitCallbacks(execute=True):
+            crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=1, desde=self.desde)
+        despues = self.cacheados()
+        self.assertLess(len(despues), len(antes))
+        self.assertEqual(despues, calculate_available_slots(
+            self.nutri, self.desde, self.hasta,
+            ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id,
+        ))
+
+    def test_los_dias_se_cortan_en_la_zona_de_la_ubicacion(self):
+        # 8 a 18 en Tokio cruza la medianoche de la zona del servidor
+        Ubicacion.objects.filter(pk=self.ubicacion.pk).update(timezone='Asia/Tokyo')
+        en_vivo = calculate_available_slots(
+            self.nutri, self.desde, self.hasta, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id,
+        )
+        self.assertEqual(self.cacheados(), en_vivo)
+        # Al refrescar un solo día (el resto sigue en caché) no se pierden ni repiten slots
+        cache.delete(_snapshot_key(
+            self.nutri.id, self.ubicacion.id, self.tipo.id, self.desde, version_agenda(self.nutri.id)
+        ))
+        self.assertEqual(self.cacheados(), en_vivo)
+
+    def test_sin_ubicacion_y_con_zonas_distintas_calcula_en_vivo(self):
+        otra = Ubicacion.objects.create(nutricionista=self.nutri, nombre="Sede Tokio", timezone='Asia/Tokyo')
+        DisponibilidadHoraria.objects.create(
+            nutricionista=self.nutri, ubicacion=otra, dia_semana=self.desde.weekday(),
+            hora_inicio=datetime.time(8, 0), hora_fin=datetime.time(12, 0),
+        )
+        self.assertEqual(
+            slots_cacheados(self.nutri, self.desde, self.hasta, tipo_consulta_id=self.tipo.id),
+            calculate_available_slots(self.nutri, self.desde, self.hasta, tipo_consulta_id=self.tipo.id),
+        )
+
+
+class DisponibilidadMaterializadaTest(TestCase):
+    """El modo materializado devuelve lo mismo que el cálculo en vivo y se mantiene al día."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=6)
+
+    def calcular(self, materializado):
+        return calculate_available_slots(
+            self.nutri, self.desde, self.hasta,
+            ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id,
+            materializado=materializado,
+        )
+
+    def test_coincide_con_calculo_en_vivo(self):
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=3, desde=self.desde)
+        self.assertEqual(self.calcular(materializado=True), self.calcular(materializado=False))
+        self.assertEqual(DisponibilidadDia.objects.filter(nutricionista=self.nutri).count(), 7)
+
+    def test_turno_nuevo_refresca_solo_su_dia(self):
+        self.calcular(materializado=True)
+        actualizados_antes = dict(DisponibilidadDia.objects.values_list('fecha', 'actualizado_en'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=1, desde=self.desde)
+
+        actualizados = dict(DisponibilidadDia.objects.values_list('fecha', 'actualizado_en'))
+        cambiados = [fecha for fecha, valor in actualizados.items() if valor != actualizados_antes[fecha]]
+        self.assertEqual(cambiados, [self.desde])
+        with self.assertNumQueries(3):  # settings, tipos y el scan de DisponibilidadDia
+            materializados = self.calcular(materializado=True)
+        self.assertEqual(materializados, self.calcular(materializado=False))
+
+    def test_el_refresco_guarda_dias_sin_fila_y_una_lectura_vieja_no_lo_pisa(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=1, desde=self.desde)
+        fila = DisponibilidadDia.objects.get(nutricionista=self.nutri, fecha=self.desde)
+
+        # Una lectura que calculó el día antes del turno y guarda recién ahora
+        with mock.patch.object(Turno.objects, 'filter', return_value=Turno.objects.none()):
+            materializar_dias(self.nutri, self.ubicacion.id, [self.desde], sobrescribir=False)
+
+        self.assertEqual(DisponibilidadDia.objects.get(pk=fila.pk).ventanas, fila.ventanas)
+        self.assertEqual(self.calcular(materializado=True), self.calcular(materializado=False))
+
+    def test_cambio_de_zona_horaria_refresca_filas_y_cache(self):
+        self.calcular(materializado=True)
+        version = cache.get(VERSION_KEY.format(nutricionista_id=self.nutri.id))
+
+        self.ubicacion.timezone = 'America/Bogota'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ubicacion.save()
+
+        self.assertNotEqual(cache.get(VERSION_KEY.format(nutricionista_id=self.nutri.id)), version)
+        self.assertEqual(self.calcular(materializado=True), self.calcular(materializado=False))
+
+    def test_los_dias_afectados_se_cortan_en_la_zona_de_la_ubicacion(self):
+        self.ubicacion.timezone = 'Asia/Tokyo'
+        self.ubicacion.save()
+        self.calcular(materializado=True)
+
+        # 10:00 en Tokio es el día anterior (22:00) en la zona del servidor
+        inicio = timezone.make_aware(
+            datetime.datetime.combine(self.desde + datetime.timedelta(days=1), datetime.time(10, 0)),
+            ZoneInfo('Asia/Tokyo'),
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            turno = Turno.objects.create(
+                nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+                start_time=inicio, end_time=inicio + datetime.timedelta(minutes=self.tipo.duracion_min),
+                state=TurnoState.RESERVADO,
+            )
+        self.assertEqual(self.calcular(materializado=True), self.calcular(materializado=False))
+
+        # Lo mismo por el camino de update() (turnos_modificados)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(turno.transicionar(TurnoState.CANCELADO))
+        self.assertEqual(self.calcular(materializado=True), self.calcular(materializado=False))
+
+
+class BusquedaMultiProfesionalTest(TestCase):
+    """La búsqueda entre profesionales carga todo en bloque y respeta el orden global."""
+
+    def setUp(self):
+        self.agendas = [crear_agenda(dni=f"3011122{i}", email=f"nutri{i}@test.com") for i in range(3)]
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=6)
+        for nutri, ubicacion, tipo in self.agendas[:2]:
+            crear_turnos(nutri, ubicacion, tipo, dias=3, desde=self.desde)
+
+    def test_consultas_constantes_y_orden_global(self):
+        with self.assertNumQueries(5):  # settings, tipos, disponibilidades, bloqueos, turnos
+            resultados = buscar_primeros_slots(self.desde, self.hasta, limite=20)
+
+        esperados = sorted(
+            (slot['inicio'], nutri.id)
+            for nutri, ubicacion, tipo in self.agendas
+            for slot in calculate_available_slots(
+                nutri, self.desde, self.hasta, ubicacion_id=ubicacion.id, tipo_consulta_id=tipo.id
+            )
+        )[:20]
+        self.assertEqual([(r['inicio'], r['nutricionista_id']) for r in resultados], esperados)
+
+    def test_filtro_por_especialidad(self):
+        especialidad = Especialidad.objects.create(nombre="Deportiva")
+        nutri = self.agendas[1][0]
+        nutri.especialidades.add(especialidad)
+        resultados = buscar_primeros_slots(self.desde, self.hasta, limite=5, especialidad_id=especialidad.id)
+        self.assertEqual(len(resultados), 5)
+        self.assertEqual({r['nutricionista_id'] for r in resultados}, {nutri.id})
+
+    def test_modalidad_virtual_sin_ubicaciones_virtuales(self):
+        self.assertEqual(buscar_primeros_slots(self.desde, self.hasta, is_virtual=True), [])
+
+
+class IteradorDeSlotsTest(TestCase):
+    """El iterador perezoso produce lo mismo que la lista y corta apenas puede."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=20)
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=10, desde=self.desde)
+
+    def test_coincide_con_calculate_available_slots(self):
+        iterados = list(iter_available_slots(
+            self.nutri, self.desde, self.hasta, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id
+        ))
+        self.assertEqual(iterados, calculate_available_slots(
+            self.nutri, self.desde, self.hasta, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id
+        ))
+
+    def test_ubicaciones_en_distintas_zonas_salen_en_orden(self):
+        # El día de Tokio (0 a 23 h) empieza a las 12:00 del día anterior en Córdoba
+        tokio = Ubicacion.objects.create(nutricionista=self.nutri, nombre="Sede Tokio", timezone='Asia/Tokyo')
+        for dia in range(7):
+            DisponibilidadHoraria.objects.create(
+                nutricionista=self.nutri, ubicacion=tokio, dia_semana=dia,
+                hora_inicio=datetime.time(0, 0), hora_fin=datetime.time(23, 0),
+            )
+        iterados = list(iter_available_slots(self.nutri, self.desde, self.hasta, tipo_consulta_id=self.tipo.id))
+        inicios = [slot['inicio'] for slot in iterados]
+        self.assertEqual(inicios, sorted(set(inicios)))
+        self.assertEqual(iterados, calculate_available_slots(
+            self.nutri, self.desde, self.hasta, tipo_consulta_id=self.tipo.id
+        ))
+
+    def test_primer_slot_carga_un_solo_bloque(self):
+        # settings, tipos, disponibilidades y una ronda de bloqueos + turnos (horizonte de 60 días)
+        with self.assertNumQueries(5):
+            primeros = list(iter_available_slots(
+                self.nutri, self.desde, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id, limit=3
+            ))
+        self.assertEqual(len(primeros), 3)
+        self.assertEqual(timezone.localtime(primeros[0]['inicio']).date(), self.desde)
+
+    def test_endpoint_next_available(self):
+        client = APIClient()
+        client.force_authenticate(self.nutri.user)
+        url = reverse('nutricionista-next-available', args=[self.nutri.id])
+        response = client.get(url, {'desde': self.desde.isoformat(), 'ubicacion_id': self.ubicacion.id, 'tipo_consulta_id': self.tipo.id})
+        self.assertEqual(response.status_code, 200)
+        esperado = calculate_available_slots(
+            self.nutri, self.desde, self.desde, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id
+        )[0]
+        self.assertEqual(datetime.datetime.fromisoformat(response.data['inicio']), esperado['inicio'])
+
+
+class SlotsPaginadosTest(TestCase):
+    """SlotsAPIView acepta rangos largos y los recorre por páginas con cursor."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.client = APIClient()
+        self.client.force_authenticate(self.nutri.user)
+        self.url = reverse('nutricionista-slots', args=[self.nutri.id])
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=59)
+
+    def pedir(self, **extra):
+        params = {
+            'fecha_inicio': self.desde.isoformat(),
+            'fecha_fin': self.hasta.isoformat(),
+            'ubicacion_id': self.ubicacion.id,
+            'tipo_consulta_id': self.tipo.id,
+            **extra,
+        }
+        return self.client.get(self.url, params)
+
+    def test_rango_largo_se_recorre_por_paginas(self):
+        paginas = []
+        response = self.pedir()
+        while True:
+            self.assertEqual(response.status_code, 200)
+            paginas.append(response.data)
+            if not response.has_header('X-Next-Cursor'):
+                break
+            response = self.pedir(cursor=response['X-Next-Cursor'])
+
+        self.assertEqual(len(paginas), 2)
+        inicios = [slot['inicio'] for pagina in paginas for slot in pagina]
+        esperados = calculate_available_slots(
+            self.nutri, self.desde, self.hasta, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id
+        )
+        self.assertEqual(len(inicios), len(esperados))
+        self.assertEqual(inicios, sorted(inicios))
+
+    def test_no_pagina_mas_alla_de_la_anticipacion_maxima(self):
+        self.hasta = self.desde + datetime.timedelta(days=365)
+        paginas = 1
+        response = self.pedir()
+        while response.has_header('X-Next-Cursor'):
+            response = self.pedir(cursor=response['X-Next-Cursor'])
+            paginas += 1
+        self.assertEqual(paginas, 2)  # el horizonte por defecto es de 60 días
+
+        ProfessionalSettings.objects.filter(nutricionista=self.nutri).update(
+            anticipacion_maxima=datetime.timedelta(days=20)
+        )
+        self.assertFalse(self.pedir().has_header('X-Next-Cursor'))
+
+    def test_rango_corto_sin_cursor(self):
+        self.hasta = self.desde + datetime.timedelta(days=30)
+        response = self.pedir()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Next-Cursor'))
+
+    def test_cursor_invalido(self):
+        self.assertEqual(self.pedir(cursor='no-es-un-cursor').status_code, 400)
+
+
+class VentanaDeReservaTest(TestCase):
+    """El motor respeta la anticipación mínima/máxima y la zona horaria de cada ubicación."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+
+    def calcular(self, desde, hasta):
+        return calculate_available_slots(
+            self.nutri, desde, hasta, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id
+        )
+
+    def test_rango_fuera_del_horizonte_no_consulta_agenda(self):
+        desde = timezone.localdate() + datetime.timedelta(days=90)
+        with self.assertNumQueries(1):  # solo settings
+            self.assertEqual(self.calcular(desde, desde + datetime.timedelta(days=6)), [])
+
+    def test_slots_dentro_de_la_anticipacion(self):
+        settings = self.nutri.settings
+        settings.anticipacion_minima = datetime.timedelta(days=2)
+        settings.anticipacion_maxima = datetime.timedelta(days=5)
+        settings.save()
+        now = timezone.now()
+        slots = self.calcular(timezone.localdate(), timezone.localdate() + datetime.timedelta(days=10))
+        self.assertTrue(slots)
+        self.assertGreaterEqual(slots[0]['inicio'], now + datetime.timedelta(days=2))
+        self.assertLessEqual(slots[-1]['inicio'], now + datetime.timedelta(days=5))
+
+    def test_sin_settings_rige_la_anticipacion_minima_de_dos_horas(self):
+        self.nutri.settings.delete()
+        now = timezone.now()
+        slots = self.calcular(timezone.localdate(), timezone.localdate() + datetime.timedelta(days=1))
+        self.assertTrue(slots)
+        self.assertGreaterEqual(slots[0]['inicio'], now + datetime.timedelta(hours=2))
+
+        pronto = (now + datetime.timedelta(hours=1)).replace(microsecond=0)
+        with self.assertRaises(HorarioNoReservable) as error:
+            VerificadorDisponibilidad().verificar(
+                self.nutri.id, self.ubicacion.id, self.tipo, pronto, pronto + datetime.timedelta(minutes=30),
+            )
+        self.assertEqual(error.exception.motivo, 'fuera_de_ventana')
+
+    def test_hora_de_pared_de_la_ubicacion(self):
+        self.ubicacion.timezone = "America/Bogota"
+        self.ubicacion.save()
+        dia = timezone.localdate() + datetime.timedelta(days=3)
+        primero = self.calcular(dia, dia)[0]['inicio']
+        local = primero.astimezone(ZoneInfo("America/Bogota"))
+        self.assertEqual((local.date(), local.time()), (dia, datetime.time(8, 10)))
+
+
+class BenchmarkSlotsTest(TestCase):
+    """El benchmark arma su agenda, mide cada escenario y no deja datos."""
+
+    def test_reporte_y_rollback(self):
+        reporte = correr_benchmark(
+            perfil={'turnos_por_semana': 10}, ventanas=(7,), repeticiones=1,
+            escenarios=['ubicacion_y_tipo', 'proximo_libre'],
+        )
+        self.assertEqual(
+            [(r['escenario'], r['dias']) for r in reporte['resultados']],
+            [('ubicacion_y_tipo', 7), ('proximo_libre', 7)],
+        )
+        for resultado in reporte['resultados']:
+            self.assertGreater(resultado['slots'], 0)
+            self.assertGreater(resultado['consultas'], 0)
+        self.assertFalse(Turno.objects.exists())
+
+
+class BenchmarkListadosTest(TestCase):
+    """El benchmark de listados compara ambos caminos sobre el mismo historial y no deja datos."""
+
+    def test_reporte_y_rollback(self):
+        reporte = correr_benchmark_listados(cantidades=(30,), repeticiones=1)
+        self.assertEqual(
+            [(r['escenario'], r['turnos'], r['filas']) for r in reporte['resultados']],
+            [('serializer', 30, 30), ('proyeccion', 30, 30)],
+        )
+        proyeccion = reporte['resultados'][1]
+        self.assertEqual(proyeccion['consultas'], 1)
+        self.assertFalse(Turno.objects.exists())
+
+
+class SlotsPorCombinacionTest(TestCase):
+    """El batch de la vista de agenda comparte la carga entre ubicaciones y tipos."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.seguimiento = TipoConsultaConfig.objects.create(
+            nutricionista=self.nutri, tipo="SEGUIMIENTO", duracion_min=20
+        )
+        self.otra = Ubicacion.objects.create(nutricionista=self.nutri, nombre="Sede Norte")
+        for dia in range(7):
+            DisponibilidadHoraria.objects.create(
+                nutricionista=self.nutri, ubicacion=self.otra, dia_semana=dia,
+                hora_inicio=datetime.time(14, 0), hora_fin=datetime.time(20, 0),
+            )
+        self.desde = timezone.localdate() + datetime.timedelta(days=1)
+        self.hasta = self.desde + datetime.timedelta(days=6)
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=3, desde=self.desde)
+
+    def test_coincide_con_cada_combinacion(self):
+        with self.assertNumQueries(5):
+            batch = calculate_available_slots_batch(self.nutri, self.desde, self.hasta)
+
+        self.assertEqual(set(batch), {self.ubicacion.id, self.otra.id})
+        for ubicacion in (self.ubicacion, self.otra):
+            for tipo in (self.tipo, self.seguimiento):
+                self.assertEqual(batch[ubicacion.id][tipo.id], calculate_available_slots(
+                    self.nutri, self.desde, self.hasta, ubicacion_id=ubicacion.id, tipo_consulta_id=tipo.id
+                ))
+
+    def test_endpoint_devuelve_mapa_anidado(self):
+        client = APIClient()
+        client.force_authenticate(self.nutri.user)
+        response = client.get(
+            reverse('nutricionista-slots-batch', args=[self.nutri.id]),
+            {'fecha_inicio': self.desde.isoformat(), 'fecha_fin': self.hasta.isoformat()},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data[str(self.otra.id)]), {str(self.tipo.id), str(self.seguimiento.id)})
+
+
+class RestriccionDeSolapesTest(TestCase):
+    """busy_range (slot + buffers) y la restricción de exclusión que lo usa."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(10, 0)
+        ))
+
+    def crear_turno(self, inicio, **kwargs):
+        datos = dict(
+            nutricionista=self.nutri,
+            ubicacion=self.ubicacion,
+            tipo_consulta=self.tipo,
+            start_time=inicio,
+            end_time=inicio + datetime.timedelta(minutes=self.tipo.duracion_min),
+            state=TurnoState.RESERVADO,
+        )
+        datos.update(kwargs)
+        return Turno.objects.create(**datos)
+
+    def test_busy_range_incluye_buffers_del_tipo(self):
+        turno = self.crear_turno(self.inicio)
+        turno.refresh_from_db()
+        self.assertEqual(turno.busy_range.lower, self.inicio - datetime.timedelta(minutes=10))
+        self.assertEqual(turno.busy_range.upper, self.inicio + datetime.timedelta(minutes=40))
+
+    def test_los_slots_usan_el_busy_range_guardado(self):
+        self.crear_turno(self.inicio)  # ocupa 9:50-10:40 con los buffers de hoy
+        self.tipo.buffer_before_min = self.tipo.buffer_after_min = 0
+        self.tipo.save()
+
+        dia = timezone.localdate(self.inicio)
+        for materializado in (False, True):
+            inicios = {slot['inicio'] for slot in calculate_available_slots(
+                self.nutri, dia, dia, ubicacion_id=self.ubicacion.id, tipo_consulta_id=self.tipo.id,
+                materializado=materializado,
+            )}
+            # El turno conserva sus buffers: la restricción rechazaría las 10:30
+            self.assertNotIn(self.inicio + datetime.timedelta(minutes=30), inicios)
+            self.assertIn(self.inicio + datetime.timedelta(minutes=60), inicios)
+
+    def test_libera_solo_holds_vencidos_que_se_cruzan(self):
+        ahora = timezone.now()
+        vencido = self.crear_turno(
+            self.inicio, state=TurnoState.TENTATIVO, soft_hold_expires_at=ahora - datetime.timedelta(minutes=1)
+        )
+        vigente = self.crear_turno(
+            self.inicio + datetime.timedelta(hours=2),
+            state=TurnoState.TENTATIVO, soft_hold_expires_at=ahora + datetime.timedelta(minutes=10),
+        )
+        lejano = self.crear_turno(
+            self.inicio + datetime.timedelta(hours=4),
+            state=TurnoState.TENTATIVO, soft_hold_expires_at=ahora - datetime.timedelta(minutes=1),
+        )
+        pedido = Turno.calcular_busy_range(
+            self.inicio, self.inicio + datetime.timedelta(hours=2, minutes=30), self.tipo
+        )
+
+        self.assertEqual(liberar_holds_vencidos(self.nutri.id, self.ubicacion.id, pedido, now=ahora), 1)
+        estados = dict(Turno.objects.values_list('id', 'state'))
+        self.assertEqual(estados[vencido.id], TurnoState.CANCELADO)
+        self.assertEqual(estados[vigente.id], TurnoState.TENTATIVO)
+        self.assertEqual(estados[lejano.id], TurnoState.TENTATIVO)
+
+    def test_solape_de_buffers_se_rechaza_en_la_base(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_constraint WHERE conname = %s", [Turno.RESTRICCION_SOLAPE])
+            if cursor.fetchone() is None:
+                self.skipTest("La base de tests no tiene la restricción de exclusión (btree_gist)")
+
+        self.crear_turno(self.inicio)
+        # Empieza cuando termina el anterior, pero los buffers (10 + 10 min) se pisan
+        with self.assertRaises(ConflictoDeHorario):
+            with sin_solapes():
+                self.crear_turno(self.inicio + datetime.timedelta(minutes=30))
+        # El savepoint deja la transacción usable
+        self.crear_turno(self.inicio + datetime.timedelta(minutes=50))
+        self.assertEqual(Turno.objects.count(), 2)
+
+
+class HoldsVencidosTest(TestCase):
+    """La tarea periódica cancela en lotes los holds vencidos y nada más."""
+
+    def setUp(self):
+        cache.clear()
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.ahora = timezone.now()
+        self.inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(9, 0)
+        ))
+
+    def crear_tentativo(self, horas, vence_en_min):
+        inicio = self.inicio + datetime.timedelta(hours=horas)
+        return Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=inicio, end_time=inicio + datetime.timedelta(minutes=self.tipo.duracion_min),
+            state=TurnoState.TENTATIVO,
+            soft_hold_expires_at=(
+                None if vence_en_min is None else self.ahora + datetime.timedelta(minutes=vence_en_min)
+            ),
+        )
+
+    def test_cancela_vencidos_en_lotes(self):
+        vencidos = [self.crear_tentativo(horas, vence_en_min=-5) for horas in range(5)]
+        vigente = self.crear_tentativo(6, vence_en_min=10)
+        solicitud = self.crear_tentativo(7, vence_en_min=None)  # espera aprobación, no vence
+
+        self.assertEqual(cancelar_holds_vencidos(now=self.ahora, lote=2), (5, 3))
+
+        estados = dict(Turno.objects.values_list('id', 'state'))
+        self.assertTrue(all(estados[turno.id] == TurnoState.CANCELADO for turno in vencidos))
+        self.assertEqual(estados[vigente.id], TurnoState.TENTATIVO)
+        self.assertEqual(estados[solicitud.id], TurnoState.TENTATIVO)
+        self.assertEqual(metrics.valor('holds_vencidos_cancelados', origen='periodico'), 5)
+        self.assertEqual(metrics.valor('holds_vencidos_lotes'), 3)
+
+    def test_tarea_periodica_programada(self):
+        self.crear_tentativo(0, vence_en_min=-1)
+        self.assertEqual(cancelar_holds_vencidos_periodico(), 1)
+        self.assertEqual(cancelar_holds_vencidos_periodico(), 0)
+        self.assertIn(
+            cancelar_holds_vencidos_periodico.name,
+            {tarea['task'] for tarea in django_settings.CELERY_BEAT_SCHEDULE.values()},
+        )
+
+
+@mock.patch('apps.agenda.notificaciones.send_notification_emails_batch')
+class ReservaPublicaIdempotenteTest(TestCase):
+    """Reintentos con la misma Idempotency-Key no duplican turno, token ni email."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(11, 0)
+        ))
+        self.datos = {
+            'nutricionista': self.nutri.id,
+            'ubicacion': self.ubicacion.id,
+            'tipo_consulta': self.tipo.id,
+            'start_time': inicio.isoformat(),
+            'end_time': (inicio + datetime.timedelta(minutes=self.tipo.duracion_min)).isoformat(),
+            'nombre_completo': 'Paciente Ansioso',
+            'email': 'ansioso@example.com',
+        }
+        self.client = APIClient()
+        self.url = reverse('public-turno-create')
+
+    def reservar(self, clave, datos=None):
+        return self.client.post(self.url, datos or self.datos, format='json', HTTP_IDEMPOTENCY_KEY=clave)
+
+    def test_reintento_devuelve_la_respuesta_original(self, envio):
+        with self.captureOnCommitCallbacks(execute=True):
+            primera = self.reservar('clave-1')
+        self.assertEqual(primera.status_code, 201)
+
+        with CaptureQueriesContext(connection) as consultas:
+            segunda = self.reservar('clave-1')
+        # Una sola búsqueda por índice (además de los savepoints de ATOMIC_REQUESTS)
+        self.assertEqual(len([q for q in consultas if 'SAVEPOINT' not in q['sql']]), 1)
+        self.assertEqual(segunda.status_code, 201)
+        self.assertEqual(segunda.data, primera.data)
+        self.assertEqual(segunda['Idempotent-Replayed'], 'true')
+
+        self.assertEqual(Turno.objects.count(), 1)
+        self.assertEqual(MagicLinkToken.objects.count(), 1)
+        self.assertEqual(envio.apply_async.call_count, 1)
+
+    def test_misma_clave_con_otro_pedido(self, _):
+        self.reservar('clave-2')
+        otro = {**self.datos, 'email': 'otro@example.com'}
+        self.assertEqual(self.reservar('clave-2', otro).status_code, 422)
+
+    def test_errores_no_se_recuerdan_y_las_claves_vencen(self, _):
+        ocupado = {**self.datos, 'start_time': self.datos['start_time'].replace('T11:', 'T22:'),
+                   'end_time': self.datos['end_time'].replace('T11:', 'T22:')}
+        self.assertEqual(self.reservar('clave-3', ocupado).status_code, 400)
+        self.assertFalse(ClaveIdempotencia.objects.exists())
+
+        self.assertEqual(self.reservar('clave-3').status_code, 201)
+        ClaveIdempotencia.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(purgar_claves_idempotencia(), 1)
+
+    def test_si_el_proceso_falla_la_clave_no_queda_reclamada(self, _):
+        # Sin ATOMIC_REQUESTS: el reclamo se revierte junto con el proceso que falló
+        request = RequestFactory().post(
+            self.url, self.datos, content_type='application/json', HTTP_IDEMPOTENCY_KEY='clave-4',
+        )
+        with self.assertRaises(RuntimeError):
+            responder_idempotente(request, 'turno_publico', mock.Mock(side_effect=RuntimeError('caída')))
+        self.assertFalse(ClaveIdempotencia.objects.exists())
+
+        procesar = mock.Mock(return_value=Response({'id': 1}, status=201))
+        respuesta = responder_idempotente(request, 'turno_publico', procesar)
+        self.assertEqual(respuesta.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', respuesta)
+        self.assertEqual(responder_idempotente(request, 'turno_publico', procesar).data, {'id': 1})
+        procesar.assert_called_once()
+
+
+class VerificadorDisponibilidadTest(TestCase):
+    """Todas las reservas pasan por el mismo verificador, con costo fijo en consultas."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(10, 0)
+        ))
+        self.fin = self.inicio + datetime.timedelta(minutes=self.tipo.duracion_min)
+
+    def motivo(self, inicio, fin=None, **kwargs):
+        try:
+            VerificadorDisponibilidad().verificar(
+                self.nutri.id, self.ubicacion.id, self.tipo, inicio, fin or inicio + (self.fin - self.inicio), **kwargs
+            )
+        except HorarioNoReservable as e:
+            return e.motivo
+        return None
+
+    def test_consultas_fijas_con_memo_de_configuracion(self):
+        # Turnos diarios a las 10:00; se verifica a la tarde
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=10, desde=timezone.localdate())
+        tarde = datetime.timedelta(hours=3)
+        verificador = VerificadorDisponibilidad()
+        with self.assertNumQueries(3):
+            verificador.verificar(self.nutri.id, self.ubicacion.id, self.tipo, self.inicio + tarde, self.fin + tarde)
+        # La configuración queda memoizada: solo la consulta de verificación
+        with self.assertNumQueries(1):
+            verificador.verificar(
+                self.nutri.id, self.ubicacion.id, self.tipo,
+                self.inicio + 2 * tarde, self.fin + 2 * tarde,
+            )
+
+    def test_mismas_reglas_que_el_motor_de_slots(self):
+        self.assertIsNone(self.motivo(self.inicio))
+        # Con el buffer previo (10 min) el turno de las 8:00 empieza antes del horario
+        self.assertEqual(self.motivo(self.inicio.replace(hour=8)), 'fuera_de_horario')
+        self.assertEqual(self.motivo(self.inicio + datetime.timedelta(days=90)), 'fuera_de_ventana')
+
+        BloqueoDisponibilidad.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion,
+            start_time=self.inicio + datetime.timedelta(hours=2), end_time=self.inicio + datetime.timedelta(hours=3),
+        )
+        self.assertEqual(self.motivo(self.inicio + datetime.timedelta(hours=2, minutes=30)), 'bloqueado')
+
+        Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=self.inicio, end_time=self.fin, state=TurnoState.RESERVADO,
+        )
+        # Empieza cuando termina el otro, pero los buffers se pisan
+        self.assertEqual(self.motivo(self.fin), 'ocupado')
+        self.assertIsNone(self.motivo(self.fin + datetime.timedelta(minutes=20)))
+
+    def test_reserva_publica_rechaza_fuera_de_horario(self):
+        inicio = self.inicio.replace(hour=19)
+        response = APIClient().post(reverse('public-turno-create'), {
+            'nutricionista': self.nutri.id,
+            'ubicacion': self.ubicacion.id,
+            'tipo_consulta': self.tipo.id,
+            'start_time': inicio.isoformat(),
+            'end_time': (inicio + datetime.timedelta(minutes=self.tipo.duracion_min)).isoformat(),
+            'nombre_completo': 'Paciente Nocturno',
+            'email': 'nocturno@example.com',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Turno.objects.exists())
+
+
+class SerieDeTurnosTest(TestCase):
+    """Una serie semanal se valida por lotes y se inserta con un solo INSERT."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        user = UserAccount.objects.create_user(dni="40111222", email="paciente@test.com", password="secreta123")
+        self.paciente = Paciente.objects.create(user=user, nombre="Juan", apellido="Gómez", genero="M")
+        AsignacionNutricionistaPaciente.objects.create(nutricionista=self.nutri, paciente=self.paciente)
+        self.inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(11, 0)
+        ))
+        self.fin = self.inicio + datetime.timedelta(minutes=self.tipo.duracion_min)
+        self.client = APIClient()
+        self.client.force_authenticate(self.nutri.user)
+        self.url = reverse('turno-serie')
+
+    def pedir_serie(self, repeticiones=12, inicio=None, **extra):
+        inicio = inicio or self.inicio
+        return self.client.post(self.url, {
+            'paciente_id': self.paciente.id,
+            'ubicacion_id': self.ubicacion.id,
+            'tipo_consulta_id': self.tipo.id,
+            'slot_inicio': inicio.isoformat(),
+            'slot_fin': (inicio + (self.fin - self.inicio)).isoformat(),
+            'repeticiones': repeticiones,
+            **extra,
+        }, format='json')
+
+    def test_verificacion_por_lotes_en_consultas_fijas(self):
+        crear_turnos(self.nutri, self.ubicacion, self.tipo, dias=90, desde=timezone.localdate())
+        rangos = ocurrencias_semanales(self.inicio, self.fin, 12)
+        # settings + zonas horarias + horarios + bloqueos + turnos, sin importar las ocurrencias
+        with self.assertNumQueries(5):
+            revision = VerificadorDisponibilidad().verificar_serie(
+                self.nutri.id, self.ubicacion.id, self.tipo, rangos, anticipacion=False
+            )
+        self.assertEqual(revision, [None] * 12)
+
+    def test_consultas_no_crecen_con_las_repeticiones(self):
+        def consultas(repeticiones, inicio):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.pedir_serie(repeticiones, inicio=inicio)
+            self.assertEqual(response.status_code, 201, response.data)
+            return len([q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']])
+
+        self.assertEqual(
+            consultas(2, self.inicio),
+            consultas(12, self.inicio + datetime.timedelta(hours=2)),
+        )
+        self.assertEqual(Turno.objects.filter(state=TurnoState.CONFIRMADO).count(), 14)
+
+    def test_refresca_solo_los_dias_de_las_ocurrencias(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.pedir_serie(repeticiones=4)
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(
+            set(DisponibilidadDia.objects.filter(nutricionista=self.nutri).values_list('fecha', flat=True)),
+            {timezone.localdate(self.inicio) + datetime.timedelta(weeks=i) for i in range(4)},
+        )
+
+    def test_informa_conflictos_por_ocurrencia(self):
+        semana = datetime.timedelta(weeks=1)
+        BloqueoDisponibilidad.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion,
+            start_time=self.inicio + 2 * semana, end_time=self.fin + 2 * semana,
+        )
+        Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=self.fin + 5 * semana, end_time=self.fin + 5 * semana + (self.fin - self.inicio),
+            state=TurnoState.RESERVADO,
+        )
+
+        response = self.pedir_serie()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual([c['motivo'] for c in response.data['conflictos']], ['bloqueado', 'ocupado'])
+        self.assertEqual(Turno.objects.count(), 1)
+
+        response = self.pedir_serie(omitir_conflictos=True)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['turnos']), 10)
+        self.assertEqual(len(response.data['conflictos']), 2)
+        creados = Turno.objects.filter(paciente=self.paciente, state=TurnoState.CONFIRMADO)
+        self.assertEqual(creados.count(), 10)
+        self.assertTrue(all(t.busy_range is not None and t.source == 'interno' for t in creados))
+
+    def test_paciente_no_asignado(self):
+        AsignacionNutricionistaPaciente.objects.update(activo=False)
+        response = self.pedir_serie()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Turno.objects.exists())
+
+
+class TransicionesTurnoTest(TestCase):
+    """Los cambios de estado son UPDATEs condicionales sobre TRANSICIONES_TURNO."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(10, 0)
+        ))
+        self.turno = Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=inicio, end_time=inicio + datetime.timedelta(minutes=30),
+            state=TurnoState.TENTATIVO, intake_answers={'email': 'p@example.com'},
+        )
+
+    def test_un_update_que_solo_escribe_el_estado(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(self.turno.transicionar(TurnoState.CONFIRMADO))
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"state" IN', updates[0])
+        self.assertNotIn('intake_answers', updates[0])
+        self.turno.refresh_from_db()
+        self.assertEqual(self.turno.state, TurnoState.CONFIRMADO)
+
+    def test_instancia_desactualizada_no_pisa_el_estado(self):
+        otra = Turno.objects.get(pk=self.turno.pk)
+        self.assertTrue(otra.transicionar(TurnoState.CANCELADO))
+        # Esta instancia todavía cree que el turno está TENTATIVO
+        self.assertFalse(self.turno.transicionar(TurnoState.CONFIRMADO))
+        self.assertEqual(self.turno.state, TurnoState.TENTATIVO)
+        self.assertEqual(Turno.objects.get(pk=self.turno.pk).state, TurnoState.CANCELADO)
+
+    def test_transicion_en_lote_ignora_estados_no_permitidos(self):
+        atendido = Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=self.turno.start_time + datetime.timedelta(hours=2),
+            end_time=self.turno.end_time + datetime.timedelta(hours=2),
+            state=TurnoState.ATENDIDO,
+        )
+        cancelados = Turno.objects.filter(pk__in=[self.turno.pk, atendido.pk]).transicionar(TurnoState.CANCELADO)
+        self.assertEqual(cancelados, [self.turno.pk])
+        self.assertEqual(Turno.objects.get(pk=atendido.pk).state, TurnoState.ATENDIDO)
+
+    def test_aprobar_un_turno_cancelado_entre_lectura_y_escritura(self):
+        client = APIClient()
+        client.force_authenticate(self.nutri.user)
+        original = Turno.transicionar
+
+        def cancelado_antes(turno, destino, **kwargs):
+            # Otro request cancela el turno justo antes del UPDATE de la aprobación
+            Turno.objects.filter(pk=turno.pk).update(state=TurnoState.CANCELADO)
+            return original(turno, destino, **kwargs)
+
+        with mock.patch.object(Turno, 'transicionar', cancelado_antes):
+            response = client.post(reverse('turno-aprobar', args=[self.turno.pk]))
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("cambió de estado", response.data['error'])
+        self.assertEqual(Turno.objects.get(pk=self.turno.pk).state, TurnoState.CANCELADO)
+
+
+class TransicionesEnLoteTest(TestCase):
+    """Aprobar/cancelar en lote: una consulta de validación, un UPDATE, una tarea de avisos."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.client = APIClient()
+        self.client.force_authenticate(self.nutri.user)
+        self.url = reverse('turno-lote')
+        self.manana = timezone.localdate() + datetime.timedelta(days=2)
+
+    def solicitud(self, hora, minuto=0, **kwargs):
+        inicio = timezone.make_aware(datetime.datetime.combine(self.manana, datetime.time(hora, minuto)))
+        return Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=inicio, end_time=inicio + datetime.timedelta(minutes=self.tipo.duracion_min),
+            state=kwargs.pop('state', TurnoState.TENTATIVO),
+            intake_answers={'email': f'p{hora}{minuto}@example.com', 'nombre_completo': 'Paciente'},
+            **kwargs,
+        )
+
+    def pedir(self, ids, estado):
+        with mock.patch('apps.agenda.notificaciones.send_notification_emails_batch') as tarea:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.url, {'ids': ids, 'estado': estado}, format='json')
+        return response, tarea
+
+    def test_aprueba_el_lote_y_informa_rechazos(self):
+        libres = [self.solicitud(hora) for hora in (9, 11, 13, 15)]
+        pisado = self.solicitud(15, 20)     # se pisa (buffers incluidos) con el de las 15:00
+        afuera = self.solicitud(17, 50)     # termina después de las 18:00
+        BloqueoDisponibilidad.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion,
+            start_time=libres[2].start_time, end_time=libres[2].end_time,
+        )
+        ids = [t.id for t in libres] + [pisado.id, afuera.id, 999999]
+
+        response, tarea = self.pedir(ids, TurnoState.CONFIRMADO)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['aplicados']), [libres[0].id, libres[1].id, libres[3].id])
+        motivos = {r['id']: r['motivo'] for r in response.data['rechazados']}
+        self.assertEqual(motivos, {
+            libres[2].id: 'bloqueado', pisado.id: 'lote', afuera.id: 'fuera_de_horario', 999999: 'no_encontrado',
+        })
+        self.assertEqual(Turno.objects.filter(state=TurnoState.CONFIRMADO).count(), 3)
+        # Un solo mensaje a la cola con los tres avisos
+        tarea.apply_async.assert_called_once()
+        (log_ids,) = tarea.apply_async.call_args.kwargs['args']
+        self.assertEqual(len(log_ids), 3)
+
+    def test_consultas_fijas_con_un_solo_update(self):
+        def contar(n, hora_inicial):
+            # Sin buffers, un turno cada media hora
+            ids = [self.solicitud(hora_inicial + i // 2, 30 * (i % 2)).id for i in range(n)]
+            with CaptureQueriesContext(connection) as ctx:
+                response, _ = self.pedir(ids, TurnoState.CONFIRMADO)
+            self.assertEqual(len(response.data['aplicados']), n, response.data)
+            sql = [q['sql'] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+            self.assertEqual(len([q for q in sql if q.startswith('UPDATE') and "'CONFIRMADO'" in q]), 1)
+            return len(sql)
+
+        self.tipo.buffer_before_min = self.tipo.buffer_after_min = 0
+        self.tipo.save()
+        self.assertEqual(contar(2, 9), contar(6, 13))
+
+    def test_cancela_solo_los_estados_permitidos(self):
+        confirmado = self.solicitud(9, state=TurnoState.CONFIRMADO)
+        atendido = self.solicitud(11, state=TurnoState.ATENDIDO)
+        response, tarea = self.pedir([confirmado.id, atendido.id], TurnoState.CANCELADO)
+        self.assertEqual(response.data['aplicados'], [confirmado.id])
+        self.assertEqual(response.data['rechazados'][0]['motivo'], 'estado')
+        self.assertEqual(Turno.objects.get(pk=atendido.pk).state, TurnoState.ATENDIDO)
+        tarea.apply_async.assert_called_once()
+
+    def test_la_tarea_del_lote_envia_cada_aviso(self):
+        turno = self.solicitud(9)
+        logs = NotificationLog.objects.bulk_create([
+            NotificationLog(turno=turno, channel='email', template='turno_confirmado_paciente', payload={
+                'destinatario': f'p{i}@example.com', 'nombre_nutri': 'Ana', 'fecha_hora_inicio': 'mañana',
+            })
+            for i in range(3)
+        ])
+        self.assertEqual(send_notification_emails_batch([log.id for log in logs]), 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(NotificationLog.objects.filter(sent_at__isnull=True).exists())
+
+    def test_no_toca_turnos_de_otro_nutricionista(self):
+        otro, ubicacion, tipo = crear_agenda(dni="30999888", email="otra@test.com")
+        inicio = timezone.make_aware(datetime.datetime.combine(self.manana, datetime.time(10, 0)))
+        ajeno = Turno.objects.create(
+            nutricionista=otro, ubicacion=ubicacion, tipo_consulta=tipo, start_time=inicio,
+            end_time=inicio + datetime.timedelta(minutes=30), state=TurnoState.CONFIRMADO,
+        )
+        response, _ = self.pedir([ajeno.id], TurnoState.CANCELADO)
+        self.assertEqual(response.data['rechazados'][0]['motivo'], 'no_encontrado')
+        self.assertEqual(Turno.objects.get(pk=ajeno.pk).state, TurnoState.CONFIRMADO)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend')
+class PoolSMTPTest(TestCase):
+    """Conexiones SMTP reutilizadas entre envíos y config de email recordada por proceso."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        Nutricionista.objects.filter(pk=self.nutri.pk).update(
+            email_host='smtp.ejemplo.com', email_port=587, email_username='ana@ejemplo.com', email_password='clave',
+        )
+        correo._remitentes.clear()
+        self.pool = correo.PoolSMTP()
+        patcher = mock.patch('django.core.mail.backends.smtp.smtplib.SMTP')
+        self.smtp = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.smtp.return_value.noop.return_value = (250, b'OK')
+
+    def enviar(self, remitente=None):
+        remitente = remitente or correo.remitente_para(self.nutri.id)
+        with self.pool.conexion(remitente) as conexion:
+            send_mail('Asunto', 'Cuerpo', remitente.from_email, ['p@example.com'], connection=conexion)
+
+    def test_reutiliza_la_conexion_entre_envios(self):
+        for _ in range(3):
+            self.enviar()
+        self.smtp.assert_called_once_with('smtp.ejemplo.com', 587, local_hostname=mock.ANY)
+        self.smtp.return_value.login.assert_called_once_with('ana@ejemplo.com', 'clave')
+        self.assertEqual(self.smtp.return_value.sendmail.call_count, 3)
+
+    def test_descarta_conexiones_cortadas_por_el_servidor(self):
+        self.enviar()
+        self.pool.verificar_despues = 0
+        self.smtp.return_value.noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.enviar()
+        self.assertEqual(self.smtp.call_count, 2)
+
+    def test_cierra_las_conexiones_inactivas(self):
+        self.enviar()
+        self.assertEqual(self.pool.cerrar_inactivas(ahora=time.monotonic() + self.pool.inactividad + 1), 1)
+        self.smtp.return_value.quit.assert_called_once()
+        self.enviar()
+        self.assertEqual(self.smtp.call_count, 2)
+
+    def test_un_envio_fallido_no_devuelve_la_conexion(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.conexion(correo.remitente_para(self.nutri.id)):
+                raise RuntimeError
+        self.enviar()
+        self.assertEqual(self.smtp.call_count, 2)
+
+    def test_recuerda_la_config_hasta_que_cambia(self):
+        with self.assertNumQueries(1):
+            correo.remitente_para(self.nutri.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(correo.remitente_para(self.nutri.id).host, 'smtp.ejemplo.com')
+
+        nutri = Nutricionista.objects.get(pk=self.nutri.pk)
+        nutri.email_host = 'smtp.otro.com'
+        with self.captureOnCommitCallbacks(execute=True):
+            nutri.save()
+        self.assertEqual(correo.remitente_para(self.nutri.id).host, 'smtp.otro.com')
+
+    def test_la_tarea_envia_por_el_pool(self):
+        inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(10, 0)
+        ))
+        turno = Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=inicio, end_time=inicio + datetime.timedelta(minutes=30),
+        )
+        logs = NotificationLog.objects.bulk_create([
+            NotificationLog(turno=turno, channel='email', template='turno_confirmado_paciente', payload={
+                'destinatario': f'p{i}@example.com', 'nutricionista_id': self.nutri.id, 'nombre_nutri': 'Ana',
+            })
+            for i in range(2)
+        ])
+        with mock.patch('apps.agenda.tasks.smtp_pool', self.pool):
+            self.assertEqual(send_notification_emails_batch([log.id for log in logs]), 2)
+        self.smtp.assert_called_once()
+        remitentes = [c.args[0] for c in self.smtp.return_value.sendmail.call_args_list]
+        self.assertEqual(remitentes, ['ana@ejemplo.com', 'ana@ejemplo.com'])
+        self.assertEqual(NotificationLog.objects.filter(delivered=True).count(), 2)
+
+
+PAYLOAD_TURNO = {
+    'destinatario': 'p@example.com', 'nombre_paciente': 'Lía', 'nombre_nutri': 'Ana Pérez',
+    'tipo_consulta': 'Inicial', 'fecha_hora_inicio': '2030-01-07T10:00:00-03:00', 'ubicacion_nombre': 'Sede Centro',
+}
+
+
+class OutboxNotificacionesTest(TestCase):
+    """Los avisos se guardan con la transacción y se publican al confirmar, en lotes por remitente."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=2), datetime.time(10, 0)
+        ))
+        self.turno = Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=inicio, end_time=inicio + datetime.timedelta(minutes=30), state=TurnoState.TENTATIVO,
+            soft_hold_expires_at=timezone.now() + datetime.timedelta(minutes=10),
+            intake_answers={'email': 'publico@example.com', 'nombre_completo': 'Paciente Público'},
+        )
+        patcher = mock.patch('apps.agenda.notificaciones.send_notification_emails_batch')
+        self.tarea = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def log(self, nutricionista_id=None, **kwargs):
+        return NotificationLog(
+            turno=self.turno, channel='email', template='turno_confirmado_paciente',
+            payload={**PAYLOAD_TURNO, 'nutricionista_id': nutricionista_id or self.nutri.id}, **kwargs,
+        )
+
+    def test_verificacion_publica_ambos_avisos_en_un_lote(self):
+        token = MagicLinkToken.objects.create(
+            turno=self.turno, action=MagicAction.CONFIRM, expires_at=self.turno.soft_hold_expires_at,
+        )
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = APIClient().post(reverse('public-turno-verify'), {'token': str(token.token)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        # Nada sale a la cola antes de confirmar
+        self.tarea.apply_async.assert_not_called()
+        for callback in callbacks:
+            callback()
+        self.tarea.apply_async.assert_called_once()
+        (log_ids,) = self.tarea.apply_async.call_args.kwargs['args']
+        self.assertEqual(len(log_ids), 2)
+        self.assertFalse(NotificationLog.objects.filter(published_at__isnull=True).exists())
+
+    def test_si_la_transaccion_se_revierte_no_hay_aviso(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                notificar([self.log()])
+                raise RuntimeError
+        self.assertFalse(NotificationLog.objects.exists())
+        self.tarea.apply_async.assert_not_called()
+
+    def test_agrupa_por_remitente_en_lotes(self):
+        otro, _, _ = crear_agenda(dni="30999888", email="otra@test.com")
+        with mock.patch('apps.agenda.notificaciones.LOTE_ENVIO', 2), self.captureOnCommitCallbacks(execute=True):
+            notificar([self.log() for _ in range(3)] + [self.log(otro.id) for _ in range(2)])
+        lotes = [llamada.kwargs['args'][0] for llamada in self.tarea.apply_async.call_args_list]
+        self.assertEqual(sorted(len(lote) for lote in lotes), [1, 2, 2])
+        for lote in lotes:
+            remitentes = NotificationLog.objects.filter(pk__in=lote).values_list('payload__nutricionista_id', flat=True)
+            self.assertEqual(len(set(remitentes)), 1)
+
+    def test_republica_lo_no_publicado_o_perdido(self):
+        ahora = timezone.now()
+        sin_publicar, perdido, reciente, enviado = NotificationLog.objects.bulk_create([
+            self.log(),
+            self.log(published_at=ahora - datetime.timedelta(minutes=30)),
+            self.log(published_at=ahora),
+            self.log(published_at=ahora - datetime.timedelta(minutes=30), sent_at=ahora),
+        ])
+        self.assertEqual(publicar_pendientes(now=ahora), 1)
+        (log_ids,) = self.tarea.apply_async.call_args.kwargs['args']
+        self.assertEqual(sorted(log_ids), [sin_publicar.id, perdido.id])
+
+    def test_si_el_broker_falla_el_lote_queda_para_republicar(self):
+        self.tarea.apply_async.side_effect = [ConnectionRefusedError('broker caído'), None]
+        with mock.patch('apps.agenda.notificaciones.LOTE_ENVIO', 2), self.captureOnCommitCallbacks(execute=True):
+            logs = notificar([self.log() for _ in range(3)])
+        # El error no sale del on_commit: solo el lote rechazado vuelve a quedar sin publicar
+        rechazado = self.tarea.apply_async.call_args_list[0].kwargs['args'][0]
+        self.assertEqual(
+            set(NotificationLog.objects.filter(published_at__isnull=True).values_list('id', flat=True)),
+            set(rechazado),
+        )
+        self.assertEqual(metrics.valor('notificaciones_publicacion_fallida'), len(rechazado))
+
+        self.tarea.apply_async.side_effect = None
+        self.assertEqual(publicar_pendientes(), 1)
+        self.assertEqual(sorted(self.tarea.apply_async.call_args.kwargs['args'][0]), sorted(rechazado))
+        self.assertEqual(len(logs), 3)
+
+    def test_un_log_publicado_dos_veces_se_envia_una_vez(self):
+        logs = NotificationLog.objects.bulk_create([self.log() for _ in range(3)])
+        log_ids = [log.id for log in logs]
+        self.assertEqual(send_notification_emails_batch(log_ids), 3)
+        self.assertEqual(send_notification_emails_batch(log_ids), 0)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(NotificationLog.objects.filter(delivered=True).count(), 3)
+
+    def test_los_logs_se_reclaman_antes_de_enviar(self):
+        logs = NotificationLog.objects.bulk_create([self.log() for _ in range(3)])
+        log_ids = [log.id for log in logs]
+        abrir = correo.pool.conexion
+        duplicada = []
+
+        @contextmanager
+        def conexion_de(remitente):
+            # Otra tarea con los mismos logs mientras esta envía
+            duplicada.append(send_notification_emails_batch(log_ids))
+            with abrir(remitente) as conexion:
+                yield conexion
+
+        with mock.patch('apps.agenda.tasks.smtp_pool.conexion', conexion_de):
+            self.assertEqual(send_notification_emails_batch(log_ids), 3)
+        self.assertEqual(duplicada, [0])
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_un_reclamo_vencido_se_puede_retomar(self):
+        ahora = timezone.now()
+        vencido, vigente = NotificationLog.objects.bulk_create([
+            self.log(claimed_at=ahora - datetime.timedelta(minutes=6)),
+            self.log(claimed_at=ahora - datetime.timedelta(minutes=1)),
+        ])
+        self.assertEqual(send_notification_emails_batch([vencido.id, vigente.id]), 1)
+        self.assertIsNotNone(NotificationLog.objects.get(pk=vencido.pk).sent_at)
+        self.assertIsNone(NotificationLog.objects.get(pk=vigente.pk).sent_at)
+
+
+class PlantillasEmailTest(TestCase):
+    """Plantillas compiladas una vez por proceso, validadas al encolar y versionadas."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        plantillas._compiladas.clear()
+
+    def test_todas_las_plantillas_renderizan(self):
+        payload = {
+            **PAYLOAD_TURNO, 'nombre_nutri': 'Ana & Co', 'verification_url': 'https://x.test/c/1?a=1&b=2',
+            'email_paciente': 'p@example.com', 'telefono_paciente': '-',
+        }
+        for nombre in plantillas.PLANTILLAS:
+            plantillas.validar_payload(nombre, payload)
+            email = plantillas.renderizar(nombre, payload)
+            self.assertTrue(email.asunto and '\n' not in email.asunto, nombre)
+            # El texto va sin escapar; el HTML, escapado
+            self.assertIn('Ana & Co', email.texto)
+            self.assertIn('Ana &amp; Co', email.html)
+        self.assertIn('https://x.test/c/1?a=1&b=2', plantillas.renderizar('public_booking_verification', payload).texto)
+
+    def test_compila_una_sola_vez(self):
+        with mock.patch('apps.agenda.plantillas.get_template', wraps=plantillas.get_template) as cargar:
+            for i in range(3):
+                plantillas.renderizar('turno_cancelado_paciente', {**PAYLOAD_TURNO, 'destinatario': f'p{i}@example.com'})
+        self.assertEqual(cargar.call_count, len(plantillas.ARCHIVOS))
+
+    def test_payload_incompleto_falla_al_encolar(self):
+        incompleto = {k: v for k, v in PAYLOAD_TURNO.items() if k != 'ubicacion_nombre'}
+        logs = [
+            NotificationLog(channel='email', template='turno_confirmado_paciente', payload=incompleto),
+            NotificationLog(channel='email', template='no_existe', payload=PAYLOAD_TURNO),
+        ]
+        with mock.patch('apps.agenda.notificaciones.send_notification_emails_batch') as tarea:
+            with self.captureOnCommitCallbacks(execute=True):
+                notificar(logs)
+        tarea.apply_async.assert_not_called()
+        self.assertEqual(NotificationLog.objects.filter(sent_at__isnull=False, delivered=False).count(), 2)
+        self.assertIn('ubicacion_nombre', NotificationLog.objects.get(template='turno_confirmado_paciente').delivery_meta['error'])
+
+    def test_el_worker_marca_las_plantillas_desconocidas(self):
+        desconocido, valido = NotificationLog.objects.bulk_create([
+            NotificationLog(channel='email', template='no_existe', payload=PAYLOAD_TURNO),
+            NotificationLog(channel='email', template='turno_confirmado_paciente', payload=PAYLOAD_TURNO),
+        ])
+        self.assertEqual(send_notification_emails_batch([desconocido.id, valido.id]), 1)
+        desconocido.refresh_from_db()
+        valido.refresh_from_db()
+        # Procesado (no queda pendiente para siempre) y fallido
+        self.assertIsNotNone(desconocido.sent_at)
+        self.assertFalse(desconocido.delivered)
+        _, version = plantillas.compilar('turno_confirmado_paciente')
+        self.assertEqual(valido.delivery_meta['plantilla_version'], version)
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+
+
+class LimiteDeEnvioTest(TestCase):
+    """Token bucket por remitente compartido vía caché y reprogramación con backoff."""
+
+    def setUp(self):
+        cache.clear()
+        correo._remitentes.clear()
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        Nutricionista.objects.filter(pk=self.nutri.pk).update(
+            email_host='smtp.ejemplo.com', email_port=587, email_username='ana@ejemplo.com', email_password='clave',
+        )
+
+    def test_balde_rellena_a_la_tasa_y_no_acumula_de_mas(self):
+        limite = LimiteDeEnvio(capacidad=3, por_minuto=60)
+        self.assertEqual(limite.tomar('balde', 5, ahora=1000), (3, 1))
+        self.assertEqual(limite.tomar('balde', ahora=1000.5), (0, 0.5))
+        self.assertEqual(limite.tomar('balde', ahora=1001), (1, 0))
+        # Una hora sin envíos vuelve a llenar el balde, pero no más que la capacidad
+        self.assertEqual(limite.tomar('balde', 5, ahora=4600), (3, 1))
+
+    def test_backoff_exponencial_con_tope(self):
+        with mock.patch('apps.agenda.limite_envio.random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual([backoff(i) for i in (0, 1, 3)], [5, 10, 40])
+            self.assertEqual(backoff(20), 300)
+            self.assertEqual(backoff(0, minimo=2), 7)
+        self.assertTrue(all(0 <= backoff(2) <= 20 for _ in range(50)))
+
+    def test_lo_que_excede_el_limite_se_reprograma_sin_gastar_reintentos(self):
+        logs = NotificationLog.objects.bulk_create([
+            NotificationLog(channel='email', template='turno_confirmado_paciente', payload={
+                **PAYLOAD_TURNO, 'destinatario': f'p{i}@example.com', 'nutricionista_id': self.nutri.id,
+            })
+            for i in range(3)
+        ])
+        log_ids = [log.id for log in logs]
+        with mock.patch('apps.agenda.limite_envio.RAFAGA', 2), \
+                mock.patch.object(send_notification_emails_batch, 'apply_async') as reprogramar:
+            self.assertEqual(send_notification_emails_batch(log_ids), 2)
+        self.assertEqual(len(mail.outbox), 2)
+        reprogramar.assert_called_once()
+        _, kwargs = reprogramar.call_args
+        self.assertEqual(kwargs['args'], ([log_ids[2]],))
+        self.assertEqual(kwargs['kwargs'], {'demoras': 1})
+        self.assertEqual(kwargs['queue'], 'notificaciones_masivas')
+        self.assertGreater(kwargs['countdown'], 0)
+        demorado = NotificationLog.objects.get(pk=log_ids[2])
+        self.assertIsNone(demorado.sent_at)
+        self.assertIsNotNone(demorado.published_at)
+        self.assertEqual(metrics.valor('emails_limitados', remitente=self.nutri.id), 1)
+
+    def test_un_error_smtp_se_reintenta_y_recien_al_agotarse_queda_fallido(self):
+        def log_pendiente():
+            return NotificationLog.objects.create(channel='email', template='turno_confirmado_paciente', payload={
+                **PAYLOAD_TURNO, 'nutricionista_id': self.nutri.id,
+            })
+
+        conexion = mock.Mock()
+
+        @contextmanager
+        def conexion_de(remitente):
+            yield conexion
+
+        # apply() ejecuta los reintentos en el momento
+        with mock.patch('apps.agenda.tasks.smtp_pool.conexion', conexion_de), \
+                mock.patch('apps.agenda.tasks.backoff', return_value=1) as backoff_de_tarea:
+            conexion.send_messages.side_effect = [smtplib.SMTPServerDisconnected('cortada'), 1]
+            log = log_pendiente()
+            send_notification_email.apply(args=(log.id,))
+            log.refresh_from_db()
+            self.assertTrue(log.delivered)
+            self.assertEqual(conexion.send_messages.call_count, 2)
+            backoff_de_tarea.assert_called_once()
+
+            conexion.send_messages.reset_mock()
+            conexion.send_messages.side_effect = smtplib.SMTPServerDisconnected('cortada')
+            log = log_pendiente()
+            send_notification_email.apply(args=(log.id,))
+            log.refresh_from_db()
+            self.assertFalse(log.delivered)
+            self.assertEqual(log.delivery_meta['error'], 'cortada')
+            self.assertEqual(conexion.send_messages.call_count, send_notification_email.max_retries + 1)
+
+    def test_mide_la_profundidad_de_la_cola(self):
+        ahora = timezone.now()
+        NotificationLog.objects.bulk_create([
+            NotificationLog(channel='email', template='turno_confirmado_paciente', payload=PAYLOAD_TURNO),
+            NotificationLog(channel='email', template='turno_confirmado_paciente', payload=PAYLOAD_TURNO,
+                            published_at=ahora - datetime.timedelta(seconds=90)),
+            NotificationLog(channel='email', template='turno_confirmado_paciente', payload=PAYLOAD_TURNO,
+                            published_at=ahora - datetime.timedelta(hours=1), sent_at=ahora),
+        ])
+        self.assertEqual(medir_cola(now=ahora), (2, 90))
+        self.assertEqual(metrics.valor('notificaciones_pendientes'), 2)
+
+
+class ColasDeNotificacionesTest(TestCase):
+    """Cada plantilla sale por la cola de su prioridad (con un broker en memoria)."""
+
+    COLAS = ('notificaciones_criticas', 'notificaciones_masivas', 'celery')
+
+    def setUp(self):
+        self.nutri, _, _ = crear_agenda()
+
+    def log(self, template, **payload):
+        return NotificationLog(channel='email', template=template, payload={
+            **PAYLOAD_TURNO, 'nutricionista_id': self.nutri.id, **payload,
+        })
+
+    def test_la_verificacion_no_espera_detras_de_los_avisos_masivos(self):
+        masivos = [self.log('turno_confirmado_paciente', destinatario=f'p{i}@example.com') for i in range(5)]
+        verificacion = self.log('public_booking_verification', verification_url='https://x.test/c/1')
+
+        with celery_app.connection_for_write('memory://') as conexion:
+            colas = {nombre: conexion.SimpleQueue(nombre) for nombre in self.COLAS}
+            for cola in colas.values():
+                cola.clear()
+            publicar_en_memoria = functools.partial(send_notification_emails_batch.apply_async, connection=conexion)
+            with mock.patch.object(send_notification_emails_batch, 'apply_async', side_effect=publicar_en_memoria) as publicar:
+                with self.captureOnCommitCallbacks(execute=True):
+                    notificar(masivos + [verificacion])
+
+            recibidos = {}
+            for nombre, cola in colas.items():
+                recibidos[nombre] = []
+                while True:
+                    try:
+                        mensaje = cola.get(block=False)
+                    except Empty:
+                        break
+                    self.assertEqual(mensaje.headers['task'], 'apps.agenda.tasks.send_notification_emails_batch')
+                    recibidos[nombre].append(mensaje.payload[0][0])
+                    mensaje.ack()
+                cola.close()
+
+        self.assertEqual(recibidos['notificaciones_criticas'], [[verificacion.id]])
+        self.assertEqual(recibidos['notificaciones_masivas'], [[log.id for log in masivos]])
+        self.assertEqual(recibidos['celery'], [])
+        # Los lotes críticos se publican primero
+        self.assertEqual(publicar.call_args_list[0].kwargs['queue'], 'notificaciones_criticas')
+
+    def test_todas_las_plantillas_declaran_una_prioridad(self):
+        for nombre, plantilla in plantillas.PLANTILLAS.items():
+            self.assertIn(plantilla.prioridad, colas.COLAS, nombre)
+        self.assertEqual(plantillas.prioridad_de('public_booking_verification'), colas.CRITICA)
+
+    def test_concurrencia_declarada_por_cola(self):
+        conf = SimpleNamespace(worker_concurrency=None)
+        colas.aplicar_concurrencia(conf, {'queues': ['notificaciones_criticas'], 'concurrency': None})
+        self.assertEqual(conf.worker_concurrency, colas.COLAS[colas.CRITICA]['concurrencia'])
+        # Con -c explícito o varias colas, no se toca
+        for options in ({'queues': ['notificaciones_masivas'], 'concurrency': 8},
+                        {'queues': ['celery', 'notificaciones_masivas'], 'concurrency': None}):
+            conf = SimpleNamespace(worker_concurrency=None)
+            colas.aplicar_concurrencia(conf, options)
+            self.assertIsNone(conf.worker_concurrency)
+
+
+class MisTurnosKeysetTest(TestCase):
+    """mis-turnos se pagina por (start_time, id) y exporta en streaming."""
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        self.client = APIClient()
+        self.client.force_authenticate(self.nutri.user)
+        self.url = reverse('turno-mis-turnos')
+        # 25 turnos en los próximos días (de a dos por día, el segundo público)
+        for i in range(25):
+            inicio = timezone.make_aware(datetime.datetime.combine(
+                timezone.localdate() + datetime.timedelta(days=1 + i // 2), datetime.time(9 + 2 * (i % 2), 0)
+            ))
+            Turno.objects.create(
+                nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+                start_time=inicio, end_time=inicio + datetime.timedelta(minutes=30),
+                state=TurnoState.RESERVADO,
+                intake_answers={'nombre_completo': f'Paciente {i}', 'email': f'p{i}@example.com'} if i % 2 else None,
+            )
+        # Uno de hace un año: fuera de la ventana por defecto
+        self.viejo = Turno.objects.create(
+            nutricionista=self.nutri, ubicacion=self.ubicacion, tipo_consulta=self.tipo,
+            start_time=timezone.now() - datetime.timedelta(days=365),
+            end_time=timezone.now() - datetime.timedelta(days=365) + datetime.timedelta(minutes=30),
+            state=TurnoState.ATENDIDO,
+        )
+
+    def test_recorre_todas_las_paginas_en_orden(self):
+        ids, cursor, paginas = [], None, 0
+        while True:
+            params = {'limite': 10, **({'cursor': cursor} if cursor else {})}
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            # Una sola consulta de turnos por página, sin importar cuántas filas trae
+            self.assertEqual(len([q for q in ctx.captured_queries if 'FROM "agenda_turno"' in q['sql']]), 1)
+            ids += [fila['id'] for fila in response.data]
+            paginas += 1
+            cursor = response.get('X-Next-Cursor')
+            if not cursor:
+                break
+        self.assertEqual(paginas, 3)
+        esperados = list(Turno.objects.exclude(pk=self.viejo.pk).order_by('start_time', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, esperados)
+
+    def test_forma_de_las_filas(self):
+        filas = self.client.get(self.url, {'limite': 2}).data
+        self.assertEqual(filas[0]['ubicacion_nombre'], 'Sede Centro')
+        self.assertIn('tipo_consulta_display', filas[0])
+        self.assertEqual(filas[1]['paciente_nombre'], 'Paciente')
+        self.assertEqual(filas[1]['paciente_email'], 'p1@example.com')
+
+    def test_vista_calendario(self):
+        user = UserAccount.objects.create_user(dni="40111222", email="juan@test.com", password="secreta123")
+        paciente = Paciente.objects.create(user=user, nombre="Juan", apellido="Gómez", genero="M")
+        primero = Turno.objects.exclude(pk=self.viejo.pk).order_by('start_time', 'id').first()
+        Turno.objects.filter(pk=primero.pk).update(paciente=paciente)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, {'vista': 'calendario', 'limite': 2})
+        self.assertEqual(len([q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]), 1)
+        filas = response.data
+        self.assertEqual(set(filas[0]), {
+            'id', 'start_time', 'end_time', 'state',
+            'paciente_nombre', 'paciente_email', 'ubicacion_nombre', 'tipo_consulta_display',
+        })
+        self.assertEqual((filas[0]['paciente_nombre'], filas[0]['paciente_email']), ('Juan Gómez', 'juan@test.com'))
+        self.assertEqual((filas[1]['paciente_nombre'], filas[1]['paciente_email']), ('Paciente 1', 'p1@example.com'))
+        self.assertEqual((filas[0]['ubicacion_nombre'], filas[0]['tipo_consulta_display']), ('Sede Centro', 'Inicial'))
+
+        # El cursor también sirve con filas proyectadas
+        siguiente = self.client.get(self.url, {'vista': 'calendario', 'limite': 2, 'cursor': response['X-Next-Cursor']})
+        self.assertEqual(
+            [f['id'] for f in filas + siguiente.data],
+            list(Turno.objects.exclude(pk=self.viejo.pk).order_by('start_time', 'id').values_list('id', flat=True)[:4]),
+        )
+
+    def test_cursor_invalido(self):
+        response = self.client.get(self.url, {'cursor': 'no-es-un-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_exportacion_en_streaming(self):
+        with mock.patch('apps.agenda.listados.LOTE_EXPORTACION', 7):
+            response = self.client.get(self.url, {'exportar': '1'})
+        self.assertTrue(response.streaming)
+        filas = json.loads(b''.join(response.streaming_content))
+        # Sin ventana por defecto: incluye el turno viejo
+        self.assertEqual(len(filas), 26)
+        self.assertEqual(filas[0]['id'], self.viejo.id)
+
+
+class ReservasConcurrentesTest(TransactionTestCase):
+    """
+    Muchas reservas públicas simultáneas sobre el mismo slot: el lock de la agenda
+    las serializa, así que exactamente una gana y el resto falla rápido.
+    """
+    INTENTOS = 50
+    LATENCIA_P99_OBJETIVO_S = 3.0
+
+    def setUp(self):
+        self.nutri, self.ubicacion, self.tipo = crear_agenda()
+        inicio = timezone.make_aware(datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=3), datetime.time(10, 0)
+        ))
+        self.datos = {
+            'nutricionista': self.nutri.id,
+            'ubicacion': self.ubicacion.id,
+            'tipo_consulta': self.tipo.id,
+            'start_time': inicio.isoformat(),
+            'end_time': (inicio + datetime.timedelta(minutes=self.tipo.duracion_min)).isoformat(),
+            'nombre_completo': 'Paciente Apurado',
+            'email': 'apurado@example.com',
+        }
+        # Calentar URLconf y vista (un GET no reserva nada)
+        self.url = reverse('public-turno-create')
+        APIClient().get(self.url)
+
+    def reservar(self, largada):
+        # La conexión de cada hilo se abre antes de la largada: se mide la reserva
+        connection.ensure_connection()
+        client = APIClient()
+        largada.wait()
+        try:
+            inicio = time.perf_counter()
+            response = client.post(self.url, self.datos, format='json')
+            return response.status_code, time.perf_counter() - inicio
+        finally:
+            connection.close()
+
+    @mock.patch('apps.agenda.notificaciones.send_notification_emails_batch')
+    def test_un_solo_ganador_entre_reservas_simultaneas(self, _):
+        largada = threading.Barrier(self.INTENTOS)
+        with ThreadPoolExecutor(max_workers=self.INTENTOS) as pool:
+            resultados = list(pool.map(lambda _: self.reservar(largada), range(self.INTENTOS)))
+
+        codigos = [codigo for codigo, _ in resultados]
+        self.assertEqual(codigos.count(201), 1, codigos)
+        # Los perdedores ven el horario tomado o la agenda ocupada, nunca un 500
+        self.assertTrue(set(codigos) <= {201, 400, 409}, codigos)
+        self.assertEqual(Turno.objects.filter(nutricionista=self.nutri).count(), 1)
+
+        latencias = sorted(latencia for _, latencia in resultados)
+        p99 = statistics.quantiles(latencias, n=100)[98]
+        self.assertLess(p99, self.LATENCIA_P99_OBJETIVO_S)
+
+    def test_agenda_tomada_falla_rapido(self):
+        tomada, soltar = threading.Event(), threading.Event()
+
+        def retener():
+            try:
+                with transaction.atomic(), agenda_bloqueada(self.nutri.id, self.ubicacion.id):
+                    tomada.set()
+                    soltar.wait(5)
+            finally:
+                connection.close()
+
+        hilo = threading.Thread(target=retener)
+        hilo.start()
+        try:
+            tomada.wait(5)
+            inicio = time.perf_counter()
+            with self.assertRaises(AgendaOcupada):
+                with transaction.atomic(), agenda_bloqueada(self.nutri.id, self.ubicacion.id, espera_ms=100):
+                    pass
+            self.assertLess(time.perf_counter() - inicio, 1)
+            # Otra ubicación del mismo profesional no espera
+            with transaction.atomic(), agenda_bloqueada(self.nutri.id, self.ubicacion.id + 1, espera_ms=100):
+                pass
+        finally:
+            soltar.set()
+            hilo.join()
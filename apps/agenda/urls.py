@@ -9,6 +9,8 @@ from .views import (
     BloqueoDisponibilidadViewSet,
     ProfessionalSettingsViewSet,
     SlotsAPIView,
+    SlotsBatchAPIView,
+    NextAvailableSlotAPIView,
     NutricionistaUbicacionesAPIView,
     NutricionistaTiposConsultaAPIView,
     TurnoViewSet, # Importar la nueva vista
@@ -44,4 +46,16 @@ urlpatterns = [
         SlotsAPIView.as_view(),
         name='nutricionista-slots'
     ),
+    # Slots de todas las combinaciones ubicación × tipo de consulta (vista de agenda)
+    path(
+        'nutricionista/<int:nutricionista_id>/slots/batch/',
+        SlotsBatchAPIView.as_view(),
+        name='nutricionista-slots-batch'
+    ),
+    # Primer slot libre dentro del horizonte de reserva
+    path(
+        'nutricionista/<int:nutricionista_id>/next-available/',
+        NextAvailableSlotAPIView.as_view(),
+        name='nutricionista-next-available'
+    ),
 ]
\ No newline at end of file
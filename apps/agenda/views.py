@@ -1,4 +1,5 @@
 from django.shortcuts import render
+from django.conf import settings as django_settings
 
 # Create your views here.
 # apps/agenda/views.py
@@ -8,6 +9,7 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from rest_framework.decorators import action
@@ -20,12 +22,13 @@ from .models import (
     ProfessionalSettings,
     Turno,
     TurnoState,
+    TRANSICIONES_TURNO,
     MagicLinkToken,
     MagicAction,
     NotificationLog, 
     NotificationChannel
 )
-from apps.user.models import UserAccount, Nutricionista, Paciente
+from apps.user.models import UserAccount, Nutricionista, Paciente, TipoConsulta
 from .serializers import (
     UbicacionSerializer, 
     TipoConsultaConfigSerializer, 
@@ -38,8 +41,35 @@ from .serializers import (
 from .permissions import IsNutriOwner
 
 from .utils import calculate_available_slots
+from .slot_cache import slots_cacheados
+from .busqueda import buscar_primeros_slots, LIMITE_POR_DEFECTO, LIMITE_MAXIMO
+from .cursores import codificar_cursor, decodificar_cursor, CursorInvalido
+from .listados import (
+    LIMITE_MAXIMO as LIMITE_MAXIMO_LISTADO,
+    LIMITE_POR_DEFECTO as LIMITE_LISTADO,
+    exportar_json,
+    iterar_paginas,
+    pagina,
+    proyectar_calendario,
+    turnos_de_agenda,
+    ventana_por_defecto,
+)
+from .idempotencia import responder_idempotente
+from .booking import (
+    AgendaOcupada,
+    ConflictoDeHorario,
+    HorarioNoReservable,
+    VerificadorDisponibilidad,
+    agenda_bloqueada,
+    liberar_holds_vencidos,
+    ocurrencias_semanales,
+    reservar_serie,
+    sin_solapes,
+    transicionar_lote,
+)
+from .availability import ResolutorBuffers, acotar_fechas, zona_horaria
 
-from .tasks import send_notification_email
+from .notificaciones import notificar
 
 from apps.user.models import Nutricionista # <-- Importamos nuestra función utilitaria
 
@@ -152,7 +182,7 @@ from rest_framework import permissions, status
 from django.shortcuts import get_object_or_404
 from apps.user.models import UserAccount
 import datetime
-from .utils import calculate_available_slots # Importar la función
+from .utils import calculate_available_slots, iter_available_slots, calculate_available_slots_batch # Importar la función
 from .serializers import TimeSlotSerializer   # Importar el serializer
 
 # ... (otros ViewSets)
@@ -199,8 +229,16 @@ class SlotsAPIView(APIView):
     """
     Vista para obtener los slots de tiempo disponibles para un nutricionista
     en un rango de fechas dado.
+
+    El rango puede ser de cualquier largo pero se responde por páginas de a lo
+    sumo DIAS_POR_PAGINA días: si quedan días por recorrer, la respuesta trae el
+    header 'X-Next-Cursor' y la página siguiente se pide repitiendo la consulta
+    con ?cursor=<valor>. Un rango de hasta 31 días entra en una sola página. Las
+    páginas terminan en la anticipación máxima del profesional, aunque el rango
+    pedido siga.
     """
     permission_classes = [permissions.IsAuthenticated] # O IsAdminUser si solo admins pueden ver todos
+    DIAS_POR_PAGINA = 31
 
     def get(self, request, nutricionista_id):
         # Obtener el perfil de nutricionista directamente por ID
@@ -238,17 +276,26 @@ class SlotsAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Validar rango de fechas (opcional, ej. no más de X días)
+        # Validar rango de fechas (el largo lo acota la paginación)
         if fecha_fin < fecha_inicio:
              return Response(
                 {"error": "La fecha de fin no puede ser anterior a la fecha de inicio."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        if (fecha_fin - fecha_inicio).days > 30: # Limitar a ~1 mes por performance
-             return Response(
-                {"error": "El rango de fechas no puede exceder los 31 días."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        # Página pedida: desde el cursor (o el inicio) y a lo sumo DIAS_POR_PAGINA días
+        pagina_inicio = fecha_inicio
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                pagina_inicio = datetime.date.fromisoformat(decodificar_cursor(cursor)['desde'])
+            except (CursorInvalido, KeyError, TypeError, ValueError):
+                return Response({"error": "Cursor inválido."}, status=status.HTTP_400_BAD_REQUEST)
+            if not fecha_inicio <= pagina_inicio <= fecha_fin:
+                return Response(
+                    {"error": "El cursor no corresponde al rango de fechas pedido."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        pagina_fin = min(pagina_inicio + datetime.timedelta(days=self.DIAS_POR_PAGINA - 1), fecha_fin)
 
         duracion_minutos = None
         if duracion_str:
@@ -288,18 +335,116 @@ class SlotsAPIView(APIView):
         # Calcular slots disponibles usando la función del utils.py (incluyendo buffers)
         slots = calculate_available_slots(
             nutricionista, 
-            fecha_inicio, 
-            fecha_fin, 
+            pagina_inicio, 
+            pagina_fin, 
             duracion_minutos, 
             ubicacion_id,
-            tipo_consulta_id
+            tipo_consulta_id,
+            materializado=django_settings.AGENDA_DISPONIBILIDAD_MATERIALIZADA
         )
 
         # Serializar los resultados
         serializer = TimeSlotSerializer(slots, many=True)
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        if pagina_fin < fecha_fin:
+            # Después de la anticipación máxima no hay slots: ahí termina la paginación
+            ventana = ResolutorBuffers(nutricionista).ventana_de_reserva(timezone.now())
+            _, ultimo_dia = acotar_fechas(pagina_inicio, None, *ventana)
+            if pagina_fin < ultimo_dia:
+                response['X-Next-Cursor'] = codificar_cursor(
+                    {'desde': (pagina_fin + datetime.timedelta(days=1)).isoformat()}
+                )
+        return response
+
+
+class SlotsBatchAPIView(APIView):
+    """
+    Slots de todas las combinaciones ubicación × tipo de consulta de un
+    nutricionista (vista semanal de la agenda) en un solo request:
+    {"<ubicacion_id>": {"<tipo_consulta_id>": [{"inicio", "fin"}, ...]}}.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    MAX_DIAS = 31
+
+    def get(self, request, nutricionista_id):
+        nutricionista = get_object_or_404(Nutricionista, id=nutricionista_id)
+
+        try:
+            fecha_inicio = datetime.datetime.strptime(request.query_params['fecha_inicio'], '%Y-%m-%d').date()
+            fecha_fin = datetime.datetime.strptime(request.query_params['fecha_fin'], '%Y-%m-%d').date()
+        except KeyError:
+            return Response(
+                {"error": "Los parámetros 'fecha_inicio' y 'fecha_fin' son requeridos."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except (ValueError, TypeError):
+            return Response({"error": "Formato de fecha inválido. Use YYYY-MM-DD."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if fecha_fin < fecha_inicio:
+            return Response(
+                {"error": "La fecha de fin no puede ser anterior a la fecha de inicio."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if (fecha_fin - fecha_inicio).days >= self.MAX_DIAS:
+            return Response(
+                {"error": f"El rango de fechas no puede exceder los {self.MAX_DIAS} días."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        por_combinacion = calculate_available_slots_batch(nutricionista, fecha_inicio, fecha_fin)
+        return Response({
+            str(ubicacion_id): {
+                str(tipo_id): TimeSlotSerializer(slots, many=True).data
+                for tipo_id, slots in por_tipo.items()
+            }
+            for ubicacion_id, por_tipo in por_combinacion.items()
+        })
+
+
+class NextAvailableSlotAPIView(APIView):
+    """
+    Primer slot libre de un nutricionista desde hoy (o 'desde') hasta su
+    anticipación máxima. Usa el iterador perezoso de slots, así que deja de
+    consultar apenas encuentra uno.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, nutricionista_id):
+        nutricionista = get_object_or_404(Nutricionista, id=nutricionista_id)
+
+        try:
+            desde_str = request.query_params.get('desde')
+            desde = datetime.datetime.strptime(desde_str, '%Y-%m-%d').date() if desde_str else timezone.localdate()
+            duracion_str = request.query_params.get('duracion')
+            duracion_minutos = int(duracion_str) if duracion_str else None
+            if duracion_minutos is not None and duracion_minutos <= 0:
+                raise ValueError()
+            ubicacion_id = int(request.query_params['ubicacion_id']) if request.query_params.get('ubicacion_id') else None
+            tipo_consulta_id = int(request.query_params['tipo_consulta_id']) if request.query_params.get('tipo_consulta_id') else None
+        except (ValueError, TypeError):
+            return Response(
+                {"error": "Parámetros inválidos: 'desde' en formato YYYY-MM-DD; duracion, ubicacion_id y tipo_consulta_id enteros positivos."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        slot = next(iter_available_slots(
+            nutricionista,
+            desde,
+            duracion_minutos=duracion_minutos,
+            ubicacion_id=ubicacion_id,
+            tipo_consulta_id=tipo_consulta_id,
+            limit=1,
+        ), None)
+
+        if slot is None:
+            return Response(
+                {"detail": "No hay turnos disponibles dentro de la anticipación máxima de reserva."},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(TimeSlotSerializer(slot).data)
     
 
+
 # apps/agenda/views.py
 # ... (importaciones)
 from rest_framework import viewsets, permissions, status
@@ -307,8 +452,16 @@ from rest_framework.decorators import action
 from django.db import transaction
 from django.utils import timezone
 from .models import Turno, Ubicacion, TipoConsultaConfig # Importar modelos
-from .serializers import TurnoSerializer # Importar serializer
+from .serializers import TurnoSerializer, TurnoAgendaSerializer, TurnoSerieSerializer, TurnoLoteSerializer # Importar serializer
 from .permissions import IsNutriOwner # Reutilizar permiso si aplica
+from rest_framework.exceptions import APIException
+
+
+class ReservaEnCurso(APIException):
+    """Otra reserva tiene tomada la agenda (ver booking.agenda_bloqueada): reintentar."""
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "Hay otra reserva en curso para este horario. Por favor, intente nuevamente en unos segundos."
+    default_code = 'reserva_en_curso'
 
 # ... (Otras vistas)
 
@@ -370,7 +523,14 @@ class TurnoViewSet(viewsets.ModelViewSet):
     def mis_turnos(self, request):
         """
         Endpoint para que el nutricionista obtenga sus turnos con filtros de fecha.
-        GET /api/agenda/turnos/mis-turnos/?fecha_inicio=...&fecha_fin=...
+        GET /api/agenda/turnos/mis-turnos/?fecha_inicio=...&fecha_fin=...&limite=...
+
+        Sin fechas se usa la ventana por defecto (ver listados.py). La respuesta se
+        pagina por keyset en orden (start_time, id): si hay más turnos, trae el
+        header 'X-Next-Cursor' y la página siguiente se pide con ?cursor=<valor>.
+        Con ?exportar=1 se emite el rango completo (sin ventana por defecto ni
+        páginas) como un array JSON en streaming. Con ?vista=calendario cada fila
+        trae solo lo que dibuja el calendario (ver listados.proyectar_calendario).
         """
         user = request.user
         
@@ -384,19 +544,17 @@ class TurnoViewSet(viewsets.ModelViewSet):
         # Obtener parámetros de fecha
         fecha_inicio_str = request.query_params.get('fecha_inicio')
         fecha_fin_str = request.query_params.get('fecha_fin')
+        fecha_inicio = fecha_fin = None
         
         # Base queryset
-        queryset = Turno.objects.filter(
-            nutricionista=user.nutricionista
-        ).select_related('paciente', 'paciente__user', 'tipo_consulta', 'ubicacion')
+        queryset = turnos_de_agenda(user.nutricionista)
         
-        # Filtrar por fechas si se proporcionan
+        # Parsear fechas si se proporcionan
         if fecha_inicio_str:
             try:
                 fecha_inicio = timezone.datetime.fromisoformat(fecha_inicio_str.replace('Z', '+00:00'))
                 if timezone.is_naive(fecha_inicio):
                     fecha_inicio = timezone.make_aware(fecha_inicio)
-                queryset = queryset.filter(start_time__gte=fecha_inicio)
             except (ValueError, TypeError):
                 pass
         
@@ -405,43 +563,49 @@ class TurnoViewSet(viewsets.ModelViewSet):
                 fecha_fin = timezone.datetime.fromisoformat(fecha_fin_str.replace('Z', '+00:00'))
                 if timezone.is_naive(fecha_fin):
                     fecha_fin = timezone.make_aware(fecha_fin)
-                queryset = queryset.filter(start_time__lte=fecha_fin)
             except (ValueError, TypeError):
                 pass
-        
-        # Ordenar por fecha
-        queryset = queryset.order_by('start_time')
-        
-        # Serializar con información extendida
-        turnos_data = []
-        for turno in queryset:
-            data = TurnoSerializer(turno).data
-            
-            # Agregar información adicional del paciente
-            if turno.paciente:
-                # Paciente registrado en el sistema
-                data['paciente_nombre'] = turno.paciente.nombre
-                data['paciente_apellido'] = turno.paciente.apellido
-            elif turno.intake_answers:
-                # Paciente público (desde turnero público)
-                nombre_completo = turno.intake_answers.get('nombre_completo', '')
-                # Intentar separar nombre y apellido
-                partes = nombre_completo.split(' ', 1)
-                data['paciente_nombre'] = partes[0] if len(partes) > 0 else ''
-                data['paciente_apellido'] = partes[1] if len(partes) > 1 else ''
-                # También agregar el email y teléfono del paciente público
-                data['paciente_email'] = turno.intake_answers.get('email', '')
-                data['paciente_telefono'] = turno.intake_answers.get('telefono', '')
-            
-            # Agregar nombre de ubicación y tipo de consulta
-            if turno.ubicacion:
-                data['ubicacion_nombre'] = turno.ubicacion.nombre
-            if turno.tipo_consulta:
-                data['tipo_consulta_display'] = turno.tipo_consulta.get_tipo_display()
-            
-            turnos_data.append(data)
-        
-        return Response(turnos_data)
+
+        if request.query_params.get('vista') == 'calendario':
+            # Filas armadas en la base: sin instancias de modelo ni campos de DRF
+            queryset = proyectar_calendario(Turno.objects.filter(nutricionista=user.nutricionista))
+            serializar = list
+        else:
+            def serializar(filas):
+                return TurnoAgendaSerializer(filas, many=True).data
+
+        # Exportación: todo el rango pedido, de a lotes y sin armar la lista en memoria
+        if request.query_params.get('exportar') in ('1', 'true'):
+            if fecha_inicio:
+                queryset = queryset.filter(start_time__gte=fecha_inicio)
+            if fecha_fin:
+                queryset = queryset.filter(start_time__lte=fecha_fin)
+            return StreamingHttpResponse(
+                exportar_json(iterar_paginas(queryset), serializar), content_type='application/json'
+            )
+
+        fecha_inicio, fecha_fin = ventana_por_defecto(fecha_inicio, fecha_fin)
+        queryset = queryset.filter(start_time__gte=fecha_inicio, start_time__lte=fecha_fin)
+
+        try:
+            limite = int(request.query_params.get('limite', LIMITE_LISTADO))
+            if not 1 <= limite <= LIMITE_MAXIMO_LISTADO:
+                raise ValueError()
+        except ValueError:
+            return Response(
+                {"error": f"El límite debe ser un entero entre 1 y {LIMITE_MAXIMO_LISTADO}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            filas, siguiente = pagina(queryset, request.query_params.get('cursor'), limite)
+        except CursorInvalido:
+            return Response({"error": "Cursor inválido."}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = Response(serializar(filas))
+        if siguiente:
+            response['X-Next-Cursor'] = siguiente
+        return response
 
 
     def perform_create(self, serializer):
@@ -472,214 +636,233 @@ class TurnoViewSet(viewsets.ModelViewSet):
         tipo_consulta = serializer.validated_data.get('tipo_consulta')
 
         # Validar que Ubicacion y TipoConsulta pertenecen al Nutricionista
-        if ubicacion and ubicacion.nutricionista != nutricionista:
-             raise serializers.ValidationError("La ubicación no pertenece al nutricionista seleccionado.")
-        if tipo_consulta.nutricionista != nutricionista:
+        if not ubicacion:
+             raise serializers.ValidationError("Se requiere la ubicación del turno.")
+        if tipo_consulta.nutricionista_id != nutricionista.id:
              raise serializers.ValidationError("El tipo de consulta no pertenece al nutricionista seleccionado.")
 
-        # **Validar política de anticipación mínima**
+        # Anticipación, horario, bloqueos y solapes (buffers incluidos) en una consulta,
+        # bajo el lock de la agenda: sin carreras entre reservas. Una solicitud TENTATIVO
+        # no entra en la restricción de la base hasta que se aprueba (ver booking.py)
+        verificador = VerificadorDisponibilidad.del_request(self.request)
         try:
-            settings = nutricionista.settings
-            anticipacion_minima = settings.anticipacion_minima  # Es un timedelta
-            ahora = timezone.now()
-            tiempo_hasta_turno = slot.lower - ahora  # slot.lower es el inicio del turno
-            
-            if tiempo_hasta_turno < anticipacion_minima:
-                horas_minimas = anticipacion_minima.total_seconds() / 3600
-                horas_hasta_turno = tiempo_hasta_turno.total_seconds() / 3600
-                raise serializers.ValidationError(
-                    f"Se requiere reservar con al menos {horas_minimas:.0f} horas de anticipación. "
-                    f"El turno seleccionado es en {horas_hasta_turno:.1f} horas."
-                )
-        except ProfessionalSettings.DoesNotExist:
-            # Si no hay configuración, usar valor por defecto de 2 horas
-            anticipacion_minima = timedelta(hours=2)
-            ahora = timezone.now()
-            tiempo_hasta_turno = slot.lower - ahora
-            
-            if tiempo_hasta_turno < anticipacion_minima:
-                raise serializers.ValidationError(
-                    "Se requiere reservar con al menos 2 horas de anticipación."
-                )
-
-        # **Validar política de anticipación máxima**
-        try:
-            settings = nutricionista.settings
-            anticipacion_maxima = settings.anticipacion_maxima  # Es un timedelta
-            
-            if tiempo_hasta_turno > anticipacion_maxima:
-                dias_maximos = anticipacion_maxima.days
-                raise serializers.ValidationError(
-                    f"No se puede reservar con más de {dias_maximos} días de anticipación."
-                )
-        except ProfessionalSettings.DoesNotExist:
-            pass  # Si no hay configuración, no validar máximo
-
-
-        # **Obtener buffers del tipo de consulta seleccionado**
-        buffer_before_min = tipo_consulta.buffer_before_min
-        buffer_after_min = tipo_consulta.buffer_after_min
-        
-        # Crear rango extendido con buffers para verificar solapamiento
-        slot_con_buffers = Range(
-            slot.lower - timedelta(minutes=buffer_before_min),
-            slot.upper + timedelta(minutes=buffer_after_min),
-            bounds='[)'
-        )
-
+            with agenda_bloqueada(nutricionista.id, ubicacion.id):
+                try:
+                    verificador.verificar(nutricionista.id, ubicacion.id, tipo_consulta, slot.lower, slot.upper)
+                except HorarioNoReservable as e:
+                    raise serializers.ValidationError(str(e))
+
+                # Si pasa todas las validaciones, guardar con datos automáticos
+                with sin_solapes():
+                    serializer.save(
+                        paciente=paciente,
+                        nutricionista=nutricionista,
+                        state=TurnoState.TENTATIVO # Estado inicial
+                    )
+        except AgendaOcupada:
+            raise ReservaEnCurso()
+        except ConflictoDeHorario:
+            # Otro usuario reservó este slot justo antes (condición de carrera)
+            raise serializers.ValidationError(
+                "Este horario acaba de ser reservado por otro usuario. Por favor, seleccione otro horario disponible."
+            )
 
-        # **Validación CRÍTICA de solapamiento con buffers**
-        # 1. Verificar contra otros turnos activos (no cancelados) incluyendo sus buffers
-        from django.db.models import Q
-        
-        turnos_existentes = Turno.objects.filter(
-            nutricionista=nutricionista,
-            slot__overlap=slot_con_buffers  # Verificar contra el rango con buffers
-        ).exclude(
-            state=TurnoState.CANCELADO
-        ).filter(
-            Q(state__in=[TurnoState.RESERVADO, TurnoState.CONFIRMADO, TurnoState.ATENDIDO]) |
-            (Q(state=TurnoState.TENTATIVO) & Q(soft_hold_expires_at__gt=timezone.now()))
-        )
-        
-        # Para cada turno existente, verificar considerando también SUS buffers
-        for turno_existente in turnos_existentes:
-            turno_buffer_before = turno_existente.tipo_consulta.buffer_before_min if turno_existente.tipo_consulta else 0
-            turno_buffer_after = turno_existente.tipo_consulta.buffer_after_min if turno_existente.tipo_consulta else 0
-            
-            turno_existente_con_buffers = Range(
-                turno_existente.slot.lower - timedelta(minutes=turno_buffer_before),
-                turno_existente.slot.upper + timedelta(minutes=turno_buffer_after),
-                bounds='[)'
+    @action(detail=False, methods=['post'], url_path='serie', permission_classes=[permissions.IsAuthenticated])
+    def serie(self, request):
+        """
+        Reserva una serie semanal de turnos confirmados para un paciente asignado.
+        POST /api/agenda/turnos/serie/
+        {paciente_id, ubicacion_id, tipo_consulta_id, slot_inicio, slot_fin,
+         repeticiones, intervalo_semanas?, omitir_conflictos?}
+
+        Todas las ocurrencias se validan juntas y se insertan en un solo INSERT
+        (ver booking.reservar_serie). La respuesta informa el conflicto de cada
+        ocurrencia que no se pudo reservar.
+        """
+        user = request.user
+        if not hasattr(user, 'nutricionista'):
+            return Response(
+                {"error": "Solo los nutricionistas pueden reservar series de turnos."},
+                status=status.HTTP_403_FORBIDDEN
             )
-            
-            # Verificar si hay solapamiento entre los dos rangos con buffers
-            if (slot_con_buffers.lower < turno_existente_con_buffers.upper and 
-                slot_con_buffers.upper > turno_existente_con_buffers.lower):
-                raise serializers.ValidationError(
-                    "El horario seleccionado no está disponible (incluyendo tiempos de preparación). "
-                    "Por favor, seleccione otro horario."
-                )
+        nutricionista = user.nutricionista
 
-        # 2. Verificar contra bloqueos (filtrar por ubicacion si aplica)
-        bloqueos_query = BloqueoDisponibilidad.objects.filter(
-            nutricionista=nutricionista,
-            start_time__lt=slot.upper,
-            end_time__gt=slot.lower
-        )
-        if ubicacion:
-            bloqueos_query = bloqueos_query.filter(ubicacion=ubicacion)
-        
-        if bloqueos_query.exists():
-              raise serializers.ValidationError("El horario seleccionado no está disponible (bloqueado).")
-
-        # 3. Verificar si cae dentro de alguna DisponibilidadHoraria válida
-        weekday = slot.lower.weekday()
-        hora_inicio = slot.lower.time()
-        hora_fin = slot.upper.time()
-
-        disponibilidades_query = DisponibilidadHoraria.objects.filter(
-            nutricionista=nutricionista,
-            dia_semana=weekday,
-            hora_inicio__lte=hora_inicio,
-            hora_fin__gte=hora_fin # Asegura que el slot completo esté dentro
+        serializer = TurnoSerieSerializer(data=request.data, context={'nutricionista': nutricionista})
+        serializer.is_valid(raise_exception=True)
+        datos = serializer.validated_data
+        ubicacion = datos['ubicacion']
+        rangos = ocurrencias_semanales(
+            datos['slot_inicio'], datos['slot_fin'], datos['repeticiones'],
+            datos['intervalo_semanas'], zona_horaria(ubicacion.timezone),
         )
-        if ubicacion:
-            disponibilidades_query = disponibilidades_query.filter(ubicacion=ubicacion)
-
-        if not disponibilidades_query.exists():
-             raise serializers.ValidationError("El horario seleccionado no está dentro de la disponibilidad del nutricionista.")
-
 
-
-        # Si pasa todas las validaciones, guardar con datos automáticos
-        from django.db import IntegrityError
-        
         try:
-            serializer.save(
-                paciente=paciente,
-                nutricionista=nutricionista,
-                state=TurnoState.TENTATIVO # Estado inicial
+            turnos, conflictos = reservar_serie(
+                nutricionista, datos['paciente'], ubicacion, datos['tipo_consulta'], rangos,
+                omitir_conflictos=datos['omitir_conflictos'],
+                verificador=VerificadorDisponibilidad.del_request(request),
             )
-        except IntegrityError as e:
-            # Si la constraint de exclusión falla, significa que otro usuario 
-            # reservó este slot justo antes (condición de carrera)
-            if 'no_overlap_por_prof_y_ubic' in str(e):
-                raise serializers.ValidationError(
-                    "Este horario acaba de ser reservado por otro usuario. Por favor, seleccione otro horario disponible."
-                )
-            # Si es otro tipo de IntegrityError, re-lanzar
-            raise
+        except AgendaOcupada:
+            raise ReservaEnCurso()
+        except ConflictoDeHorario:
+            return Response(
+                {"error": "Uno de los horarios de la serie acaba de ser reservado. Por favor, intente nuevamente."},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        reporte = [
+            {"start_time": inicio, "end_time": fin, "motivo": error.motivo, "detalle": str(error)}
+            for (inicio, fin), error in conflictos
+        ]
+        if not turnos:
+            return Response(
+                {"error": "Hay ocurrencias de la serie que no se pueden reservar.", "conflictos": reporte},
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response(
+            {"turnos": TurnoSerializer(turnos, many=True).data, "conflictos": reporte},
+            status=status.HTTP_201_CREATED
+        )
 
     # Acción para que el Nutricionista apruebe un turno
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated, IsNutriOwner])
     def aprobar(self, request, pk=None):
         turno = self.get_object()
-        if turno.state != TurnoState.TENTATIVO:
+        if turno.state not in TRANSICIONES_TURNO[TurnoState.CONFIRMADO]:
             return Response(
                 {"error": "Solo se pueden aprobar turnos en estado TENTATIVO."},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Obtener buffers del turno a aprobar
-        buffer_before_min = turno.tipo_consulta.buffer_before_min if turno.tipo_consulta else 0
-        buffer_after_min = turno.tipo_consulta.buffer_after_min if turno.tipo_consulta else 0
-        
-        turno_con_buffers = Range(
-            turno.slot.lower - timedelta(minutes=buffer_before_min),
-            turno.slot.upper + timedelta(minutes=buffer_after_min),
-            bounds='[)'
-        )
-        
-        # Validar solapamiento OTRA VEZ por si algo cambió mientras estaba tentativo
-        # Verificar contra turnos CONFIRMADOS (incluyendo sus buffers)
-        turnos_confirmados = Turno.objects.filter(
-            nutricionista=turno.nutricionista,
-            state=TurnoState.CONFIRMADO,
-            slot__overlap=turno_con_buffers  # Verificar contra el rango con buffers
-        ).exclude(pk=turno.pk)  # Excluir el turno actual
-        
-        # Para cada turno confirmado, verificar considerando también SUS buffers
-        for turno_existente in turnos_confirmados:
-            turno_buffer_before = turno_existente.tipo_consulta.buffer_before_min if turno_existente.tipo_consulta else 0
-            turno_buffer_after = turno_existente.tipo_consulta.buffer_after_min if turno_existente.tipo_consulta else 0
-            
-            turno_existente_con_buffers = Range(
-                turno_existente.slot.lower - timedelta(minutes=turno_buffer_before),
-                turno_existente.slot.upper + timedelta(minutes=turno_buffer_after),
-                bounds='[)'
-            )
-            
-            # Verificar si hay solapamiento entre los dos rangos con buffers
-            if (turno_con_buffers.lower < turno_existente_con_buffers.upper and 
-                turno_con_buffers.upper > turno_existente_con_buffers.lower):
-                return Response(
-                    {"error": "Conflicto de horario detectado (incluyendo tiempos de preparación). No se puede aprobar."},
-                    status=status.HTTP_409_CONFLICT
-                )
-
-        turno.state = TurnoState.CONFIRMADO
+        # Revalidar por si algo cambió mientras estaba tentativo (la anticipación ya se
+        # validó al pedirlo); la restricción de solapes de la base respalda el UPDATE
+        verificador = VerificadorDisponibilidad.del_request(request)
         # Podrías añadir notas del nutricionista aquí si se envían en el request
-        # turno.notas_nutricionista = request.data.get('notas_nutricionista', turno.notas_nutricionista)
-        turno.save()
+        # (como cambio extra de turno.transicionar)
+        try:
+            with agenda_bloqueada(turno.nutricionista_id, turno.ubicacion_id):
+                liberar_holds_vencidos(turno.nutricionista_id, turno.ubicacion_id, turno.busy_range)
+                verificador.verificar(
+                    turno.nutricionista_id, turno.ubicacion_id, turno.tipo_consulta,
+                    turno.start_time, turno.end_time, excluir_id=turno.id, anticipacion=False,
+                )
+                with sin_solapes():
+                    # UPDATE condicional: si otro request lo canceló/aprobó antes, no aplica
+                    aprobado = turno.transicionar(TurnoState.CONFIRMADO)
+        except AgendaOcupada:
+            raise ReservaEnCurso()
+        except HorarioNoReservable as e:
+            return Response({"error": str(e), "motivo": e.motivo}, status=status.HTTP_409_CONFLICT)
+        except ConflictoDeHorario:
+            return Response(
+                {"error": "Conflicto de horario detectado (incluyendo tiempos de preparación). No se puede aprobar."},
+                status=status.HTTP_409_CONFLICT
+            )
+        if not aprobado:
+            return Response(
+                {"error": "El turno cambió de estado mientras se procesaba la aprobación. Actualice e intente nuevamente."},
+                status=status.HTTP_409_CONFLICT
+            )
         serializer = self.get_serializer(turno)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], url_path='lote', permission_classes=[permissions.IsAuthenticated])
+    def lote(self, request):
+        """
+        Aprueba o cancela varios turnos del nutricionista de una vez.
+        POST /api/agenda/turnos/lote/  {"ids": [...], "estado": "CONFIRMADO" | "CANCELADO"}
+
+        El lote se revalida en una consulta y se aplica con un solo UPDATE (ver
+        booking.transicionar_lote); los turnos que no se pudieron pasar al estado
+        pedido se informan con su motivo. Los avisos a pacientes se encolan como
+        una única tarea.
+        """
+        user = request.user
+        if not hasattr(user, 'nutricionista'):
+            return Response(
+                {"error": "Solo los nutricionistas pueden aprobar o cancelar turnos en lote."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        nutricionista = user.nutricionista
+
+        serializer = TurnoLoteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        destino = serializer.validated_data['estado']
+
+        try:
+            aplicados, rechazos = transicionar_lote(
+                nutricionista.id, ids, destino, verificador=VerificadorDisponibilidad.del_request(request),
+            )
+        except AgendaOcupada:
+            raise ReservaEnCurso()
+        except ConflictoDeHorario:
+            return Response(
+                {"error": "Conflicto de horario detectado (incluyendo tiempos de preparación). No se aplicó el lote."},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        self._notificar_lote(aplicados, destino)
+        return Response({
+            "aplicados": aplicados,
+            "rechazados": [
+                {"id": turno_id, "motivo": error.motivo, "detalle": str(error)}
+                for turno_id, error in rechazos.items()
+            ],
+        })
+
+    def _notificar_lote(self, turno_ids, destino):
+        """Un NotificationLog por paciente con email, guardados y publicados juntos."""
+        template = {
+            TurnoState.CONFIRMADO: "turno_confirmado_paciente",
+            TurnoState.CANCELADO: "turno_cancelado_paciente",
+        }[destino]
+        logs = []
+        for turno in Turno.objects.filter(pk__in=turno_ids).select_related(
+            'paciente__user', 'nutricionista', 'ubicacion', 'tipo_consulta'
+        ):
+            if turno.paciente:
+                destinatario = turno.paciente.user.email
+                nombre_paciente = turno.paciente.nombre
+            else:
+                destinatario = (turno.intake_answers or {}).get('email')
+                nombre_paciente = (turno.intake_answers or {}).get('nombre_completo', 'paciente')
+            if not destinatario:
+                continue
+            logs.append(NotificationLog(
+                turno=turno,
+                paciente=turno.paciente,
+                channel=NotificationChannel.EMAIL,
+                template=template,
+                payload={
+                    "destinatario": destinatario,
+                    "nombre_paciente": nombre_paciente,
+                    "nombre_nutri": turno.nutricionista.full_name,
+                    "nutricionista_id": turno.nutricionista.id,
+                    "fecha_hora_inicio": turno.start_time.isoformat(),
+                    "ubicacion_nombre": turno.ubicacion.nombre,
+                    "tipo_consulta": turno.tipo_consulta.get_tipo_display(),
+                }
+            ))
+        # Outbox: se publican en la cola al confirmar, en lotes por remitente
+        notificar(logs)
+
     # Acción genérica para cancelar (podría necesitar lógica distinta para paciente vs nutri)
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated]) # Permiso más específico?
     def cancelar(self, request, pk=None):
         turno = self.get_object()
         user = request.user
 
-        # Validar quién puede cancelar qué estado
+        # Validar quién puede cancelar qué estado (ver TRANSICIONES_TURNO)
         can_cancel = False
         is_paciente = False
+        cancelable = turno.state in TRANSICIONES_TURNO[TurnoState.CANCELADO]
         
         # CORREGIDO: Comparar correctamente paciente.user_account con user
-        if hasattr(user, 'paciente') and user.paciente == turno.paciente and turno.state in [TurnoState.TENTATIVO, TurnoState.CONFIRMADO]:
+        if hasattr(user, 'paciente') and user.paciente == turno.paciente and cancelable:
              can_cancel = True # Paciente puede cancelar sus turnos (quizás con límite de tiempo antes de la cita?)
              is_paciente = True
-        elif hasattr(user, 'nutricionista') and user.nutricionista == turno.nutricionista and turno.state in [TurnoState.TENTATIVO, TurnoState.CONFIRMADO]:
+        elif hasattr(user, 'nutricionista') and user.nutricionista == turno.nutricionista and cancelable:
              can_cancel = True # Nutri puede cancelar
         elif user.is_staff: # Admin puede cancelar
              can_cancel = True
@@ -720,10 +903,13 @@ class TurnoViewSet(viewsets.ModelViewSet):
              # return Response({"error": "No se puede cancelar un turno que ya ha pasado."}, status=status.HTTP_400_BAD_REQUEST)
              pass # O permitirlo con registro?
 
-        turno.state = TurnoState.CANCELADO
-        # Añadir razón de cancelación?
-        # turno.notas_cancelacion = request.data.get('razon')
-        turno.save()
+        # Añadir razón de cancelación? (como cambio extra de turno.transicionar)
+        # UPDATE condicional: si otro request cambió el estado antes, no aplica
+        if not turno.transicionar(TurnoState.CANCELADO):
+            return Response(
+                {"error": "El turno ya no se puede cancelar: cambió de estado o ya está cancelado/completado."},
+                status=status.HTTP_409_CONFLICT
+            )
         serializer = self.get_serializer(turno)
         return Response(serializer.data)
 
@@ -739,7 +925,8 @@ class TurnoViewSet(viewsets.ModelViewSet):
 class PublicSlotsView(APIView):
     """
     Vista pública para obtener slots de disponibilidad (GET).
-    Utiliza la función 'calculate_available_slots' existente.
+    Sirve cada día desde la caché versionada de slots (ver slot_cache.py),
+    que usa el mismo motor que 'calculate_available_slots'.
     """
     permission_classes = [AllowAny]
 
@@ -768,14 +955,14 @@ class PublicSlotsView(APIView):
             start_date = dt.fromisoformat(fecha_inicio_str).date()
             end_date = dt.fromisoformat(fecha_fin_str).date()
 
-            # 3. Llamamos a la función de utils.py
-            slots = calculate_available_slots(
+            # 3. Slots por día desde la caché (los días faltantes se calculan juntos)
+            slots = slots_cacheados(
                 nutricionista=nutricionista,
                 start_date=start_date,
                 end_date=end_date,
                 ubicacion_id=ubicacion_id,
                 tipo_consulta_id=tipo_consulta_id
-                # duracion_minutos se calcula dentro del util
+                # duracion_minutos se calcula dentro del motor
             )
             
             # El util devuelve [{'inicio': dt, 'fin': dt}], lo cual es serializable
@@ -791,6 +978,56 @@ class PublicSlotsView(APIView):
             return Response({"error": "Ocurrió un error al calcular la disponibilidad."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class PublicSlotSearchView(APIView):
+    """
+    GET /api/public/agenda/busqueda/?especialidad=&modalidad=virtual|presencial&ubicacion_id=&tipo=&start_date=&end_date=&limit=
+    Primeros N slots libres entre todos los nutricionistas públicos (ver busqueda.py).
+    Sin fechas busca desde hoy y durante las próximas dos semanas.
+    """
+    permission_classes = [AllowAny]
+    MAX_DIAS = 31
+
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        modalidad = params.get('modalidad')
+        if modalidad not in (None, '', 'virtual', 'presencial'):
+            return Response({"error": "modalidad debe ser 'virtual' o 'presencial'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        tipo = params.get('tipo') or TipoConsulta.INICIAL
+        if tipo not in TipoConsulta.values:
+            return Response({"error": f"tipo inválido. Opciones: {', '.join(TipoConsulta.values)}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            from datetime import datetime as dt
+            hoy = timezone.localdate()
+            start_date = dt.fromisoformat(params['start_date']).date() if params.get('start_date') else hoy
+            end_date = (
+                dt.fromisoformat(params['end_date']).date() if params.get('end_date')
+                else start_date + datetime.timedelta(days=13)
+            )
+            limite = min(int(params.get('limit', LIMITE_POR_DEFECTO)), LIMITE_MAXIMO)
+            especialidad_id = int(params['especialidad']) if params.get('especialidad') else None
+            ubicacion_id = int(params['ubicacion_id']) if params.get('ubicacion_id') else None
+        except (ValueError, TypeError):
+            return Response({"error": "Parámetros inválidos. Fechas en formato YYYY-MM-DD; limit, especialidad y ubicacion_id numéricos."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if end_date < start_date:
+            return Response({"error": "end_date no puede ser anterior a start_date."}, status=status.HTTP_400_BAD_REQUEST)
+        if (end_date - start_date).days >= self.MAX_DIAS:
+            return Response({"error": f"El rango de búsqueda no puede superar {self.MAX_DIAS} días."}, status=status.HTTP_400_BAD_REQUEST)
+
+        slots = buscar_primeros_slots(
+            start_date,
+            end_date,
+            limite=limite,
+            especialidad_id=especialidad_id,
+            ubicacion_id=ubicacion_id,
+            is_virtual={'virtual': True, 'presencial': False}.get(modalidad),
+            tipo=tipo,
+        )
+        return Response(slots, status=status.HTTP_200_OK)
+
+
 class PublicTurnoCreateView(generics.CreateAPIView):
     """
     Vista pública para CREAR un turno tentativo (POST).
@@ -800,26 +1037,50 @@ class PublicTurnoCreateView(generics.CreateAPIView):
     permission_classes = [AllowAny]
 
     def create(self, request, *args, **kwargs):
-        # DEBUG: Imprimir los datos recibidos
-        print(f"DEBUG PublicTurnoCreateView - Request data: {request.data}")
-        return super().create(request, *args, **kwargs)
+        # Un reintento con la misma Idempotency-Key recibe la respuesta original
+        # (sin crear otro hold, token ni email)
+        return responder_idempotente(request, 'turno_publico', lambda: self._crear(request, *args, **kwargs))
+
+    def _crear(self, request, *args, **kwargs):
+        try:
+            agenda = int(request.data.get('nutricionista')), int(request.data.get('ubicacion'))
+        except (TypeError, ValueError):
+            agenda = None
+        if not agenda or not all(0 < clave < 2 ** 31 for clave in agenda):
+            # IDs inválidos: que los reporte el serializador, no hay agenda que bloquear
+            return super().create(request, *args, **kwargs)
+
+        # Validación y alta bajo el lock de la agenda: dos reservas concurrentes
+        # sobre la misma agenda no pueden validar ambas antes de insertar
+        try:
+            with agenda_bloqueada(*agenda):
+                return super().create(request, *args, **kwargs)
+        except AgendaOcupada:
+            raise ReservaEnCurso()
 
     def perform_create(self, serializer):
-        from django.db import IntegrityError
         from rest_framework.exceptions import ValidationError
-        
+
+        datos = serializer.validated_data
+        nutricionista_id, ubicacion_id = datos['nutricionista'].id, datos['ubicacion'].id
+        busy_range = Turno.calcular_busy_range(datos['start_time'], datos['end_time'], datos['tipo_consulta'])
+        liberar_holds_vencidos(nutricionista_id, ubicacion_id, busy_range)
+        try:
+            VerificadorDisponibilidad.del_request(self.request).verificar(
+                nutricionista_id, ubicacion_id, datos['tipo_consulta'], datos['start_time'], datos['end_time']
+            )
+        except HorarioNoReservable as e:
+            raise ValidationError({"detail": str(e)})
         try:
-            # El serializador ya setea el estado TENTATIVO y el soft_hold_expires_at
-            turno = serializer.save()
-        except IntegrityError as e:
-            # Si la constraint de exclusión falla, significa que otro usuario 
-            # reservó este slot justo antes (condición de carrera)
-            if 'no_overlap_por_prof_y_ubic' in str(e):
-                raise ValidationError({
-                    "detail": "Este horario acaba de ser reservado por otro usuario. Por favor, seleccione otro horario disponible."
-                })
-            # Si es otro tipo de IntegrityError, re-lanzar
-            raise
+            # El serializador ya setea el estado TENTATIVO y el soft_hold_expires_at;
+            # la restricción de solapes de la base rechaza el INSERT si el horario
+            # (buffers incluidos) ya está tomado
+            with sin_solapes():
+                turno = serializer.save()
+        except ConflictoDeHorario:
+            raise ValidationError({
+                "detail": "Este horario ya no está disponible. Por favor seleccione otro horario."
+            })
         
         # Crear el MagicLinkToken usando el modelo existente
         token_obj = MagicLinkToken.objects.create(
@@ -840,7 +1101,7 @@ class PublicTurnoCreateView(generics.CreateAPIView):
 
         # 3. Crear el Log de Notificación (usando tu modelo)
         if email_paciente:
-            log = NotificationLog.objects.create(
+            notificar([NotificationLog(
                 turno=turno,
                 channel=NotificationChannel.EMAIL,
                 template="public_booking_verification", # Template para "Por favor confirma tu turno"
@@ -853,10 +1114,7 @@ class PublicTurnoCreateView(generics.CreateAPIView):
                     "fecha_hora_inicio": turno.start_time.isoformat(),
                     "tipo_consulta": turno.tipo_consulta.get_tipo_display()
                 }
-            )
-            send_notification_email.delay(log.id)
-        
-        print(f"DEBUG: Token creado para turno {turno.id}: {token_obj.token}")
+            )])
 
 
 class PublicTurnoVerifyView(generics.GenericAPIView):
@@ -868,21 +1126,28 @@ class PublicTurnoVerifyView(generics.GenericAPIView):
     permission_classes = [AllowAny]
 
     def post(self, request, *args, **kwargs):
+        # Un reintento con la misma Idempotency-Key recibe la respuesta original
+        return responder_idempotente(request, 'verificar_turno', lambda: self._verificar(request))
+
+    def _verificar(self, request):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         
         # El serializador ya validó el token, lo usó y nos devuelve el turno
         turno = serializer.validated_data.get('turno')
         
-        # Actualizar el turno de 'TENTATIVO' a 'RESERVADO'
-        turno.state = TurnoState.RESERVADO 
-        turno.soft_hold_expires_at = None # Eliminar la expiración
-        turno.save(update_fields=['state', 'soft_hold_expires_at', 'updated_at'])
+        # Actualizar el turno de 'TENTATIVO' a 'RESERVADO' y eliminar la expiración,
+        # salvo que se haya cancelado mientras tanto (p. ej. por el reaper de holds)
+        if not turno.transicionar(TurnoState.RESERVADO, soft_hold_expires_at=None):
+            raise serializers.ValidationError("La reserva ha expirado. Por favor, intente de nuevo.")
+
+        # Ambos avisos se guardan en el outbox y salen solo si el cambio se confirma
+        logs = []
 
        # 1. Notificación al Paciente (Confirmación de Reserva)
         email_paciente = turno.intake_answers.get('email')
         if email_paciente:
-            log_paciente = NotificationLog.objects.create(
+            logs.append(NotificationLog(
                 turno=turno,
                 channel=NotificationChannel.EMAIL,
                 template="public_booking_confirmed_paciente", # Template para "Tu turno está reservado"
@@ -895,13 +1160,12 @@ class PublicTurnoVerifyView(generics.GenericAPIView):
                     "ubicacion_nombre": turno.ubicacion.nombre,
                     "tipo_consulta": turno.tipo_consulta.get_tipo_display()
                 }
-            )
-            send_notification_email.delay(log_paciente.id)
+            ))
 
         # 2. Notificación al Nutricionista (Aviso de nuevo turno)
         email_nutri = turno.nutricionista.user.email
         if email_nutri:
-            log_nutri = NotificationLog.objects.create(
+            logs.append(NotificationLog(
                 turno=turno,
                 profesional=turno.nutricionista, # Trazabilidad: models.py
                 channel=NotificationChannel.EMAIL,
@@ -916,8 +1180,8 @@ class PublicTurnoVerifyView(generics.GenericAPIView):
                     "fecha_hora_inicio": turno.start_time.isoformat(),
                     "tipo_consulta": turno.tipo_consulta.get_tipo_display()
                 }
-            )
-            send_notification_email.delay(log_nutri.id)
+            ))
+        notificar(logs)
 
         # Devolvemos el turno completo
         return Response(
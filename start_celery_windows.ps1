@@ -5,9 +5,11 @@ Write-Host "🚀 Iniciando Celery Worker para Windows..." -ForegroundColor Green
 Write-Host "Pool: solo (compatible con Windows)" -ForegroundColor Yellow
 Write-Host ""
 
-celery -A core worker --pool=solo -l info
+celery -A core worker --pool=solo -Q celery,notificaciones_criticas,notificaciones_masivas -l info
 
 # Notas:
 # - El pool 'solo' ejecuta tareas de forma síncrona (una a la vez)
 # - Es la solución recomendada para desarrollo en Windows
 # - En producción (Linux), usar el pool 'prefork' por defecto
+# - -Q: este único worker atiende también las colas de notificaciones; en
+#   producción cada una va en su propio worker (ver apps/agenda/colas.py)